@@ -0,0 +1,618 @@
+#!/usr/bin/env python
+"""
+NumPy evaluator of the LAMMPS force field used by ForceFieldParameters.
+It follows the settings written by LAMMPSStructure:
+
+    - bond_style harmonic: E = k(r-req)^2
+    - angle_style harmonic: E = k(theta-theteq)^2
+    - dihedral_style charmm (weight 0): E = phi_k[1+cos(n*phi-d)]
+    - pair_style lj/cut/coul/long with the arithmetic mixing and tail
+    - special_bonds amber (lj 0 0 0.5, coul 0 0 0.83333, angle yes)
+    - Ewald summation with the same gewald in place of pppm
+
+Besides the energy/forces/stress, it gives their derivatives with respect
+to the full parameter vector of ForceFieldParameters. All the geometry
+dependent terms are collected in the descriptors of each structure, so
+that a new set of parameters only needs a few small contractions.
+"""
+import numpy as np
+from scipy.special import erfc
+from ase import units
+from ase.neighborlist import primitive_neighbor_list
+from parmed.topologyobjects import DihedralTypeList
+
+from pyocse.interfaces.parmed import ParmEdStructure
+
+# lammps constants in real units
+QQR2E = 332.06371
+SPECIAL_LJ = [1.0, 0.0, 0.0, 0.5]
+SPECIAL_COUL = [1.0, 0.0, 0.0, 0.83333]
+KCAL2EV = units.kcal / units.mol
+VOIGT = [(0, 0), (1, 1), (2, 2), (1, 2), (0, 2), (0, 1)]
+
+
+def mic(vecs, cell, inv_cell):
+    """
+    Apply the minimum image convention to the bonded vectors
+    """
+    frac = vecs @ inv_cell
+    return vecs - np.round(frac) @ cell
+
+def get_special_levels(natoms, bonds, angles):
+    """
+    Get the special levels (1: 1-2, 2: 1-3, 3: 1-4, 0: others) within
+    a molecule in the same way as special_bonds with angle yes.
+
+    Args:
+        natoms (int): number of atoms
+        bonds: list of (i, j)
+        angles: list of (i, j, k)
+    """
+    conn = np.zeros([natoms, natoms], dtype=int)
+    for (i, j) in bonds:
+        conn[i, j] = conn[j, i] = 1
+    n2 = conn @ conn
+    n3 = n2 @ conn
+    levels = np.zeros([natoms, natoms], dtype=int)
+    levels[(n3 > 0)] = 3
+    levels[(n2 > 0)] = 2
+    levels[(conn > 0)] = 1
+    np.fill_diagonal(levels, 0)
+
+    # 1-3 pairs are only weighted when they are the ends of an angle
+    in_angle = np.zeros([natoms, natoms], dtype=bool)
+    for (i, j, k) in angles:
+        in_angle[i, k] = in_angle[k, i] = True
+    levels[(levels == 2) & (~in_angle)] = 0
+    return levels
+
+
+class AnalyticFF:
+    """
+    Analytic FF evaluator for one topology (smiles + numMols + natoms)
+
+    Args:
+        params: ForceFieldParameters object
+        numMols (list): number of molecules for each smiles
+        natoms (int): number of atoms of the structures, a multiple of the
+            numMols block for the supercells, None for one block
+    """
+
+    def __init__(self, params, numMols, natoms=None):
+        self.numMols = list(numMols)
+        self.n_params = len(params.params_init)
+        self.base_bond = 0
+        self.base_angle = params.N_bond
+        self.base_proper = self.base_angle + params.N_angle
+        self.base_vdW = self.base_proper + params.N_proper
+        self.base_charge = self.base_vdW + params.N_vdW
+        self.n_types = params.N_vdW // 2
+        self.n_charges = params.N_charges
+
+        cutoffs = ParmEdStructure.DEFAULT_CUTOFF_LJOUT, ParmEdStructure.DEFAULT_CUTOFF_COUL
+        self.cutoff_lj, self.cutoff_coul = cutoffs
+        tol = ParmEdStructure.DEFAULT_EWALD_ERROR_TOLERANCE
+        self.gewald = (-np.log(tol * 2.0)) ** 0.5 / self.cutoff_coul
+        self.set_topology(params.ff.molecules, natoms)
+
+    def set_topology(self, molecules, natoms=None):
+        """
+        Tile the topology of each molecule in the same order as the
+        lammps structure (see forcefield.update_ase_lammps): the block of
+        numMols molecules (or the single molecule for one smiles) is
+        repeated up to natoms
+
+        Args:
+            molecules (list): parmed structure of each smiles
+            natoms (int): number of atoms, None for one block
+        """
+        if len(molecules) == 1 and natoms is not None:
+            block = [0]
+        else:
+            block = [m for m, nmol in enumerate(self.numMols) for _ in range(nmol)]
+        n_block = sum([len(molecules[m].atoms) for m in block])
+        if natoms is None:
+            mul = 1
+        elif natoms % n_block != 0:
+            raise ValueError("Inconsistent number of atoms", natoms, n_block)
+        else:
+            mul = natoms // n_block
+
+        bonds, bond_ids = [], []
+        angles, angle_ids = [], []
+        diheds, dihed_ids, dihed_pers, dihed_phases = [], [], [], []
+        types, charges, mols, locs, moltypes = [], [], [], [], []
+        self.levels = []
+
+        # the terms of each molecule with the parameter/type/charge ids
+        tops = []
+        b_base, a_base, d_base = self.base_bond, self.base_angle, self.base_proper
+        t_base, c_base = 0, 0
+        for molecule in molecules[:len(self.numMols)]:
+            natoms_mol = len(molecule.atoms)
+            ps = molecule.get_parameterset_with_resname_as_prefix()
+            keys = list(ps.atom_types.keys())
+            _types = [t_base + keys.index(at.residue.name + at.type) for at in molecule.atoms]
+
+            _bonds = [(b.atom1.idx, b.atom2.idx) for b in molecule.bonds]
+            _bond_ids = [b_base + 2 * b.type.idx for b in molecule.bonds]
+            _angles = [(a.atom1.idx, a.atom2.idx, a.atom3.idx) for a in molecule.angles]
+            _angle_ids = [a_base + 2 * a.type.idx for a in molecule.angles]
+            _diheds, _dihed_ids, _pers, _phases = [], [], [], []
+            for d in molecule.dihedrals:
+                dtype = d.type
+                if type(dtype) == DihedralTypeList:
+                    dtype = dtype[0]
+                _diheds.append((d.atom1.idx, d.atom2.idx, d.atom3.idx, d.atom4.idx))
+                _dihed_ids.append(d_base + dtype.idx)
+                _pers.append(dtype.per)
+                _phases.append(int(dtype.phase))
+            self.levels.append(get_special_levels(natoms_mol, _bonds, _angles))
+            tops.append((natoms_mol, _bonds, _bond_ids, _angles, _angle_ids,
+                         _diheds, _dihed_ids, _pers, _phases, _types, c_base))
+
+            b_base += 2 * len(molecule.bond_types)
+            a_base += 2 * len(molecule.angle_types)
+            d_base += len(molecule.dihedral_types)
+            t_base += len(keys)
+            c_base += natoms_mol
+
+        count = 0
+        for imol, m in enumerate(block * mul):
+            (natoms_mol, _bonds, _bond_ids, _angles, _angle_ids,
+             _diheds, _dihed_ids, _pers, _phases, _types, c0) = tops[m]
+            shift = count
+            bonds.extend([(b[0] + shift, b[1] + shift) for b in _bonds])
+            angles.extend([tuple(x + shift for x in a) for a in _angles])
+            diheds.extend([tuple(x + shift for x in d) for d in _diheds])
+            bond_ids.extend(_bond_ids)
+            angle_ids.extend(_angle_ids)
+            dihed_ids.extend(_dihed_ids)
+            dihed_pers.extend(_pers)
+            dihed_phases.extend(_phases)
+            types.extend(_types)
+            charges.extend(range(c0, c0 + natoms_mol))
+            mols.extend([imol] * natoms_mol)
+            locs.extend(range(natoms_mol))
+            moltypes.extend([m] * natoms_mol)
+            count += natoms_mol
+
+        self.natoms = count
+        self.bonds = np.array(bonds, dtype=int).reshape([-1, 2])
+        self.bond_ids = np.array(bond_ids, dtype=int)
+        self.angles = np.array(angles, dtype=int).reshape([-1, 3])
+        self.angle_ids = np.array(angle_ids, dtype=int)
+        self.diheds = np.array(diheds, dtype=int).reshape([-1, 4])
+        self.dihed_ids = np.array(dihed_ids, dtype=int)
+        self.dihed_pers = np.array(dihed_pers, dtype=float)
+        self.dihed_phases = np.radians(np.array(dihed_phases, dtype=float))
+        self.types = np.array(types, dtype=int)
+        self.charge_ids = np.array(charges, dtype=int)
+        self.mols = np.array(mols, dtype=int)
+        self.locs = np.array(locs, dtype=int)
+        self.moltypes = np.array(moltypes, dtype=int)
+        self.type_counts = np.bincount(self.types, minlength=self.n_types).astype(float)
+        self.charge_counts = np.bincount(self.charge_ids, minlength=self.n_charges).astype(float)
+
+    def get_descriptors(self, structure):
+        """
+        Compute the parameter independent terms of a structure
+
+        Args:
+            structure: ase atoms in the same order as the topology
+
+        Returns:
+            a dictionary of numpy arrays
+        """
+        if len(structure) != self.natoms:
+            raise ValueError("Inconsistent number of atoms", len(structure), self.natoms)
+        pos = structure.get_positions()
+        cell = structure.cell.array
+        inv_cell = np.linalg.inv(cell)
+        desc = {'volume': abs(np.linalg.det(cell))}
+        desc['bond'] = self._get_bond_descriptors(pos, cell, inv_cell)
+        desc['angle'] = self._get_angle_descriptors(pos, cell, inv_cell)
+        desc['proper'] = self._get_dihedral_descriptors(pos, cell, inv_cell)
+        desc.update(self._get_pair_descriptors(pos, cell))
+        self._add_kspace_descriptors(desc, pos, cell)
+        return desc
+
+    def _get_bond_descriptors(self, pos, cell, inv_cell):
+        (i, j) = self.bonds.T
+        d = mic(pos[i] - pos[j], cell, inv_cell)
+        r = np.linalg.norm(d, axis=1)
+        u = d / r[:, None]
+        grads = np.stack([u, -u], axis=1)
+        wq = np.einsum('ma,mb->mab', d, u)
+        return (r, grads, wq)
+
+    def _get_angle_descriptors(self, pos, cell, inv_cell):
+        (i, j, k) = self.angles.T
+        a = mic(pos[i] - pos[j], cell, inv_cell)
+        b = mic(pos[k] - pos[j], cell, inv_cell)
+        la = np.linalg.norm(a, axis=1)[:, None]
+        lb = np.linalg.norm(b, axis=1)[:, None]
+        c = np.clip(np.sum(a * b, axis=1)[:, None] / (la * lb), -1.0, 1.0)
+        s = np.maximum(np.sqrt(1.0 - c**2), 0.001)
+        theta = np.arccos(c[:, 0])
+        g1 = -(b / (la * lb) - c * a / la**2) / s
+        g3 = -(a / (la * lb) - c * b / lb**2) / s
+        grads = np.stack([g1, -(g1 + g3), g3], axis=1)
+        wq = np.einsum('ma,mb->mab', a, g1) + np.einsum('ma,mb->mab', b, g3)
+        return (theta, grads, wq)
+
+    def _get_dihedral_descriptors(self, pos, cell, inv_cell):
+        (i, j, k, l) = self.diheds.T
+        b1 = mic(pos[j] - pos[i], cell, inv_cell)
+        b2 = mic(pos[k] - pos[j], cell, inv_cell)
+        b3 = mic(pos[l] - pos[k], cell, inv_cell)
+        m = np.cross(b1, b2)
+        n = np.cross(b2, b3)
+        lb2 = np.linalg.norm(b2, axis=1)[:, None]
+        phi = np.arctan2(lb2[:, 0] * np.sum(b1 * n, axis=1), np.sum(m * n, axis=1))
+        g1 = -lb2 * m / np.sum(m * m, axis=1)[:, None]
+        g4 = lb2 * n / np.sum(n * n, axis=1)[:, None]
+        f1 = -np.sum(b1 * b2, axis=1)[:, None] / lb2**2
+        f3 = -np.sum(b3 * b2, axis=1)[:, None] / lb2**2
+        g2 = (f1 - 1) * g1 - f3 * g4
+        g3 = (f3 - 1) * g4 - f1 * g1
+        grads = np.stack([g1, g2, g3, g4], axis=1)
+        wq = np.einsum('ma,mb->mab', b1, g2)
+        wq += np.einsum('ma,mb->mab', b1 + b2, g3)
+        wq += np.einsum('ma,mb->mab', b1 + b2 + b3, g4)
+        return (phi, grads, wq)
+
+    def _get_pair_descriptors(self, pos, cell):
+        """
+        Collect the LJ sums by type pairs and the real space Coulomb sums
+        by charge pairs from a full neighbor list
+        """
+        N, T, C = self.natoms, self.n_types, self.n_charges
+        rc = max(self.cutoff_lj, self.cutoff_coul)
+        (i, j, D, r) = primitive_neighbor_list('ijDd', [True] * 3, cell, pos, rc)
+        d = -D
+
+        # special pairs are only applied to the minimum images
+        levels = np.zeros(len(i), dtype=int)
+        same = self.mols[i] == self.mols[j]
+        half = 0.5 * np.abs(np.diag(cell))
+        same &= np.all(np.abs(d) <= half, axis=1)
+        for m, level in enumerate(self.levels):
+            ids = np.where(same & (self.moltypes[i] == m))[0]
+            levels[ids] = level[self.locs[i[ids]], self.locs[j[ids]]]
+
+        # LJ
+        ids = np.where(r < self.cutoff_lj)[0]
+        w = np.array(SPECIAL_LJ)[levels[ids]]
+        ti, tj = self.types[i[ids]], self.types[j[ids]]
+        r2inv = 1.0 / r[ids] ** 2
+        r6inv = r2inv ** 3
+        dd = np.einsum('ma,mb->mab', d[ids], d[ids])
+        S12, S6 = np.zeros([T, T]), np.zeros([T, T])
+        np.add.at(S12, (ti, tj), 0.5 * w * r6inv**2)
+        np.add.at(S6, (ti, tj), 0.5 * w * r6inv)
+        X12, X6 = np.zeros([N, T, 3]), np.zeros([N, T, 3])
+        np.add.at(X12, (i[ids], tj), (w * r6inv**2 * r2inv)[:, None] * d[ids])
+        np.add.at(X6, (i[ids], tj), (w * r6inv * r2inv)[:, None] * d[ids])
+        V12, V6 = np.zeros([T, T, 3, 3]), np.zeros([T, T, 3, 3])
+        np.add.at(V12, (ti, tj), (0.5 * w * r6inv**2 * r2inv)[:, None, None] * dd)
+        np.add.at(V6, (ti, tj), (0.5 * w * r6inv * r2inv)[:, None, None] * dd)
+
+        # Coulomb in real space
+        ids = np.where(r < self.cutoff_coul)[0]
+        w = np.array(SPECIAL_COUL)[levels[ids]]
+        ci, cj = self.charge_ids[i[ids]], self.charge_ids[j[ids]]
+        g = self.gewald
+        rr = r[ids]
+        e = erfc(g * rr) - (1.0 - w)
+        phi = QQR2E * e / rr
+        psi = QQR2E * (e / rr**3 + 2 * g / np.sqrt(np.pi) * np.exp(-(g * rr)**2) / rr**2)
+        dd = np.einsum('ma,mb->mab', d[ids], d[ids])
+        Aq, Bq = np.zeros([C, C]), np.zeros([N, 3, C])
+        Wq = np.zeros([C, C, 3, 3])
+        np.add.at(Aq, (ci, cj), 0.5 * phi)
+        np.add.at(Bq, (i[ids], slice(None), cj), psi[:, None] * d[ids])
+        np.add.at(Wq, (ci, cj), 0.5 * psi[:, None, None] * dd)
+
+        return {'lj': (S12, S6, X12, X6, V12, V6),
+                'coul': [Aq, Bq, Wq],
+                }
+
+    def _add_kspace_descriptors(self, desc, pos, cell, accuracy=1e-10, chunk=2000):
+        """
+        Add the Ewald reciprocal, self and neutralization energies to the
+        Coulomb quadratic forms
+        """
+        Aq, Bq, Wq = desc['coul']
+        g = self.gewald
+        V = desc['volume']
+        rec = 2 * np.pi * np.linalg.inv(cell).T
+        kcut = 2 * g * np.sqrt(-np.log(accuracy))
+        nmax = [int(np.ceil(kcut * np.linalg.norm(a) / (2 * np.pi))) for a in cell]
+        grid = np.mgrid[0:nmax[0]+1, -nmax[1]:nmax[1]+1, -nmax[2]:nmax[2]+1]
+        hkl = grid.reshape([3, -1]).T
+        # half space
+        mask = (hkl[:, 0] > 0) | ((hkl[:, 0] == 0) & (hkl[:, 1] > 0))
+        mask |= (hkl[:, 0] == 0) & (hkl[:, 1] == 0) & (hkl[:, 2] > 0)
+        kvecs = hkl[mask] @ rec
+        k2 = np.sum(kvecs**2, axis=1)
+        kvecs, k2 = kvecs[k2 < kcut**2], k2[k2 < kcut**2]
+        ak = QQR2E / V * 4 * np.pi / k2 * np.exp(-k2 / (4 * g**2))
+        vterm = -2 * (1 / k2 + 0.25 / g**2)
+
+        onehot = np.zeros([self.natoms, self.n_charges])
+        onehot[np.arange(self.natoms), self.charge_ids] = 1.0
+        for i0 in range(0, len(k2), chunk):
+            k, a, v = kvecs[i0:i0+chunk], ak[i0:i0+chunk], vterm[i0:i0+chunk]
+            eikr = np.exp(1j * pos @ k.T)
+            Z = eikr.T @ onehot
+            Aq += np.real(Z.conj().T @ (a[:, None] * Z))
+            for x in range(3):
+                Bq[:, x, :] += 2 * np.imag((eikr * (a * k[:, x])) @ Z.conj())
+            for (x, y) in [(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)]:
+                t = a * (float(x == y) + v * k[:, x] * k[:, y])
+                tmp = np.real(Z.conj().T @ (t[:, None] * Z))
+                Wq[:, :, x, y] += tmp
+                if x != y:
+                    Wq[:, :, y, x] += tmp
+
+        # self energy and neutralization (no virial, as in lammps)
+        n = self.charge_counts
+        Aq[np.diag_indices(self.n_charges)] -= QQR2E * g / np.sqrt(np.pi) * n
+        Aq -= QQR2E * np.pi / (2 * g**2 * V) * np.outer(n, n)
+
+        # Symmetrize the quadratic forms
+        desc['coul'] = [0.5 * (Aq + Aq.T), Bq, 0.5 * (Wq + Wq.transpose(1, 0, 2, 3))]
+
+    def evaluate(self, desc, parameters, jacobian=True, terms=None):
+        """
+        Evaluate the energy/forces/stress from the descriptors
+
+        Args:
+            desc (dict): descriptors from get_descriptors
+            parameters (array): full FF parameters
+            jacobian (bool): whether or not compute the derivatives
+            terms (list): only the contributions of these FF terms among
+                'bond', 'angle', 'proper', 'vdW' and 'charge', None for all
+
+        Returns:
+            energy (eV), forces (eV/A), stress (eV/A^3, Voigt order),
+            and their derivatives with respect to the parameters in the
+            shape of (P,), (N, 3, P) and (6, P) if jacobian is True
+        """
+        p = np.array(parameters, dtype=float)
+        N, P = self.natoms, self.n_params
+        out = {'energy': 0.0,
+               'forces': np.zeros([N, 3]),
+               'virial': np.zeros([3, 3]),
+               }
+        if jacobian:
+            out['dE'] = np.zeros(P)
+            out['dF'] = np.zeros([P, N, 3])
+            out['dW'] = np.zeros([P, 3, 3])
+
+        for (term, args) in self._get_bonded_terms(desc, p):
+            if terms is None or term in terms:
+                self._add_bonded(out, *args)
+
+        if terms is None or 'vdW' in terms:
+            self._add_lj(out, desc, p, jacobian)
+        if terms is None or 'charge' in terms:
+            self._add_coulomb(out, desc, p, jacobian)
+
+        V = desc['volume']
+        stress = np.array([-out['virial'][x, y] / V for (x, y) in VOIGT])
+        results = [out['energy'] * KCAL2EV, out['forces'] * KCAL2EV, stress * KCAL2EV]
+        if jacobian:
+            dS = np.array([-out['dW'][:, x, y] / V for (x, y) in VOIGT])
+            results.extend([out['dE'] * KCAL2EV,
+                            out['dF'].transpose(1, 2, 0) * KCAL2EV,
+                            dS * KCAL2EV])
+        return results
+
+    def get_linear_ids(self, terms=['bond', 'angle', 'proper']):
+        """
+        Get the ids of the bonded force constants (bond k, angle k and
+        proper phi_k) in the full parameters
+
+        Args:
+            terms (list): bonded terms among 'bond', 'angle' and 'proper'
+        """
+        ids = []
+        for term in terms:
+            if term == 'bond':
+                ids.extend(range(self.base_bond, self.base_angle, 2))
+            elif term == 'angle':
+                ids.extend(range(self.base_angle, self.base_proper, 2))
+            elif term == 'proper':
+                ids.extend(range(self.base_proper, self.base_vdW))
+            else:
+                raise ValueError("Not a linear FF term", term)
+        return np.array(ids, dtype=int)
+
+    def get_linear_design(self, desc, parameters, terms=['bond', 'angle', 'proper']):
+        """
+        Split the energy/forces/stress into the remaining part and the part
+        that is linear in the bonded force constants, e.g.,
+        E = E0 + dE @ parameters[ids], with the equilibrium values fixed.
+
+        Args:
+            desc (dict): descriptors from get_descriptors
+            parameters (array): full FF parameters
+            terms (list): bonded terms among 'bond', 'angle' and 'proper'
+
+        Returns:
+            a dictionary of ids, E0/F0/S0 and the design matrices of
+            dE (L,), dF (N, 3, L) and dS (6, L)
+        """
+        ids = self.get_linear_ids(terms)
+        p = np.array(parameters, dtype=float)
+        p[ids] = 0.0
+        (E0, F0, S0) = self.evaluate(desc, p, jacobian=False)
+
+        N, P = self.natoms, self.n_params
+        out = {'energy': 0.0,
+               'forces': np.zeros([N, 3]),
+               'virial': np.zeros([3, 3]),
+               'dE': np.zeros(P),
+               'dF': np.zeros([P, N, 3]),
+               'dW': np.zeros([P, 3, 3]),
+               }
+        for (term, args) in self._get_bonded_terms(desc, p):
+            if term in terms:
+                # only keep the derivatives over the force constants
+                self._add_bonded(out, *args[:-1], args[-1][:1])
+
+        V = desc['volume']
+        dS = np.array([-out['dW'][ids, x, y] / V for (x, y) in VOIGT])
+        return {'ids': ids,
+                'E0': E0,
+                'F0': F0,
+                'S0': S0,
+                'dE': out['dE'][ids] * KCAL2EV,
+                'dF': out['dF'][ids].transpose(1, 2, 0) * KCAL2EV,
+                'dS': dS * KCAL2EV,
+                }
+
+    def _get_bonded_terms(self, desc, p):
+        """
+        Get the inputs of _add_bonded for the bond, angle and proper terms
+        """
+        (r, grads, wq) = desc['bond']
+        ids = self.bond_ids
+        dr = r - p[ids + 1]
+        k = p[ids]
+        terms = [(ids, dr**2, 2 * dr), (ids + 1, -2 * k * dr, -2 * k)]
+        bond = (self.bonds, grads, wq, k * dr**2, 2 * k * dr, terms)
+
+        (theta, grads, wq) = desc['angle']
+        ids = self.angle_ids
+        deg = np.pi / 180
+        dt = theta - p[ids + 1] * deg
+        k = p[ids]
+        terms = [(ids, dt**2, 2 * dt), (ids + 1, -2 * k * dt * deg, -2 * k * deg)]
+        angle = (self.angles, grads, wq, k * dt**2, 2 * k * dt, terms)
+
+        (phi, grads, wq) = desc['proper']
+        ids = self.dihed_ids
+        n = self.dihed_pers
+        arg = n * phi - self.dihed_phases
+        k = p[ids]
+        terms = [(ids, 1 + np.cos(arg), -n * np.sin(arg))]
+        proper = (self.diheds, grads, wq, k * (1 + np.cos(arg)), -k * n * np.sin(arg), terms)
+
+        return [('bond', bond), ('angle', angle), ('proper', proper)]
+
+    @staticmethod
+    def _add_bonded(out, atoms, grads, wq, eng, fp, terms):
+        """
+        Add the bonded term E = f(q) where q is an internal coordinate
+
+        Args:
+            out (dict): results
+            atoms: (M, n) atomic ids
+            grads: (M, n, 3) dq/dx
+            wq: (M, 3, 3) virial of dq/dx
+            eng: (M,) energies
+            fp: (M,) df/dq
+            terms: list of (param_ids, df/dp, d(df/dq)/dp)
+        """
+        out['energy'] += np.sum(eng)
+        np.add.at(out['forces'], atoms, -fp[:, None, None] * grads)
+        out['virial'] -= np.einsum('m,mab->ab', fp, wq)
+        if 'dE' in out:
+            for (ids, dfdp, dfpdp) in terms:
+                np.add.at(out['dE'], ids, dfdp)
+                np.add.at(out['dF'], (ids[:, None], atoms), -dfpdp[:, None, None] * grads)
+                np.add.at(out['dW'], ids, -dfpdp[:, None, None] * wq)
+
+    def _add_lj(self, out, desc, p, jacobian):
+        """
+        Add the LJ energy with the arithmetic mixing and tail correction
+        """
+        (S12, S6, X12, X6, V12, V6) = desc['lj']
+        V = desc['volume']
+        rc = self.cutoff_lj
+        t = self.types
+        T = self.n_types
+        rmin = p[self.base_vdW:self.base_charge:2]
+        eps = p[self.base_vdW+1:self.base_charge:2]
+        sigma = rmin * 2 ** (5 / 6)
+        sig = 0.5 * (sigma[:, None] + sigma[None, :])
+        epsilon = np.sqrt(eps[:, None] * eps[None, :])
+        A = 4 * epsilon * sig**12
+        B = 4 * epsilon * sig**6
+
+        # tail correction
+        nn = np.outer(self.type_counts, self.type_counts)
+        ea = 2 * np.pi / (9 * rc**9 * V) * nn
+        eb = -3 * rc**6 * ea
+        pa = 8 * np.pi / (9 * rc**9 * V) * nn
+        pb = -3 * rc**6 / 2 * pa
+        eye = np.eye(3)
+
+        out['energy'] += np.sum(A * (S12 + ea) - B * (S6 - eb))
+        out['forces'] += np.einsum('iu,iux->ix', 12 * A[t], X12) - np.einsum('iu,iux->ix', 6 * B[t], X6)
+        out['virial'] += np.einsum('tu,tuab->ab', 12 * A, V12) - np.einsum('tu,tuab->ab', 6 * B, V6)
+        out['virial'] += eye * np.sum(A * pa + B * pb)
+
+        if jacobian:
+            # derivatives of A/B with respect to the mixed epsilon/sigma
+            dA_de, dA_ds = 4 * sig**12, 48 * epsilon * sig**11
+            dB_de, dB_ds = 4 * sig**6, 24 * epsilon * sig**5
+            with np.errstate(divide='ignore', invalid='ignore'):
+                coef = 0.5 * np.sqrt(eps[None, :] / eps[:, None])
+            coef[~np.isfinite(coef)] = 0.0
+            ids_r = self.base_vdW + 2 * np.arange(T)
+            ids_e = ids_r + 1
+            fac = 2 ** (5 / 6)
+
+            def add_type_pairs(dX, gA, gB):
+                """
+                Map the derivatives with respect to the A/B(T, T, ...)
+                matrices to the vdW parameters
+                """
+                ge = gA * dA_de.reshape(dA_de.shape + (1,) * (gA.ndim - 2))
+                ge += gB * dB_de.reshape(dB_de.shape + (1,) * (gB.ndim - 2))
+                gs = gA * dA_ds.reshape(dA_ds.shape + (1,) * (gA.ndim - 2))
+                gs += gB * dB_ds.reshape(dB_ds.shape + (1,) * (gB.ndim - 2))
+                ge = ge + np.swapaxes(ge, 0, 1)
+                gs = gs + np.swapaxes(gs, 0, 1)
+                c = coef.reshape(coef.shape + (1,) * (ge.ndim - 2))
+                dX[ids_e] += np.sum(ge * c, axis=1)
+                dX[ids_r] += 0.5 * fac * np.sum(gs, axis=1)
+
+            add_type_pairs(out['dE'], S12 + ea, -(S6 - eb))
+            gA = 12 * V12 + (pa[:, :, None, None] * eye)
+            gB = -6 * V6 + (pb[:, :, None, None] * eye)
+            add_type_pairs(out['dW'], gA, gB)
+
+            # forces of atom i only depend on the type pairs (t[i], U)
+            gA, gB = 12 * X12, -6 * X6
+            ge = gA * dA_de[t][:, :, None] + gB * dB_de[t][:, :, None]
+            gs = gA * dA_ds[t][:, :, None] + gB * dB_ds[t][:, :, None]
+            atoms = np.arange(self.natoms)
+            np.add.at(out['dF'], (ids_e[t], atoms), np.einsum('iux,iu->ix', ge, coef[t]))
+            np.add.at(out['dF'], (ids_r[t], atoms), 0.5 * fac * np.sum(gs, axis=1))
+            out['dF'][ids_e] += np.einsum('iux,iu->uix', ge, coef.T[t])
+            out['dF'][ids_r] += 0.5 * fac * gs.transpose(1, 0, 2)
+
+    def _add_coulomb(self, out, desc, p, jacobian):
+        """
+        Add the Coulomb energy as quadratic forms of the charges
+        """
+        Aq, Bq, Wq = desc['coul']
+        c0, c1 = self.base_charge, self.base_charge + self.n_charges
+        qp = p[c0:c1]
+        q = qp[self.charge_ids]
+        Bp = Bq @ qp
+        out['energy'] += qp @ Aq @ qp
+        out['forces'] += q[:, None] * Bp
+        out['virial'] += np.einsum('c,cdab,d->ab', qp, Wq, qp)
+
+        if jacobian:
+            out['dE'][c0:c1] += 2 * Aq @ qp
+            out['dW'][c0:c1] += 2 * np.einsum('cdab,d->cab', Wq, qp)
+            atoms = np.arange(self.natoms)
+            np.add.at(out['dF'], (c0 + self.charge_ids, atoms), Bp)
+            out['dF'][c0:c1] += np.einsum('i,ixc->cix', q, Bq)
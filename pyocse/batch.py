@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+Batched evaluation of many structures with the reference calculators.
+
+The ase calculators of MACE and ANI evaluate one structure per call, so
+that most of the time on CPU is spent on the graph construction and the
+model overhead rather than on the model itself. Here, the structures are
+collated into one model call per batch:
+
+    - MACE: the AtomicData of all structures in one torch_geometric batch
+    - ANI: the structures with the same numbers/cell padded into one tensor
+      (energy and forces only, the stress needs one strain per structure)
+    - torch-dftd: its own batch_calculate
+
+A sum of calculators (e.g., mace_mp with dispersion) is evaluated term by
+term, and any other calculator falls back to the usual one by one calls.
+
+For a family of structures derived from the same parent by small
+displacements or strains (e.g., the elastic/vibration samples of one
+minimum), the MACE graphs can be taken from one skin-padded neighbor list
+of the parent instead of being rebuilt for each structure.
+"""
+import numpy as np
+from ase import units
+from ase.neighborlist import primitive_neighbor_list
+from ase.stress import full_3x3_to_voigt_6_stress
+
+
+def get_sub_calculators(calculator):
+    """
+    Split a sum of calculators into the list of (weight, calculator)
+
+    Args:
+        calculator: ase calculator
+    """
+    # ase >= 3.23 keeps the calculators in the mixer
+    mixer = getattr(calculator, 'mixer', calculator)
+    if hasattr(mixer, 'calcs') and hasattr(mixer, 'weights'):
+        return list(zip(mixer.weights, mixer.calcs))
+    return [(1.0, calculator)]
+
+def get_family_neighbors(parent, structures, cutoff, skin):
+    """
+    Get the neighbor lists of the structures derived from the parent from
+    one neighbor list of the parent with the cutoff + skin. Writing each
+    structure as x = x_parent @ F + u, with F the cell deformation, a pair
+    out of the parent list stays beyond the cutoff if
+
+        (cutoff + skin) * min singular value of F - 2 max|u| >= cutoff
+
+    otherwise the neighbor list of the structure has to be rebuilt.
+
+    Args:
+        parent: ase atoms
+        structures (list): ase atoms with the same atoms as the parent
+        cutoff (float): cutoff radius
+        skin (float): padding of the parent list
+
+    Returns:
+        a list of (edge_index (2, E), unit_shifts (E, 3)) as the sender,
+        receiver and shift of each pair, None if it must be rebuilt
+    """
+    i, j, S = primitive_neighbor_list('ijS', parent.pbc, parent.cell.array,
+                                      parent.positions, cutoff + skin)
+    inv_cell = np.linalg.inv(parent.cell.array)
+    neighbors = []
+    for s in structures:
+        if len(s) != len(parent) or (s.numbers != parent.numbers).any():
+            neighbors.append(None)
+            continue
+        F = inv_cell @ s.cell.array
+        u = s.positions - parent.positions @ F
+        s_min = np.linalg.svd(F, compute_uv=False).min()
+        if (cutoff + skin) * s_min - 2 * np.linalg.norm(u, axis=1).max() < cutoff:
+            neighbors.append(None)
+            continue
+        vecs = s.positions[j] - s.positions[i] + S @ s.cell.array
+        mask = np.einsum('ij,ij->i', vecs, vecs) < cutoff ** 2
+        neighbors.append((np.array([i[mask], j[mask]]), S[mask]))
+    return neighbors
+
+def evaluate_batch(structures, calculator, options=[True, True, True], batch_size=32,
+                   parent=None, skin=1.0):
+    """
+    Evaluate the energies, forces and stresses of many structures
+
+    Args:
+        structures (list): ase atoms
+        calculator: ase calculator (MACE, ANI, their sum with D3, or any)
+        options (list): [energy, forces, stress]
+        batch_size (int): maximum number of structures per model call
+        parent: ase atoms from which the structures are derived, if given,
+            the MACE graphs are taken from its skin-padded neighbor list
+        skin (float): padding of the parent neighbor list in Angstrom
+
+    Returns:
+        energies (N), list of forces (natoms, 3) and stresses (N, 6) in
+        eV, eV/A and eV/A^3, or None if not requested
+    """
+    N = len(structures)
+    energies = np.zeros(N)
+    forces = [np.zeros([len(s), 3]) for s in structures]
+    stresses = np.zeros([N, 6])
+
+    for weight, calc in get_sub_calculators(calculator):
+        if hasattr(calc, 'models') and hasattr(calc, 'z_table'):
+            try:
+                results = mace_batch(structures, calc, options[2], batch_size, parent, skin)
+            except (TypeError, KeyError):
+                # the data API of this mace version is not supported
+                results = serial_batch(structures, calc, options)
+        elif hasattr(calc, 'batch_calculate'):
+            results = dftd_batch(structures, calc, options, batch_size)
+        elif hasattr(calc, 'species_to_tensor') and not options[2]:
+            results = ani_batch(structures, calc, batch_size)
+        else:
+            results = serial_batch(structures, calc, options)
+        for i, (eng, force, stress) in enumerate(zip(*results)):
+            energies[i] += weight * eng
+            forces[i] += weight * force
+            if stress is not None:
+                stresses[i] += weight * stress
+
+    return (energies if options[0] else None,
+            forces if options[1] else None,
+            stresses if options[2] else None)
+
+def serial_batch(structures, calculator, options):
+    """
+    Evaluate the structures one by one with a generic ase calculator
+    """
+    engs, forces, stresses = [], [], []
+    for structure in structures:
+        structure = structure.copy()
+        structure.calc = calculator
+        engs.append(structure.get_potential_energy())
+        forces.append(structure.get_forces())
+        stresses.append(structure.get_stress() if options[2] else None)
+    return engs, forces, stresses
+
+def mace_batch(structures, calc, compute_stress, batch_size, parent=None, skin=1.0):
+    """
+    Evaluate the structures in batches with the models of a MACECalculator.
+    If the parent is given, the graphs are copied from the one of the
+    parent with the edges of get_family_neighbors where possible.
+    """
+    import torch
+    from mace import data
+    from mace.tools import torch_geometric, torch_tools
+
+    # the same config as in MACECalculator._atoms_to_batch
+    kwargs = {'z_table': calc.z_table, 'cutoff': calc.r_max}
+    config_kwargs = {}
+    if hasattr(calc, 'available_heads'):
+        # newer mace, the head is given to the config
+        kwargs['heads'] = calc.available_heads
+        arrays_keys = dict(calc.arrays_keys)
+        arrays_keys[calc.charges_key] = 'charges'
+        config_kwargs['key_specification'] = data.KeySpecification(
+            info_keys=calc.info_keys, arrays_keys=arrays_keys)
+        config_kwargs['head_name'] = calc.head
+    else:
+        if hasattr(calc, 'heads'):
+            kwargs['heads'] = calc.heads
+        if hasattr(calc, 'charges_key'):
+            config_kwargs['charges_key'] = calc.charges_key
+
+    def get_data(s):
+        if not hasattr(calc, 'default_dtype'):
+            return data.AtomicData.from_config(data.config_from_atoms(s, **config_kwargs), **kwargs)
+        with torch_tools.default_dtype(calc.default_dtype):
+            return data.AtomicData.from_config(data.config_from_atoms(s, **config_kwargs), **kwargs)
+
+    if parent is None:
+        dataset = [get_data(s) for s in structures]
+    else:
+        neighbors = get_family_neighbors(parent, structures, float(calc.r_max), skin)
+        base = get_data(parent)
+        dtype = base.positions.dtype
+        dataset = []
+        for s, neighbor in zip(structures, neighbors):
+            if neighbor is None:
+                dataset.append(get_data(s))
+            else:
+                edge_index, unit_shifts = neighbor
+                d = base.clone()
+                d.positions = torch.tensor(s.positions, dtype=dtype)
+                d.cell = torch.tensor(s.cell.array, dtype=dtype)
+                d.edge_index = torch.tensor(edge_index, dtype=torch.long)
+                d.unit_shifts = torch.tensor(unit_shifts, dtype=dtype)
+                d.shifts = torch.tensor(unit_shifts @ s.cell.array, dtype=dtype)
+                dataset.append(d)
+    loader = torch_geometric.dataloader.DataLoader(dataset=dataset,
+                                                   batch_size=batch_size,
+                                                   shuffle=False,
+                                                   drop_last=False)
+    e_unit = calc.energy_units_to_eV
+    l_unit = calc.length_units_to_A
+
+    engs, forces, stresses = [], [], []
+    for batch_base in loader:
+        batch_base = batch_base.to(calc.device)
+        n_graphs = batch_base.num_graphs
+        eng = torch.zeros(n_graphs, device=calc.device)
+        force = torch.zeros([batch_base.num_nodes, 3], device=calc.device)
+        stress = torch.zeros([n_graphs, 3, 3], device=calc.device)
+        # average over the committee as in MACECalculator
+        for model in calc.models:
+            batch = batch_base.clone()
+            dtype = next(model.parameters()).dtype
+            for key in batch.keys:
+                if torch.is_tensor(batch[key]) and torch.is_floating_point(batch[key]):
+                    batch[key] = batch[key].to(dtype=dtype)
+            out = model(batch.to_dict(), compute_stress=compute_stress, training=False)
+            eng += out['energy'].detach()
+            force += out['forces'].detach()
+            if compute_stress:
+                stress += out['stress'].detach()
+        nmodels = len(calc.models)
+        eng = eng.cpu().numpy() * e_unit / nmodels
+        force = force.cpu().numpy() * e_unit / l_unit / nmodels
+        stress = stress.cpu().numpy() * e_unit / l_unit ** 3 / nmodels
+        ptr = batch_base.ptr.cpu().numpy()
+        for i in range(n_graphs):
+            engs.append(eng[i])
+            forces.append(force[ptr[i]:ptr[i+1]])
+            stresses.append(full_3x3_to_voigt_6_stress(stress[i]) if compute_stress else None)
+    return engs, forces, stresses
+
+def dftd_batch(structures, calc, options, batch_size):
+    """
+    Evaluate the structures in batches with the batch_calculate of torch-dftd
+    """
+    properties = ['energy', 'forces']
+    if options[2]:
+        properties.append('stress')
+    engs, forces, stresses = [], [], []
+    for i in range(0, len(structures), batch_size):
+        for res in calc.batch_calculate(structures[i:i+batch_size], properties):
+            engs.append(res['energy'])
+            forces.append(res['forces'])
+            stresses.append(res['stress'] if options[2] else None)
+    return engs, forces, stresses
+
+def ani_batch(structures, calc, batch_size):
+    """
+    Evaluate the energies and forces with the model of a torchani
+    calculator. The structures are grouped by the numbers and the cell,
+    as the periodic model takes one cell per call.
+    """
+    import torch
+    from torchani import utils
+
+    groups = {}
+    for i, s in enumerate(structures):
+        key = (s.numbers.tobytes(), np.round(s.cell.array, 8).tobytes(), tuple(s.pbc))
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(i)
+
+    engs = [None] * len(structures)
+    forces = [None] * len(structures)
+    for ids in groups.values():
+        s0 = structures[ids[0]]
+        species = calc.species_to_tensor(s0.get_chemical_symbols()).to(calc.device)
+        pbc = torch.tensor(s0.pbc, dtype=torch.bool, device=calc.device)
+        cell = torch.tensor(s0.cell.array, dtype=calc.dtype, device=calc.device)
+        for i in range(0, len(ids), batch_size):
+            sub = ids[i:i+batch_size]
+            coords = np.array([structures[j].positions for j in sub])
+            coords = torch.tensor(coords, dtype=calc.dtype, device=calc.device)
+            if pbc.any():
+                coords = utils.map2central(cell, coords, pbc)
+            coords.requires_grad_(True)
+            _species = species.unsqueeze(0).expand(len(sub), -1)
+            if pbc.any():
+                energy = calc.model((_species, coords), cell=cell, pbc=pbc).energies
+            else:
+                energy = calc.model((_species, coords)).energies
+            energy = energy * units.Hartree
+            force = -torch.autograd.grad(energy.sum(), coords)[0]
+            energy = energy.detach().cpu().numpy()
+            force = force.cpu().numpy()
+            for k, j in enumerate(sub):
+                engs[j] = energy[k]
+                forces[j] = force[k]
+    return engs, forces, [None] * len(structures)
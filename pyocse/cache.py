@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Storage of the objective values of the FF fitting.
+
+    - ObjectiveCache: the objective values of the visited parameters,
+      keyed by the rounded parameters and the fingerprint of the
+      references, in memory and optionally in a shelve file
+    - checkpoints of the optimizers: the pickled state of optimize_global
+      or the append-only log of the evaluations of optimize_local
+"""
+import os
+import pickle
+import hashlib
+import shelve
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ObjectiveCache:
+    """
+    LRU cache of the objective values, keyed by the hash of the rounded
+    full parameters, e_offset, the objective settings and the fingerprint
+    of the references. If filename is given, all values are also kept in
+    a shelve file, so that a restarted job can reuse them. The fingerprint
+    is computed once at the start of each optimize_* stage, so the
+    references must not be changed in place during a stage.
+
+    Args:
+        maxsize (int): maximum number of values in memory
+        decimals (int): decimals to round the parameters
+        filename (str): path of the shelve file, None for memory only
+    """
+
+    def __init__(self, maxsize=10000, decimals=10, filename=None):
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.values = OrderedDict()
+        self.filename = filename
+        self.disk = shelve.open(filename) if filename is not None else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_fingerprint(self, ref_dics, signature=''):
+        """
+        Get the hash of the references from their structures and values
+        (energy, forces, stress), together with the FF signature
+
+        Args:
+            ref_dics (list): reference dictionaries
+            signature (str): FF setup, see ForceFieldParameters.get_ff_signature
+        """
+        h = hashlib.sha1()
+        h.update(signature.encode())
+        for ref_dic in ref_dics:
+            structure = ref_dic['structure']
+            h.update(np.ascontiguousarray(structure.numbers).tobytes())
+            h.update(np.ascontiguousarray(structure.positions).tobytes())
+            h.update(np.ascontiguousarray(structure.cell.array).tobytes())
+            h.update(repr((ref_dic['energy'], ref_dic['replicate'], ref_dic['options'])).encode())
+            for key in ['forces', 'stress']:
+                if ref_dic.get(key) is not None:
+                    h.update(np.ascontiguousarray(ref_dic[key], dtype=float).tobytes())
+        return h.hexdigest()
+
+    def get_key(self, parameters, e_offset, settings, fingerprint):
+        """
+        Get the hash key of an objective evaluation
+
+        Args:
+            parameters (array): full FF parameters
+            e_offset (float): energy offset
+            settings (tuple): other settings, e.g., (obj, E_only, f_coef, s_coef)
+            fingerprint (str): get_fingerprint of the references
+        """
+        h = hashlib.sha1()
+        h.update(np.round(np.array(parameters, dtype=float), self.decimals).tobytes())
+        h.update(repr((round(float(e_offset), self.decimals), settings)).encode())
+        h.update(fingerprint.encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Get the cached value, None if not found
+        """
+        if key in self.values:
+            self.values.move_to_end(key)
+            self.hits += 1
+            return self.values[key]
+        if self.disk is not None and key in self.disk:
+            value = self.disk[key]
+            self._add(key, value)
+            self.disk_hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Store a new value
+        """
+        self._add(key, value)
+        if self.disk is not None:
+            self.disk[key] = value
+
+    def _add(self, key, value):
+        self.values[key] = value
+        self.values.move_to_end(key)
+        while len(self.values) > self.maxsize:
+            self.values.popitem(last=False)
+
+    def report(self, stage=''):
+        """
+        Print and reset the hit/miss statistics of a stage
+        """
+        total = self.hits + self.disk_hits + self.misses
+        if total > 0:
+            strs = "Objective cache {:s}: {:d} calls, {:d} hits, {:d} disk hits, {:d} misses ({:.1f}% hit)".format(
+                    stage, total, self.hits, self.disk_hits, self.misses,
+                    100 * (self.hits + self.disk_hits) / total)
+            print(strs)
+        if self.disk is not None:
+            self.disk.sync()
+        self.hits = self.disk_hits = self.misses = 0
+
+    def close(self):
+        """
+        Close the shelve file
+        """
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+def save_checkpoint(filename, state):
+    """
+    Write the state of an optimization to a pickle file. The file is
+    replaced atomically, so that a job killed while writing still
+    leaves the previous checkpoint.
+
+    Args:
+        filename (str): path of the checkpoint
+        state (dict): stage, x0 and the stage specific values
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tmp, filename)
+
+def write_log(filename, header, records=[]):
+    """
+    Write a new evaluation log, i.e., the header followed by the pickled
+    records, which are then added with append_log. The file is replaced
+    atomically.
+
+    Args:
+        filename (str): path of the log
+        header (dict): stage, x0 and the stage specific values
+        records (list): records to start with
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(dict(header, log=True), f)
+        for record in records:
+            pickle.dump(record, f)
+    os.replace(tmp, filename)
+
+def append_log(filename, records):
+    """
+    Add the new records at the end of the log of write_log, so that the
+    checkpoints only write the evaluations since the previous one
+    """
+    if len(records) > 0:
+        with open(filename, 'ab') as f:
+            for record in records:
+                pickle.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+def load_checkpoint(filename, stage, x0=None):
+    """
+    Read the checkpoint of an optimization, None if the file does not
+    exist or was written by another stage or from another x0. For a log
+    of write_log, the records are returned as the history of the state,
+    a record cut by a killed job is ignored.
+
+    Args:
+        filename (str): path of the checkpoint
+        stage (str): 'optimize_local' or 'optimize_global'
+        x0 (array): initial x of the optimization, None to skip the check
+    """
+    if filename is None or not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        state = pickle.load(f)
+        if state.get('log', False):
+            history = []
+            while True:
+                try:
+                    history.append(pickle.load(f))
+                except (EOFError, pickle.UnpicklingError):
+                    break
+            state['history'] = history
+    if state['stage'] != stage:
+        print("Ignore the checkpoint of another run", filename)
+        return None
+    if x0 is not None and not is_same_start(state, x0):
+        return None
+    return state
+
+def is_same_start(state, x0):
+    """
+    Check if the checkpoint was written from the same x0
+    """
+    if len(state['x0']) != len(x0) or not np.allclose(state['x0'], x0):
+        print("Ignore the checkpoint of another run")
+        return False
+    return True
@@ -116,6 +116,48 @@ class forcefield:
         atoms.title = '.'.join(self.smiles)
         return atoms
 
+    def update_ase_lammps(self, atoms, numMols):
+        """
+        Copy the current ff parameters of self.molecules to the lammps
+        structure from get_ase_lammps without rebuilding its topology
+
+        Args:
+            atoms: the lammps structure from get_ase_lammps
+            numMols: the list of number of molecules
+        """
+        if len(self.molecules) == 1:
+            sources = [self.molecules[0]]
+        else:
+            sources = []
+            for i, m in enumerate(numMols):
+                sources += [self.molecules[i]] * m
+        mul = len(atoms.atoms) // sum([len(m.atoms) for m in sources])
+        sources *= mul
+
+        ia, ib, ic, id = 0, 0, 0, 0
+        for molecule in sources:
+            for at0 in molecule.atoms:
+                at = atoms.atoms[ia]
+                at.charge = at0.charge
+                at.atom_type.rmin = at0.atom_type.rmin
+                at.atom_type.rmin_14 = at0.atom_type.rmin_14
+                at.atom_type.epsilon = at0.atom_type.epsilon
+                at.atom_type.epsilon_14 = at0.atom_type.epsilon_14
+                ia += 1
+            for bond0 in molecule.bonds:
+                bond_type = atoms.bonds[ib].type
+                bond_type.k = bond0.type.k
+                bond_type.req = bond0.type.req
+                ib += 1
+            for angle0 in molecule.angles:
+                angle_type = atoms.angles[ic].type
+                angle_type.k = angle0.type.k
+                angle_type.theteq = angle0.type.theteq
+                ic += 1
+            for dihedral0 in molecule.dihedrals:
+                atoms.dihedrals[id].type.phi_k = dihedral0.type.phi_k
+                id += 1
+
     def get_lammps_in(self, lmp_dat='lmp.dat'):
         """
         Add the lammps ff information into the give atoms object
@@ -9,11 +9,41 @@ from ase.calculators.lammpslib import LAMMPSlib
 from ase.geometry import wrap_positions
 from ase import units
 
+from pyocse import profiler
 from pyocse.utils import which_lmp
 
 seed = 123456789
 
 
+def get_lammps_instance(base="lmp", nproc=1, lammps_name=None, *args, **kwargs):
+    """
+    Create a PyLammps instance which writes the log to {base}.log
+
+    Args:
+        base: base name of the log file
+        nproc: number of openmp threads
+        lammps_name: suffix of the lammps binary, e.g., 'mpi'
+    """
+    from lammps import PyLammps  # , get_thermo_data
+
+    cmdargs = ["-screen", "none", "-log", f"{base}.log", "-nocite"]
+    if nproc > 1:
+        cmdargs += ["-sf", "omp"]
+    os.environ["OMP_NUM_THREADS"] = str(nproc)
+
+    if lammps_name:
+        binary_name = which_lmp("lmp_" + lammps_name)
+    else:
+        binary_name = which_lmp()
+    #print("binary name: ", binary_name)
+    if binary_name == "lmp":
+        lammps_name = ""
+    else:
+        lammps_name = None
+        # lammps_name = binary_name.split("lmp_")[-1]
+    return PyLammps(name=lammps_name, cmdargs=cmdargs, *args, **kwargs)
+
+
 class LAMMPSCalculatorMixIn:
     def _easy_run(self, n, precmds=None, postcmds=None):
         for cmd in precmds:
@@ -188,22 +218,22 @@ class LAMMPSCalculatorMixIn:
         #self.lmp.run(0)
 
         #self._easy_run(0, precmds, postcmds)
-        #from time import time; t0 = time()
-        self.lmp.run(0)
-        #t1 = time(); print('stress', t1-t0)
-        thermo = self.lmp.last_run[-1]
-        energy = float(thermo.TotEng[-1]) * units.kcal/units.mol
-        stress = np.zeros(6)
-        # traditional Voigt order (xx, yy, zz, yz, xz, xy)
-        stress_vars = ['pxx', 'pyy', 'pzz', 'pyz', 'pxz', 'pxy']
-        for i, var in enumerate(stress_vars):
-            stress[i] = self.lmp.variables[var].value
-        #t1 = time(); print('stress', t1-t0)
-
-        fx = np.frombuffer(self.lmp.variables['fx'].value)
-        fy = np.frombuffer(self.lmp.variables['fy'].value)
-        fz = np.frombuffer(self.lmp.variables['fz'].value)
-        #t2 = time(); print('forces', t2-t1)
+        # PyLammps.run redirects the stdout of the whole process to capture
+        # the thermo output, which is not safe with several instances in
+        # threads, so the energy is read from the library instead
+        with profiler.timer('run0'):
+            self.lmp.command("run 0")
+        with profiler.timer('extract'):
+            energy = self.lmp.lmp.get_thermo("etotal") * units.kcal/units.mol
+            stress = np.zeros(6)
+            # traditional Voigt order (xx, yy, zz, yz, xz, xy)
+            stress_vars = ['pxx', 'pyy', 'pzz', 'pyz', 'pxz', 'pxy']
+            for i, var in enumerate(stress_vars):
+                stress[i] = self.lmp.variables[var].value
+
+            fx = np.frombuffer(self.lmp.variables['fx'].value)
+            fy = np.frombuffer(self.lmp.variables['fy'].value)
+            fz = np.frombuffer(self.lmp.variables['fz'].value)
 
         stress = -stress * 101325 * units.Pascal
         forces = np.vstack((fx, fy, fz)).T * units.kcal/units.mol
@@ -596,48 +626,32 @@ class LAMMPSCalculator(LAMMPSCalculatorMixIn):
 
         self.struc = struc
         self.base = base
-        cmdargs = ["-screen", "none", "-log", f"{base}.log", "-nocite"]
         self.lin = f"{base}.in"
         self.ldat = f"{base}.dat"
         self.dumpdir = dumpdir
         self.coulcut = coulcut
 
         self.nproc = nproc
-        if self.nproc > 1:
-            cmdargs += ["-sf", "omp"]
-        os.environ["OMP_NUM_THREADS"] = str(nproc)
 
         # Set up the lammps instance
-        if lmp_instance is not None:
-            self.lmp = lmp_instance
-            self.lmp.command('clear')
-        else:
-            from lammps import PyLammps  # , get_thermo_data
-            if lammps_name:
-                binary_name = which_lmp("lmp_" + lammps_name)
-            else:
-                binary_name = which_lmp()
-            #print("binary name: ", binary_name)
-            if binary_name == "lmp":
-                lammps_name = ""
+        with profiler.timer('lmp_init'):
+            if lmp_instance is not None:
+                self.lmp = lmp_instance
+                self.lmp.command('clear')
             else:
-                lammps_name = None
-                # lammps_name = binary_name.split("lmp_")[-1]
-            self.lmp = PyLammps(name=lammps_name, cmdargs=cmdargs, *args, **lwargs)
+                self.lmp = get_lammps_instance(base, nproc, lammps_name, *args, **lwargs)
 
-        #from time import time; t0 = time()
         if lmp_in is None:
             struc.write_lammps(fin=self.lin, fdat=self.ldat, lmp_dat=lmp_dat)
         else:
             struc.write_lammps(fin=self.lin, fdat=self.ldat, fin_template=lmp_in, lmp_dat=lmp_dat)
 
-        #t1=time(); print("lmp_instance", t1-t0)
         self.restart = False
-        self.initialize()
+        with profiler.timer('lmp_init'):
+            self.initialize()
         if not skip_dump:
             if not os.path.exists(dumpdir): os.mkdir(dumpdir)
             self.compute_and_dump_settings()
-        #t2=time(); print("lmp_initialize", t2-t1)
 
     def initialize(self):
         #lines = open(self.lin).readlines()
@@ -648,6 +662,82 @@ class LAMMPSCalculator(LAMMPSCalculatorMixIn):
         #    self.lmp.command(line)
         self.lmp.file(self.lin)
 
+    def update(self, struc=None, coefficients=True):
+        """
+        Update the loaded lammps instance in place from struc without
+        rewriting the lmp.in/lmp.dat files. The topology must be the
+        same as the one used to initialize the calculator.
+
+        Args:
+            struc: LAMMPSStructure with the new box/coordinates/parameters
+            coefficients (bool): whether or not to reset the coefficients
+        """
+        if struc is not None:
+            self.struc = struc
+        with profiler.timer('lmp_update'):
+            if coefficients:
+                charges = [a.charge for a in self.struc.atoms]
+                self.set_coefficients(self.struc.get_coeff_commands(), charges)
+            self.set_box(self.struc)
+            self.set_positions(self.struc.coordinates)
+            # the thermo output is only refreshed on a new timestep
+            step = self.lmp.lmp.extract_global("ntimestep")
+            self.lmp.command("reset_timestep {:d}".format(step + 1))
+
+    def set_coefficients(self, cmds, charges=None):
+        """
+        Reset the FF coefficients and the atomic charges
+
+        Args:
+            cmds: list of *_coeff commands
+            charges: per-atom charges in the order of atom ids
+        """
+        for cmd in cmds:
+            self.lmp.command(cmd)
+        if charges is not None:
+            charges = np.array(charges, dtype=float)
+            c_double_array = ctypes.c_double * len(charges)
+            self.lmp.lmp.scatter_atoms("q", 1, 1, c_double_array(*charges))
+
+    def set_box(self, struc):
+        """
+        Reset the simulation box from struc.box and update the kspace mesh
+
+        Args:
+            struc: LAMMPSStructure
+        """
+        xhi, yhi, zhi, xy, xz, yz = struc._get_box_bounds()
+        # same precision as in _write_dat_box
+        lengths = np.round([xhi, yhi, zhi], 4)
+        boxlo, boxhi = self.lmp.lmp.extract_box()[:2]
+        lengths0 = np.array(boxhi) - np.array(boxlo)
+        # the skew is checked after each keyword of change_box, so that
+        # the lengths are only reduced after the new tilts are set, e.g.,
+        # for a compressed triclinic cell: grow -> tilts -> shrink
+        cmd = "change_box all x final 0.0 {:.4f} y final 0.0 {:.4f} z final 0.0 {:.4f} units box"
+        larger = np.maximum(lengths, lengths0)
+        shifted = np.any(np.array(boxlo) != 0)
+        if (larger > lengths0).any() or shifted:
+            self.lmp.command(cmd.format(*larger))
+        self.lmp.command("change_box all xy final {:.4f} xz final {:.4f} yz final {:.4f} units box".format(xy, xz, yz))
+        if (larger > lengths).any():
+            self.lmp.command(cmd.format(*lengths))
+        if not getattr(struc, 'coulcut', False):
+            [x, y, z] = struc.fftgrid()
+            self.lmp.command("kspace_modify gewald {:f} mesh {:d} {:d} {:d} order 6".format(struc.gewald(), x, y, z))
+
+    def set_positions(self, positions):
+        """
+        Scatter the atomic positions to lammps through the library API
+
+        Args:
+            positions: (N, 3) array in the order of atom ids
+        """
+        pos = np.array(positions, dtype=float).ravel()
+        c_double_array = ctypes.c_double * len(pos)
+        self.lmp.command("set atom * image 0 0 0")
+        self.lmp.lmp.scatter_atoms("x", 1, 3, c_double_array(*pos))
+
     def compute_and_dump_settings(self, thermo=500, dump=1000):
         """
         compute and dump settings
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
 from io import StringIO
+from itertools import chain
 
 import numpy as np
 from parmed.topologyobjects import DihedralTypeList
 
+from pyocse import profiler
 from pyocse.interfaces.parmed import ParmEdStructure
 
 
@@ -70,6 +72,17 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
             self._atomtypes_with_resname = ps.atom_types
         return self._atomtypes_with_resname
 
+    @property
+    def atomtype_ids(self):
+        """
+        1-based lammps type ids by resname + atom type. Unlike the
+        parameters, they do not change after the structure is built.
+        """
+        if not hasattr(self, "_atomtype_ids"):
+            keys = self.atomtypes_with_resname.keys()
+            self._atomtype_ids = {k: i for i, k in enumerate(keys, 1)}
+        return self._atomtype_ids
+
     def set_charmm_style_lj(self):
         self.ljmode = "charmmfsw"
 
@@ -135,16 +148,20 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
                                 fftz=fftz)
         return in_str
 
-    def _update_input(self, fin, lines):
+    def _update_input(self, fin, lines, fdat=None):
         """
         Write LMP input files
 
         Args:
             fin: input file
+            lines: lines of the input template
+            fdat: lammps dat file path to replace the one in the template
         """
         with open(fin, 'w') as of:
             for i, line in enumerate(lines):
-                if i + 1 == len(lines):
+                if fdat is not None and line.startswith('read_data'):
+                    of.write('read_data {:s}\n'.format(fdat))
+                elif i + 1 == len(lines):
                     [x, y, z] = self.fftgrid()
                     #print('update', len(dir(self)))
                     if not hasattr(self, 'coulcut') or (hasattr(self, 'coulcut') and not self.coulcut):
@@ -185,25 +202,7 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
 
         if self.box is not None:
             xlo = ylo = zlo = 0.0
-            a = self.box[0]
-            b = self.box[1]
-            c = self.box[2]
-            alp = np.radians(self.box[3])
-            bet = np.radians(self.box[4])
-            gam = np.radians(self.box[5])
-            xhi = a
-            xy = b * np.cos(gam)
-            xz = c * np.cos(bet)
-            yhi = (b**2 - xy**2) ** 0.5
-            yz = (b * c * np.cos(alp) - xy * xz) / yhi
-            zhi = (c**2 - xz**2 - yz**2) ** 0.5
-            if c**2 - xz**2 - yz**2 < 0:
-                print(
-                    "bad lattice angle condition: alpha, beta, gamma = {}, {}, {}".format(
-                        alp, bet, gam
-                    )
-                )
-                raise
+            xhi, yhi, zhi, xy, xz, yz = self._get_box_bounds()
             #of.write("%9.4f %9.4f xlo xhi\n" % (xlo - padding[0], xhi + padding[0]))
             #of.write("%9.4f %9.4f ylo yhi\n" % (ylo - padding[1], yhi + padding[1]))
             #of.write("%9.4f %9.4f zlo zhi\n" % (zlo - padding[2], zhi + padding[0]))
@@ -240,6 +239,34 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
 
         return box_str
 
+    def _get_box_bounds(self):
+        """
+        Convert the cell parameters to the lammps triclinic box
+
+        Returns:
+            xhi, yhi, zhi, xy, xz, yz (with xlo = ylo = zlo = 0)
+        """
+        a = self.box[0]
+        b = self.box[1]
+        c = self.box[2]
+        alp = np.radians(self.box[3])
+        bet = np.radians(self.box[4])
+        gam = np.radians(self.box[5])
+        xhi = a
+        xy = b * np.cos(gam)
+        xz = c * np.cos(bet)
+        yhi = (b**2 - xy**2) ** 0.5
+        yz = (b * c * np.cos(alp) - xy * xz) / yhi
+        zhi = (c**2 - xz**2 - yz**2) ** 0.5
+        if c**2 - xz**2 - yz**2 < 0:
+            print(
+                "bad lattice angle condition: alpha, beta, gamma = {}, {}, {}".format(
+                    alp, bet, gam
+                )
+            )
+            raise
+        return xhi, yhi, zhi, xy, xz, yz
+
     def _write_dat_parameters(self):
 
         # write parameters
@@ -250,25 +277,28 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
 
         if len(self.bond_types) > 0:
             prm_str += "Bond Coeffs\n\n"
+            bond_tags = self._get_tags_index(self.bonds)
             for i, t in enumerate(self.bond_types, 1):
-                tags = self._get_tags(t, self.bonds)
+                tags = bond_tags.get(t, "")
                 if len(tags) > 20:
                     tags = tags[:20]
                 prm_str += "%d harmonic %11.7f %11.7f #%s\n" % (i, t.k, t.req, tags)
             prm_str += "\n"
         if len(self.angle_types) > 0:
             prm_str += "Angle Coeffs\n\n"
+            angle_tags = self._get_tags_index(self.angles)
             for i, t in enumerate(self.angle_types, 1):
-                tags = self._get_tags(t, self.angles)
+                tags = angle_tags.get(t, "")
                 if len(tags) > 20:
                     tags = tags[:20]
                 prm_str += "%d harmonic %11.7f %11.7f #%s\n" % (i, t.k, t.theteq, tags)
             prm_str += "\n"
         if len(self.dihedral_types) > 0:
             prm_str += "Dihedral Coeffs\n\n"
+            dihedral_tags = self._get_tags_index(self.dihedrals)
             if self._dihedralstyle == "fourier":
                 for i, ts in enumerate(self.dihedral_types, 1):
-                    tags = self._get_tags(ts, self.dihedrals)
+                    tags = dihedral_tags.get(ts, "")
                     if len(tags) > 20:
                         tags = tags[:20]
                     string = "%d fourier %d" % (i, len(ts))
@@ -277,7 +307,7 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
                     prm_str += string + "\n"
             else:
                 for i, t in enumerate(self.dihedral_types, 1):
-                    tags = self._get_tags(t, self.dihedrals)
+                    tags = dihedral_tags.get(t, "")
                     if len(tags) > 20:
                         tags = tags[:20]
                     prm_str += "%d charmm %f %d %d 0.0 #%s\n" % (i, t.phi_k, t.per, int(t.phase), tags)
@@ -285,32 +315,43 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
             prm_str += "\n"
         return prm_str
 
+    @staticmethod
+    def _format_rows(fmt, nrows, values):
+        """
+        Format a table with one bulk string formatting
+
+        Args:
+            fmt (str): format string of each row
+            nrows (int): number of rows
+            values: flat sequence of the table values row by row
+        """
+        return (fmt * nrows) % tuple(values)
+
     def _write_dat_atoms(self, velocity=False):
         # write atoms
         # avoid zero-charge-system error using ewald
-        flag = True
-        for a in self.atoms:
-            if a.charge != 0.0:
-                flag = False
-                break
-        if flag:
+        charges = [a.charge for a in self.atoms]
+        if not any(charges):
             self.atoms[0].charge = 0.00000001
             if len(self.atoms) > 1:
                 self.atoms[1].charge = -0.00000001
+            charges = [a.charge for a in self.atoms]
 
         atom_str = "Atoms\n\n"
-        ks = list(self.atomtypes_with_resname.keys())
-        for i, (a, r) in enumerate(zip(self.atoms, self.coordinates), 1):
-            name = a.residue.name + a.type
-            tid = ks.index(name) + 1
-            imol = a.residue.number + 1
-            #atom_str += "%6d %6d %6d %13.8f %11.7f %11.7f %11.7f #%s:%s\n" % (i, imol, tid, a.charge, *r, a.residue.name, a.type)
-            atom_str += "%6d %6d %6d %13.8f %11.7f %11.7f %11.7f\n" % (i, imol, tid, a.charge, *r)
+        ks = self.atomtype_ids
+        natoms = len(self.atoms)
+        ids = range(1, natoms + 1)
+        tids = [ks[a.residue.name + a.type] for a in self.atoms]
+        imols = [a.residue.number + 1 for a in self.atoms]
+        xyz = np.array(self.coordinates)[:natoms].tolist()
+        fmt = "%6d %6d %6d %13.8f %11.7f %11.7f %11.7f\n"
+        values = chain.from_iterable(zip(ids, imols, tids, charges, *zip(*xyz)))
+        atom_str += self._format_rows(fmt, natoms, values)
         atom_str += '\n'
         if velocity:
             atom_str += "Velocities\n\n"
-            for i in range(len(self.atoms)):
-                atom_str += "%6d %11.7f %11.7f %11.7f\n" % (i + 1, 0.0, 0.0, 0.0)
+            values = chain.from_iterable((i, 0.0, 0.0, 0.0) for i in ids)
+            atom_str += self._format_rows("%6d %11.7f %11.7f %11.7f\n", natoms, values)
             atom_str += "\n"
         return atom_str
 
@@ -403,32 +444,63 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
         of.write(string)
 
     @staticmethod
-    def _get_tags(ttype, target):
+    def _get_tags_index(target):
+        """
+        Collect the tags of all types in the target props with one pass
+
+        Args:
+            target: list of bonds/angles/dihedrals
+
+        Returns:
+            a dictionary of {type: tags}
+        """
         tags = {}
-        resname = None
         for prop in target:
-            tmp = []
-            if prop.type == ttype:
-                resname = prop.atom1.residue.name
-                assert resname == prop.atom2.residue.name
-                tmp += [prop.atom1.type]
-                tmp += [prop.atom2.type]
-                if hasattr(prop, "atom3"):
-                    assert resname == prop.atom3.residue.name
-                    tmp += [prop.atom3.type]
-                if hasattr(prop, "atom4"):
-                    assert resname == prop.atom4.residue.name
-                    tmp += [prop.atom4.type]
-                tag = "-".join(tmp)
-                if resname not in tags:
-                    tags[resname] = [tag]
-                elif tag not in tags[resname]:
-                    tags[resname] += [tag]
+            resname = prop.atom1.residue.name
+            assert resname == prop.atom2.residue.name
+            tmp = [prop.atom1.type, prop.atom2.type]
+            if hasattr(prop, "atom3"):
+                assert resname == prop.atom3.residue.name
+                tmp += [prop.atom3.type]
+            if hasattr(prop, "atom4"):
+                assert resname == prop.atom4.residue.name
+                tmp += [prop.atom4.type]
+            tag = "-".join(tmp)
+            # dicts are used as ordered sets
+            res_tags = tags.setdefault(prop.type, {})
+            res_tags.setdefault(resname, {})[tag] = None
+
+        ret = {}
+        for ttype, res_tags in tags.items():
+            ret[ttype] = ",".join([resname + "(" + ",".join(tag) + ")"
+                                   for resname, tag in res_tags.items()])
+        return ret
 
-        ret = []
-        for resname, tag in tags.items():
-            ret.append(resname + "(" + ",".join(tag) + ")")
-        return ",".join(ret)
+    @staticmethod
+    def _get_tags(ttype, target):
+        return LAMMPSStructure._get_tags_index(target).get(ttype, "")
+
+    @staticmethod
+    def _get_master_index(master_props):
+        """
+        Hash index from (type, atom types) to the type of the master props.
+        The last match wins, as in a linear search over the master props.
+
+        Args:
+            master_props: list of bonds/angles/dihedrals
+
+        Returns:
+            a dictionary of {(type, atom types): type}
+        """
+        index = {}
+        for prop in master_props:
+            key = [prop.type, prop.atom1.type, prop.atom2.type]
+            if hasattr(prop, "atom3"):
+                key.append(prop.atom3.type)
+            if hasattr(prop, "atom4"):
+                key.append(prop.atom4.type)
+            index[tuple(key)] = prop.type
+        return index
 
     def _write_dat_connects(self, only_unique_residue=False, master_props=None):
         if only_unique_residue:
@@ -439,94 +511,76 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
 
         if master_props:
             master_bonds, master_angles, master_dihedrals = master_props
+            bond_index = self._get_master_index(master_bonds)
+            angle_index = self._get_master_index(master_angles)
+            dihedral_index = self._get_master_index(master_dihedrals)
 
         def check_unique_residue(residue):
             return noskip or residue.number in resorgs.keys()
 
+        # collect the flat rows of (id, tid, atom ids, resname, atom types)
+        aids = {id(atom): i for i, atom in enumerate(self.atoms, 1)}
+        bonds = []
         nbonds = 0
+        for b in self.bonds:
+            if check_unique_residue(b.atom1.residue):
+                tid = b.type.idx + 1
+                if master_props:
+                    key = (b.type, b.atom1.type, b.atom2.type)
+                    if key in bond_index:
+                        tid = bond_index[key].idx + 1
+                nbonds += 1
+                bonds.extend((nbonds, tid, aids[id(b.atom1)], aids[id(b.atom2)],
+                              b.atom1.residue.name, b.atom1.type, b.atom2.type))
+
+        angles = []
         nangles = 0
+        for a in self.angles:
+            if check_unique_residue(a.atom1.residue):
+                tid = a.type.idx + 1
+                if master_props:
+                    key = (a.type, a.atom1.type, a.atom2.type, a.atom3.type)
+                    if key in angle_index:
+                        tid = angle_index[key].idx + 1
+                nangles += 1
+                angles.extend((nangles, tid, aids[id(a.atom1)], aids[id(a.atom2)],
+                               aids[id(a.atom3)], a.atom1.residue.name, a.atom1.type,
+                               a.atom2.type, a.atom3.type))
+
+        diheds = []
         ndiheds = 0
+        for d in self.dihedrals:
+            dtype = d.type
+            if master_props:
+                key = (d.type, d.atom1.type, d.atom2.type, d.atom3.type, d.atom4.type)
+                dtype = dihedral_index.get(key, dtype)
+            if type(dtype) == DihedralTypeList:
+                dtype = dtype[0]
+
+            if check_unique_residue(d.atom1.residue):
+                if self._dihedralstyle == "fourier":
+                    tid = ndiheds + 1
+                else:
+                    tid = dtype.idx + 1
+                ndiheds += 1
+                diheds.extend((ndiheds, tid, aids[id(d.atom1)], aids[id(d.atom2)],
+                               aids[id(d.atom3)], aids[id(d.atom4)], d.atom1.residue.name,
+                               d.atom1.type, d.atom2.type, d.atom3.type, d.atom4.type))
+
         connect_str = ''
         if len(self.bonds) > 0:
             connect_str += "Bonds\n\n"
-            for b in self.bonds:
-                if check_unique_residue(b.atom1.residue):
-                    tid = b.type.idx + 1
-                    if master_props:
-                        for mb in master_bonds:
-                            if (
-                                b.type == mb.type
-                                and b.atom1.type == mb.atom1.type
-                                and b.atom2.type == mb.atom2.type
-                            ):
-                                tid = mb.type.idx + 1
-                    b0 = b.atom1.idx + 1
-                    b1 = b.atom2.idx + 1
-                    b2 = b.atom1.residue.name
-                    b3 = b.atom1.type
-                    b4 = b.atom2.type
-                    connect_str += "%6d %6d %6d %6d #%s:%s-%s\n" % (nbonds + 1, tid, b0, b1, b2, b3, b4)
-
-                    nbonds += 1
+            connect_str += self._format_rows("%6d %6d %6d %6d #%s:%s-%s\n", nbonds, bonds)
             connect_str += "\n"
         if len(self.angles) > 0:
             connect_str += "Angles\n\n"
-            for a in self.angles:
-                if check_unique_residue(a.atom1.residue):
-                    tid = a.type.idx + 1
-                    if master_props:
-                        for ma in master_angles:
-                            if (
-                                a.type == ma.type
-                                and a.atom1.type == ma.atom1.type
-                                and a.atom2.type == ma.atom2.type
-                                and a.atom3.type == ma.atom3.type
-                            ):
-                                tid = ma.type.idx + 1
-                    a0 = a.atom1.idx + 1
-                    a1 = a.atom2.idx + 1
-                    a2 = a.atom3.idx + 1
-                    a3 = a.atom1.residue.name
-                    a4 = a.atom1.type
-                    a5 = a.atom2.type
-                    a6 = a.atom3.type
-                    connect_str += "%6d %6d %6d %6d %6d #%s:%s-%s-%s\n" % (nangles + 1, tid, a0, a1, a2, a3, a4, a5, a6)
-                    nangles += 1
-
+            fmt = "%6d %6d %6d %6d %6d #%s:%s-%s-%s\n"
+            connect_str += self._format_rows(fmt, nangles, angles)
             connect_str += "\n"
         if len(self.dihedrals) > 0:
             connect_str += "Dihedrals\n\n"
-            for d in self.dihedrals:
-                dtype = d.type
-                if master_props:
-                    for md in master_dihedrals:
-                        if (
-                            d.type == md.type
-                            and d.atom1.type == md.atom1.type
-                            and d.atom2.type == md.atom2.type
-                            and d.atom3.type == md.atom3.type
-                            and d.atom4.type == md.atom4.type
-                        ):
-                            dtype = md.type
-                if type(dtype) == DihedralTypeList:
-                    dtype = dtype[0]
-
-                if check_unique_residue(d.atom1.residue):
-                    if self._dihedralstyle == "fourier":
-                        tid = ndiheds + 1
-                    else:
-                        tid = dtype.idx + 1
-                    d0 = d.atom1.idx + 1
-                    d1 = d.atom2.idx + 1
-                    d2 = d.atom3.idx + 1
-                    d3 = d.atom4.idx + 1
-                    d4 = d.atom1.residue.name
-                    d5 = d.atom1.type
-                    d6 = d.atom2.type
-                    d7 = d.atom3.type
-                    d8 = d.atom4.type
-                    connect_str += "%6d %6d %6d %6d %6d %6d #%s:%s-%s-%s-%s\n" % (ndiheds + 1, tid, d0, d1, d2, d3, d4, d5, d6, d7, d8)
-                    ndiheds += 1
+            fmt = "%6d %6d %6d %6d %6d %6d #%s:%s-%s-%s-%s\n"
+            connect_str += self._format_rows(fmt, ndiheds, diheds)
         return connect_str, nbonds, nangles, ndiheds
 
     def write_lammps(self, fin="lmp.in", fdat="lmp.dat",
@@ -536,19 +590,18 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
         if not hasattr(self, "pbc"):
             self.set_pbc()
 
-        #from time import time; t0 = time()
-        if fin_template is None:
-            in_str = self._write_input(fdat)
-            with open(fin, "w") as of:
-                of.write(in_str)
-        else:
-            lines = fin_template.split('\n')
-            self._update_input(fin, lines)
+        with profiler.timer('write_input'):
+            if fin_template is None:
+                in_str = self._write_input(fdat)
+                with open(fin, "w") as of:
+                    of.write(in_str)
+            else:
+                lines = fin_template.split('\n')
+                self._update_input(fin, lines, fdat)
 
-        #t1 = time(); print('lmp.in', t1-t0)
-        with open(fdat, "w") as of:
-            self._write_data(of, lmp_dat, orthogonality, padding)
-        #t2 = time(); print('lmp.dat', t2-t1)
+        with profiler.timer('write_data'):
+            with open(fdat, "w") as of:
+                self._write_data(of, lmp_dat, orthogonality, padding)
 
     def _get_create_box_command(self):
         ns = [
@@ -569,31 +622,38 @@ kspace_modify gewald {gewald:} mesh {fftx:} {ffty:} {fftz:} order 6
         return create_box_command
 
     def _get_coeff_commands(self):
-        of = StringIO()
+        """
+        Get the mass commands followed by the ones of get_coeff_commands
+        """
+        cmds = []
         for i, (_k, t) in enumerate(self.atomtypes_with_resname.items(), 1):
-            of.write("mass %d %11.7f #%s\n" % (i, t.mass, t.name))
+            cmds.append("mass %d %11.7f #%s" % (i, t.mass, t.name))
+        return cmds + self.get_coeff_commands()
+
+    def get_coeff_commands(self):
+        """
+        Get the lammps commands to reset the pair/bond/angle/dihedral
+        coefficients of a loaded topology. The values are formatted in
+        the same way as in the lmp.in/lmp.dat files.
+        """
+        cmds = []
         for i, (_k, t) in enumerate(self.atomtypes_with_resname.items(), 1):
-            fact = 1.0
-            line = "pair_coeff {0:d} {0:d} {1:11.7f} {2:11.7f}\n".format(
-                i, fact * t.epsilon, t.sigma
-            )
-            of.write(line)
+            cmds.append("pair_coeff {0:d} {0:d} {1:11.7f} {2:11.7f}".format(
+                i, t.epsilon, t.sigma))
         for i, t in enumerate(self.bond_types, 1):
-            line = "bond_coeff {0:d} harmonic {1:11.7f} {2:11.7f}\n".format(
-                i, t.k, t.req
-            )
-            of.write(line)
+            cmds.append("bond_coeff %d harmonic %11.7f %11.7f" % (i, t.k, t.req))
         for i, t in enumerate(self.angle_types, 1):
-            line = "angle_coeff {0:d} harmonic {1:11.7f} {2:11.7f}\n".format(
-                i, t.k, t.theteq
-            )
-            of.write(line)
-        for i, t in enumerate(self.dihedral_types, 1):
-            line = "dihedral_coeff {0:d} charmm {1:11.7f} {2:d} {3:d} 0.0\n".format(
-                i, t.phi_k, t.per, int(t.phase)
-            )
-            of.write(line)
-        return of.getvalue().split("\n")
+            cmds.append("angle_coeff %d harmonic %11.7f %11.7f" % (i, t.k, t.theteq))
+        if self._dihedralstyle == "fourier":
+            for i, ts in enumerate(self.dihedral_types, 1):
+                cmd = "dihedral_coeff %d fourier %d" % (i, len(ts))
+                for t in ts:
+                    cmd += " %f %d %f" % (t.phi_k, t.per, t.phase)
+                cmds.append(cmd)
+        else:
+            for i, t in enumerate(self.dihedral_types, 1):
+                cmds.append("dihedral_coeff %d charmm %f %d %d 0.0" % (i, t.phi_k, t.per, int(t.phase)))
+        return cmds
 
     def _get_molecules(self):
         ret = []
@@ -2,15 +2,22 @@ import xml.etree.ElementTree as ET
 from xml.dom import minidom
 import ast
 import os, time
-from copy import deepcopy
-from concurrent.futures import ProcessPoolExecutor
+import struct
+import zipfile
+from copy import copy, deepcopy
+from concurrent.futures import Future
+import multiprocessing as mp
+from multiprocessing.connection import wait
 
 import numpy as np
-from scipy.optimize import minimize
+from scipy.optimize import minimize, lsq_linear, differential_evolution
 from math import ceil
 import matplotlib.pyplot as plt
 
 from ase import Atoms
+from ase.db import connect
+from ase.utils import Lock
+from ase.calculators.singlepoint import SinglePointCalculator
 from ase.optimize.fire import FIRE
 from ase.constraints import UnitCellFilter, FixSymmetry
 
@@ -18,15 +25,20 @@ from pyxtal import pyxtal
 from pyxtal.util import ase2pymatgen
 from pymatgen.core import Structure
 
+from pyocse import profiler
 from pyocse.utils import reset_lammps_cell
 from pyocse.forcefield import forcefield
 from pyocse.lmp import LAMMPSCalculator
+from pyocse.analytic import AnalyticFF
+from pyocse.batch import evaluate_batch
+from pyocse.pool import schedule_tasks, FFWorkerPool, multistart_worker
+from pyocse.cache import (ObjectiveCache, save_checkpoint, write_log, append_log,
+                          load_checkpoint, is_same_start)
 from pyocse.interfaces.parmed import ParmEdStructure
 from pyocse.charmm import CHARMMStructure
 
 from lammps import PyLammps  # , get_thermo_data
 
-#import multiprocessing as mp
 
 def timeit(method):
     def timed(*args, **kw):
@@ -66,48 +78,391 @@ def array_to_string(arr):
             lines.append(line_segment)
     return '\n' + '\n'.join(lines) + '\n'
 
+def parse_xml_structure(item, keys=None):
+    """
+    Convert one <structure> element to the dictionary
+
+    Args:
+        item: xml element of the structure
+        keys (list): tags to convert, None for all
+
+    Returns:
+        the dictionary of the structure
+    """
+    item_dict = {}
+    for child in item:
+        key = child.tag
+        if keys is not None and key not in keys:
+            continue
+        text = child.text.strip()
+        # Check if the field should be converted back to an array
+        if key in ['lattice', 'position', 'forces', 'numbers', 'stress',
+                   'bond', 'angle', 'proper', 'vdW', 'charge', 'offset',
+                   'rmse_values', 'r2_values', 'numMols']:
+
+            if text != 'None':
+                value = string_to_array(text)
+            else:
+                value = None
+        elif key in ['options', 'runtime']:
+            value = ast.literal_eval(text) #print(value)
+        else:
+            # Attempt to convert numeric values back to float/int
+            try:
+                value = float(text)
+                if value.is_integer():
+                    value = int(value)
+            except ValueError:
+                if text == 'None':
+                    value = None
+                else:
+                    value = text
+
+        item_dict[key] = value
+    return item_dict
+
+def iter_xml(filename, keys=None):
+    """
+    Iterate over the structures of a xml file without building the whole
+    tree. Each <structure> element is released after it is converted, so
+    the memory does not grow with the file size.
+
+    Args:
+        filename (str): path of the xml file
+        keys (list): tags to convert, None for all
+
+    Yields:
+        the dictionary of each structure
+    """
+    context = ET.iterparse(filename, events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0 and elem.tag == 'structure':
+                yield parse_xml_structure(elem, keys)
+                root.clear()
+
 def xml_to_dict_list(filename):
-    # Parse the XML file
-    tree = ET.parse(filename)
-    root = tree.getroot()
-
-    data = []
-    for item in root.findall('structure'):
-        item_dict = {}
-        for child in item:
-            key = child.tag
-            text = child.text.strip()
-            # Check if the field should be converted back to an array
-            if key in ['lattice', 'position', 'forces', 'numbers', 'stress',
-                       'bond', 'angle', 'proper', 'vdW', 'charge', 'offset',
-                       'rmse_values', 'r2_values', 'numMols']:
-
-                if text != 'None':
-                    #print(text)
-                    value = string_to_array(text)
-                    #if key == 'position': print(value, value.shape)
-                    #if key == 'stress': print(value, value.shape)
+    return list(iter_xml(filename))
+
+def xml_dict_to_ref_dic(dic, reset_cell=False):
+    """
+    Convert the dictionary from the xml file to the reference dictionary
+
+    Args:
+        dic (dict): dictionary from iter_xml
+        reset_cell (bool): whether or not reset the cell
+
+    Returns:
+        the reference dictionary
+    """
+    structure = Atoms(numbers = dic['numbers'],
+                      positions = dic['position'],
+                      cell = dic['lattice'],
+                      pbc = [1, 1, 1])
+    if reset_cell:
+        structure = reset_lammps_cell(structure)
+    ref_dic = {
+               'structure': structure,
+               'energy': dic['energy'],
+               'forces': dic['forces'],
+               'stress': dic['stress'],
+               'replicate': dic['replicate'],
+               'options': dic['options'],
+               'tag': dic['tag'],
+               'numMols': [int(m) for m in dic['numMols']],
+              }
+    if dic.get('runtime') is not None:
+        ref_dic['runtime'] = dic['runtime']
+    return ref_dic
+
+
+# stages of the runtime records, the columns of the runtime array in npz
+RUNTIME_KEYS = ['lmp_setup', 'lmp_run', 'ref']
+
+def load_npz(filename, keys=None, mmap=True):
+    """
+    Load the arrays of a npz file. If mmap is True, the arrays stored
+    without compression (np.savez) are memory-mapped instead of read.
+
+    Args:
+        filename (str): path of the npz file
+        keys (list): names of the arrays to load, None for all
+        mmap (bool): whether or not use memory-mapped arrays
+
+    Returns:
+        a dictionary of arrays
+    """
+    arrays = {}
+    npz = np.load(filename)
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as f:
+        for info in zf.infolist():
+            key = info.filename[:-4]
+            if keys is not None and key not in keys:
+                continue
+            if mmap and info.compress_type == zipfile.ZIP_STORED:
+                # skip the zip local header to reach the npy data
+                f.seek(info.header_offset + 26)
+                n_name, n_extra = struct.unpack('<HH', f.read(4))
+                f.seek(info.header_offset + 30 + n_name + n_extra)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    header = np.lib.format.read_array_header_1_0(f)
+                elif version == (2, 0):
+                    header = np.lib.format.read_array_header_2_0(f)
                 else:
-                    value = None
-            elif key in ['options']:
-                value = ast.literal_eval(text) #print(value)
-            else:
-                # Attempt to convert numeric values back to float/int
-                try:
-                    value = float(text)
-                    if value.is_integer():
-                        value = int(value)
-                except ValueError:
-                    if text == 'None':
-                        value = None
-                    else:
-                        value = text
+                    header = None
+                if header is not None:
+                    shape, fortran_order, dtype = header
+                    if not dtype.hasobject and np.prod(shape) > 0:
+                        order = 'F' if fortran_order else 'C'
+                        arrays[key] = np.memmap(filename, dtype=dtype, mode='r',
+                                                offset=f.tell(), shape=shape, order=order)
+                        continue
+            arrays[key] = npz[key]
+    npz.close()
+    return arrays
+
+def dict_list_to_npz(ref_dics, filename):
+    """
+    Save the reference dictionaries to a columnar npz file. The per-atom
+    arrays (numbers, positions, forces) of all references are concatenated
+    and indexed by atom_offsets, numMols are indexed by mol_offsets.
+    Missing energy/forces/stress are recorded in the has_* masks and the
+    missing runtimes as nan.
+
+    Args:
+        ref_dics (list): reference dictionaries
+        filename (str): path of the npz file
+    """
+    N = len(ref_dics)
+    natoms = [len(ref_dic['structure']) for ref_dic in ref_dics]
+    nmols = [len(ref_dic['numMols']) for ref_dic in ref_dics]
+    atom_offsets = np.zeros(N + 1, dtype=np.int64)
+    atom_offsets[1:] = np.cumsum(natoms)
+    mol_offsets = np.zeros(N + 1, dtype=np.int64)
+    mol_offsets[1:] = np.cumsum(nmols)
+
+    numbers = np.zeros(atom_offsets[-1], dtype=np.int32)
+    positions = np.zeros([atom_offsets[-1], 3])
+    forces = np.zeros([atom_offsets[-1], 3])
+    cells = np.zeros([N, 3, 3])
+    stress = np.zeros([N, 6])
+    energy = np.zeros(N)
+    has_energy = np.zeros(N, dtype=bool)
+    has_forces = np.zeros(N, dtype=bool)
+    has_stress = np.zeros(N, dtype=bool)
+    numMols = np.zeros(mol_offsets[-1], dtype=np.int64)
+    runtime = np.full([N, len(RUNTIME_KEYS)], np.nan)
+
+    for i, ref_dic in enumerate(ref_dics):
+        a0, a1 = atom_offsets[i], atom_offsets[i+1]
+        structure = ref_dic['structure']
+        numbers[a0:a1] = structure.numbers
+        positions[a0:a1] = structure.positions
+        cells[i] = structure.cell.array
+        if ref_dic['energy'] is not None:
+            energy[i] = ref_dic['energy']
+            has_energy[i] = True
+        if ref_dic['forces'] is not None:
+            forces[a0:a1] = ref_dic['forces']
+            has_forces[i] = True
+        if ref_dic['stress'] is not None:
+            stress[i] = np.array(ref_dic['stress']).flatten()
+            has_stress[i] = True
+        numMols[mol_offsets[i]:mol_offsets[i+1]] = ref_dic['numMols']
+        if ref_dic.get('runtime') is not None:
+            for j, key in enumerate(RUNTIME_KEYS):
+                if key in ref_dic['runtime']:
+                    runtime[i, j] = ref_dic['runtime'][key]
+
+    np.savez(filename,
+             atom_offsets=atom_offsets,
+             mol_offsets=mol_offsets,
+             numbers=numbers,
+             positions=positions,
+             forces=forces,
+             cells=cells,
+             stress=stress,
+             energy=energy,
+             has_energy=has_energy,
+             has_forces=has_forces,
+             has_stress=has_stress,
+             replicate=np.array([ref_dic['replicate'] for ref_dic in ref_dics], dtype=float),
+             options=np.array([ref_dic['options'] for ref_dic in ref_dics], dtype=bool).reshape([N, 3]),
+             tags=np.array([str(ref_dic['tag']) for ref_dic in ref_dics]),
+             numMols=numMols,
+             runtime=runtime,
+             )
+
+def npz_to_dict_list(filename, fields=None, mmap=True):
+    """
+    Load the reference dictionaries from the npz file of dict_list_to_npz.
+    The forces are the slices of one (memory-mapped) array.
+
+    Args:
+        filename (str): path of the npz file
+        fields (list): keys of the reference dictionary to load, e.g.,
+            ['structure', 'energy', 'replicate', 'options', 'numMols'],
+            None for all
+        mmap (bool): whether or not use memory-mapped arrays
+
+    Returns:
+        a list of reference dictionaries
+    """
+    all_fields = ['structure', 'energy', 'forces', 'stress', 'replicate',
+                  'options', 'tag', 'numMols', 'runtime']
+    if fields is None:
+        fields = all_fields
+    for field in fields:
+        if field not in all_fields:
+            raise ValueError("Unknown reference field", field)
+
+    columns = {'structure': ['numbers', 'positions', 'cells'],
+               'energy': ['energy', 'has_energy'],
+               'forces': ['forces', 'has_forces'],
+               'stress': ['stress', 'has_stress'],
+               'replicate': ['replicate'],
+               'options': ['options'],
+               'tag': ['tags'],
+               'numMols': ['numMols'],
+               'runtime': ['runtime'],
+              }
+    keys = ['atom_offsets', 'mol_offsets']
+    for field in fields:
+        keys.extend(columns[field])
+    data = load_npz(filename, keys, mmap)
+    atom_offsets = np.array(data['atom_offsets'])
+    mol_offsets = np.array(data['mol_offsets'])
+
+    ref_dics = []
+    for i in range(len(atom_offsets) - 1):
+        a0, a1 = atom_offsets[i], atom_offsets[i+1]
+        dic = {}
+        if 'structure' in fields:
+            dic['structure'] = Atoms(numbers = data['numbers'][a0:a1],
+                                     positions = data['positions'][a0:a1],
+                                     cell = data['cells'][i],
+                                     pbc = [1, 1, 1])
+        if 'energy' in fields:
+            dic['energy'] = float(data['energy'][i]) if data['has_energy'][i] else None
+        if 'forces' in fields:
+            dic['forces'] = data['forces'][a0:a1] if data['has_forces'][i] else None
+        if 'stress' in fields:
+            dic['stress'] = np.array(data['stress'][i]) if data['has_stress'][i] else None
+        if 'replicate' in fields:
+            dic['replicate'] = float(data['replicate'][i])
+        if 'options' in fields:
+            dic['options'] = [bool(x) for x in data['options'][i]]
+        if 'tag' in fields:
+            dic['tag'] = str(data['tags'][i])
+        if 'numMols' in fields:
+            dic['numMols'] = [int(m) for m in data['numMols'][mol_offsets[i]:mol_offsets[i+1]]]
+        if 'runtime' in fields and 'runtime' in data:
+            runtime = {}
+            for j, key in enumerate(RUNTIME_KEYS):
+                if not np.isnan(data['runtime'][i, j]):
+                    runtime[key] = float(data['runtime'][i, j])
+            if len(runtime) > 0:
+                dic['runtime'] = runtime
+        ref_dics.append(dic)
+    return ref_dics
 
-            item_dict[key] = value
-        #print(item_dict.keys())
-        data.append(item_dict)
-    return data
+def dict_list_to_db(ref_dics, filename, smiles=''):
+    """
+    Append the reference dictionaries to an ase database. Each reference is
+    a row with the energy/forces/stress of a single point calculator, the
+    key-value pairs (tag, replicate, smiles, energy_per_unit) for indexed
+    queries and the data of options/numMols/runtime. The rows are written in one
+    transaction under a lock file, so several jobs can append to the same
+    database.
+
+    Args:
+        ref_dics (list): reference dictionaries
+        filename (str): path of the ase database
+        smiles (str): smiles of the molecules joined by '.'
+    """
+    with Lock(filename + '.lock'), connect(filename, use_lock_file=False) as db:
+        for ref_dic in ref_dics:
+            structure = ref_dic['structure'].copy()
+            structure.calc = SinglePointCalculator(structure,
+                                                   energy=ref_dic['energy'],
+                                                   forces=ref_dic['forces'],
+                                                   stress=ref_dic['stress'])
+            key_value_pairs = {'tag': str(ref_dic['tag']),
+                               'replicate': float(ref_dic['replicate']),
+                               'smiles': smiles,
+                              }
+            if ref_dic['energy'] is not None:
+                key_value_pairs['energy_per_unit'] = ref_dic['energy'] / ref_dic['replicate']
+            data = {'options': np.array(ref_dic['options'], dtype=bool),
+                    'numMols': np.array(ref_dic['numMols'], dtype=int),
+                   }
+            if ref_dic.get('runtime') is not None:
+                data['runtime'] = ref_dic['runtime']
+            db.write(structure, key_value_pairs=key_value_pairs, data=data)
 
+def db_to_dict_list(filename, tags=None, smiles=None, emin=None, emax=None,
+                    selection=None):
+    """
+    Load the reference dictionaries from an ase database with the queries
+    on the indexed key-value pairs. The rows are returned in the order of
+    their ids.
+
+    Args:
+        filename (str): path of the ase database
+        tags (list): only the rows with one of these tags
+        smiles (str): only the rows of this smiles
+        emin (float): only the rows with energy_per_unit >= emin
+        emax (float): only the rows with energy_per_unit < emax
+        selection: additional ase db selection, e.g., 'replicate=4'
+
+    Returns:
+        a list of reference dictionaries
+    """
+    db = connect(filename)
+    expressions = []
+    if isinstance(selection, str):
+        expressions.extend([w.strip() for w in selection.split(',') if w.strip()])
+    elif selection is not None:
+        expressions.extend(selection)
+    if emin is not None:
+        expressions.append(('energy_per_unit', '>=', emin))
+    if emax is not None:
+        expressions.append(('energy_per_unit', '<', emax))
+    kwargs = {}
+    if smiles is not None:
+        kwargs['smiles'] = smiles
+
+    rows = {}
+    for tag in (tags if tags is not None else [None]):
+        if tag is not None:
+            kwargs['tag'] = tag
+        for row in db.select(expressions, **kwargs):
+            rows[row.id] = row
+
+    ref_dics = []
+    for id in sorted(rows.keys()):
+        row = rows[id]
+        structure = row.toatoms()
+        structure.calc = None
+        ref_dic = {'structure': structure,
+                   'energy': row.get('energy'),
+                   'forces': row.get('forces'),
+                   'stress': row.get('stress'),
+                   'replicate': row.replicate,
+                   'options': [bool(x) for x in row.data['options']],
+                   'tag': row.tag,
+                   'numMols': [int(m) for m in row.data['numMols']],
+                  }
+        if 'runtime' in row.data:
+            ref_dic['runtime'] = {key: float(t) for key, t in row.data['runtime'].items()}
+        ref_dics.append(ref_dic)
+    return ref_dics
 
 def prettify(elem):
     """Return a pretty-printed XML string for the Element."""
@@ -123,15 +478,14 @@ def compute_r2(y_true, y_pred):
     :param y_pred: The predicted values by the regression model.
     :return: The R-squared value.
     """
+    y_true = np.asarray(y_true, dtype=float).ravel()
+    y_pred = np.asarray(y_pred, dtype=float).ravel()
     if len(y_true) > 0:
-        # Calculate the mean of actual values
-        mean_y_true = sum(y_true) / len(y_true)
-
         # Total sum of squares (SST)
-        sst = sum((y_i - mean_y_true) ** 2 for y_i in y_true)
+        sst = np.sum((y_true - y_true.mean()) ** 2)
 
         # Residual sum of squares (SSE)
-        sse = sum((y_true_i - y_pred_i) ** 2 for y_true_i, y_pred_i in zip(y_true, y_pred))
+        sse = np.sum((y_true - y_pred) ** 2)
 
         # R-squared
         r2 = 1 - (sse / sst)
@@ -140,149 +494,348 @@ def compute_r2(y_true, y_pred):
 
     return r2
 
-def get_lmp_efs(lmp_struc, lmp_in, lmp_dat):
+def stack_efs(efs_list, ref_dics, e_offset):
+    """
+    Stack the FF and reference values of several references into
+    preallocated arrays, with the energies per replicate and only the
+    forces and stresses used in the options of each reference
+
+    Args:
+        efs_list (list): FF (energy, forces, stress) of each reference
+        ref_dics (list): reference dictionaries
+        e_offset (float): energy offset added to the FF energies
+
+    Returns:
+        (ff_eng, ff_force, ff_stress, ref_eng, ref_force, ref_stress) 1D arrays
+    """
+    n_force = sum([ref_dic['forces'].size for ref_dic in ref_dics if ref_dic['options'][1]])
+    n_stress = sum([ref_dic['stress'].size for ref_dic in ref_dics if ref_dic['options'][2]])
+    engs = np.empty([2, len(ref_dics)])
+    forces = np.empty([2, n_force])
+    stresses = np.empty([2, n_stress])
+
+    i_force, i_stress = 0, 0
+    for i, (efs, ref_dic) in enumerate(zip(efs_list, ref_dics)):
+        eng, force, stress = efs
+        replicate = ref_dic['replicate']
+        engs[0, i] = eng / replicate + e_offset
+        engs[1, i] = ref_dic['energy'] / replicate
+        if ref_dic['options'][1]:
+            n = ref_dic['forces'].size
+            forces[0, i_force:i_force+n] = np.ravel(force)
+            forces[1, i_force:i_force+n] = ref_dic['forces'].ravel()
+            i_force += n
+        if ref_dic['options'][2]:
+            n = ref_dic['stress'].size
+            stresses[0, i_stress:i_stress+n] = np.ravel(stress)
+            stresses[1, i_stress:i_stress+n] = ref_dic['stress'].ravel()
+            i_stress += n
+
+    return engs[0], forces[0], stresses[0], engs[1], forces[1], stresses[1]
+
+def get_lmp_efs(lmp_struc, lmp_in, lmp_dat, lmp_instance=None, folder='.'):
     if not hasattr(lmp_struc, 'ewald_error_tolerance'):
         lmp_struc.complete()
     #print('get_lmp_efs', len(dir(lmp_struc)), hasattr(lmp_struc, 'ewald_error_tolerance'))
-    calc = LAMMPSCalculator(lmp_struc, lmp_in=lmp_in, lmp_dat=lmp_dat)
+    calc = LAMMPSCalculator(lmp_struc, base=os.path.join(folder, 'lmp'),
+                            lmp_in=lmp_in, lmp_dat=lmp_dat,
+                            lmp_instance=lmp_instance)
     return calc.express_evaluation()
 
+def get_lmp_efs_inplace(calcs, lmp_struc, lmp_in, lmp_dat, version, folder='.'):
+    """
+    Same as get_lmp_efs, but keep one live lammps instance per topology.
+    See get_lmp_calc_inplace.
+    """
+    return get_lmp_calc_inplace(calcs, lmp_struc, lmp_in, lmp_dat, version,
+                                folder).express_evaluation()
+
+def get_lmp_calc_inplace(calcs, lmp_struc, lmp_in, lmp_dat, version, folder='.'):
+    """
+    Get the live lammps instance of the topology, ready for run 0.
+    The lammps files are only written and read when a topology is met for
+    the first time. Afterwards, the box and positions are scattered into
+    the loaded instance, and the coefficients/charges are only pushed when
+    the FF version has changed.
+
+    The instances are keyed by the id of lmp_struc, i.e., one per template
+    of get_lmp_input_from_structure, as references with different numMols
+    may have the same number of atoms but not the same bonds and molecules.
+    The template is kept alive by its calculator, so that the id is not
+    reused.
+
+    Args:
+        calcs (dict): {id(lmp_struc): [LAMMPSCalculator, version]}
+        lmp_struc: LAMMPSStructure with the current box/positions/parameters
+        lmp_in: lammps input template
+        lmp_dat: list of lammps data strings
+        version (int): version of the FF parameters in lmp_struc
+        folder (str): folder of the lammps files
+    """
+    if not hasattr(lmp_struc, 'ewald_error_tolerance'):
+        lmp_struc.complete()
+    key = id(lmp_struc)
+    if key not in calcs:
+        base = os.path.join(folder, 'lmp-{:d}'.format(len(calcs)))
+        calc = LAMMPSCalculator(lmp_struc, base=base, lmp_in=lmp_in, lmp_dat=lmp_dat)
+        calcs[key] = [calc, version]
+    else:
+        calc, version0 = calcs[key]
+        calc.update(lmp_struc, coefficients=(version != version0))
+        calcs[key][1] = version
+    return calc
+
 def evaluate_ff_par(ref_dics, lmp_strucs, lmp_dats, lmp_in, e_offset, E_only,
-        natoms_per_unit, f_coef, s_coef, dir_name, obj):
+        natoms_per_unit, f_coef, s_coef, dir_name, obj, lmp_instance=None,
+        calcs=None, version=0):
     """
     parallel version
+
+    If lmp_instance is given, it is cleared and reused for all structures
+    instead of launching a new lammps for each structure. If calcs is
+    given, the live instances from get_lmp_efs_inplace are used instead.
+    The lammps files are written in dir_name and the lammps wall times are
+    recorded in the runtime of each ref_dic.
     """
     #print("parallel version", E_only)
-    pwd = os.getcwd()
-    total_mse = 0.0
-    eng_arr, force_arr, stress_arr = [[], []], [[], []], [[], []]
-    os.chdir(dir_name)
-
-    for ref_dic, lmp_struc, lmp_dat in zip(ref_dics, lmp_strucs, lmp_dats):
-        options = ref_dic['options']
-        numMol = ref_dic['numMols']
-        efs = evaluate_structure(ref_dic['structure'],
-                                 #numMol,
-                                 lmp_struc,
-                                 lmp_dat,
-                                 lmp_in,
-                                 natoms_per_unit)
-        result = obj_from_efs(efs, ref_dic, e_offset, E_only, f_coef, s_coef, obj)
+    structures = [ref_dic['structure'] for ref_dic in ref_dics]
+    times = [None] * len(structures)
+    efs_list = evaluate_structures(structures,
+                                   lmp_strucs,
+                                   lmp_dats,
+                                   lmp_in,
+                                   lmp_instance,
+                                   calcs,
+                                   version,
+                                   times,
+                                   dir_name)
+
+    results = []
+    for ref_dic, efs, t in zip(ref_dics, efs_list, times):
+        set_runtime(ref_dic, lmp_setup=t[0], lmp_run=t[1])
+        results.append(obj_from_efs(efs, ref_dic, e_offset, E_only, f_coef, s_coef, obj))
+
+    return collect_ff_results(results, obj)
+
+def collect_ff_results(results, obj):
+    """
+    Gather the obj_from_efs results of several references
+
+    Args:
+        results (list): obj_from_efs output of each reference
+        obj (str): 'MSE' or 'R2'
+
+    Returns:
+        the total mse or (eng_arr, force_arr, stress_arr), each an array
+        of (2, N) with the FF and reference values
+    """
+    with profiler.timer('aggregate'):
         if obj == 'MSE':
-            total_mse += result
+            return sum(results, 0.0)
         else:
-            engs, forces, stresses = result
-            eng_arr[0].append(engs[0])
-            eng_arr[1].append(engs[1])
-            if len(forces) > 0:
-                force_arr[0].extend(forces[0])
-                force_arr[1].extend(forces[1])
-            if len(stresses) > 0:
-                stress_arr[0].extend(stresses[0])
-                stress_arr[1].extend(stresses[1])
-    #print(len(eng_arr[0]), len(force_arr[1]), len(stress_arr[0]), '++++++++++++++')
-
-    os.chdir(pwd)
-    if obj == 'MSE':
-        return total_mse
-    else:
-        return (eng_arr, force_arr, stress_arr)
+            return tuple(concatenate_columns([result[i] for result in results])
+                         for i in range(3))
+
+def concatenate_columns(arrays):
+    """
+    Concatenate the (2, N) arrays into one preallocated (2, sum(N)) array
+    """
+    out = np.empty([2, sum([array.shape[1] for array in arrays])])
+    i = 0
+    for array in arrays:
+        out[:, i:i+array.shape[1]] = array
+        i += array.shape[1]
+    return out
 
 def evaluate_ff_error_par(ref_dics, lmp_strucs, lmp_dats, lmp_in, e_offset,
         natoms_per_unit, f_coef, s_coef, dir_name, max_dE=1.25, max_E=1000.0):
     """
-    parallel version
+    parallel version, the lammps files are written in dir_name
     """
-    pwd = os.getcwd()
-    os.chdir(dir_name)
-
-    result = 0.0
+    structures = [ref_dic['structure'] for ref_dic in ref_dics]
+    efs_list = evaluate_structures(structures, lmp_strucs, lmp_dats, lmp_in,
+                                   folder=dir_name)
 
-    ff_eng, ff_force, ff_stress = [], [], []
-    ref_eng, ref_force, ref_stress = [], [], []
-
-    for ref_dic, lmp_struc, lmp_dat in zip(ref_dics, lmp_strucs, lmp_dats):
-        options = ref_dic['options']
+    refs, efs_refs = [], []
+    for ref_dic, efs in zip(ref_dics, efs_list):
         replicate = ref_dic['replicate']
-        eng, force, stress = evaluate_structure(ref_dic['structure'],
-                                                lmp_struc,
-                                                lmp_dat,
-                                                lmp_in,
-                                                natoms_per_unit)
+        eng = efs[0]
         # Ignore the structures with unphysical energy values
         e_diff = eng/replicate + e_offset - ref_dic['energy']/replicate
         if eng < max_E and abs(e_diff) < max_dE:
-            ff_eng.append(eng/replicate + e_offset)
-            ref_eng.append(ref_dic['energy']/replicate)
-
-            if options[1]:
-                ff_force.extend(force.tolist())
-                ref_force.extend(ref_dic['forces'].tolist())
-
-            if options[2]:
-                ff_stress.extend(stress.tolist())
-                ref_stress.extend(ref_dic['stress'].tolist())
+            refs.append(ref_dic)
+            efs_refs.append(efs)
         else:
             print('Neglect reference due to energy', eng, abs(e_diff), ref_dic['tag'])
-    os.chdir(pwd)
-    return (ff_eng, ff_force, ff_stress, ref_eng, ref_force, ref_stress)
+    return stack_efs(efs_refs, refs, e_offset)
 
-def evaluate_structure(structure, lmp_struc, lmp_dat, lmp_in, natoms_per_unit):
+def evaluate_structure(structure, lmp_struc, lmp_dat, lmp_in, natoms_per_unit,
+                       lmp_instance=None, calcs=None, version=0, folder='.'):
     replicate = len(structure)/natoms_per_unit
     lmp_struc.box = structure.cell.cellpar()
     lmp_struc.coordinates = structure.get_positions()
-    return get_lmp_efs(lmp_struc, lmp_in, lmp_dat)
+    if calcs is not None:
+        return get_lmp_efs_inplace(calcs, lmp_struc, lmp_in, lmp_dat, version, folder)
+    return get_lmp_efs(lmp_struc, lmp_in, lmp_dat, lmp_instance, folder)
+
+def evaluate_structures(structures, lmp_strucs, lmp_dats, lmp_in,
+                        lmp_instance=None, calcs=None, version=0, times=None,
+                        folder='.'):
+    """
+    Evaluate a list of structures by reusing one lammps instance for all
+    structures sharing the same topology (i.e., the same lmp_struc template).
+    The lammps files are only written and read for the first structure of
+    each topology, the others only need change_box/scatter_atoms and run 0.
+
+    Args:
+        structures: list of ase structures
+        lmp_strucs: list of LAMMPSStructure templates
+        lmp_dats: list of lammps data strings
+        lmp_in: lammps input template
+        lmp_instance: PyLammps instance to be reused in the file mode
+        calcs (dict): live instances for get_lmp_efs_inplace
+        version (int): version of the FF parameters
+        times (list): if given, filled with the (setup, run) wall times
+        folder (str): folder of the lammps files
+
+    Returns:
+        a list of (energy, forces, stress) in the input order
+    """
+    groups = {}
+    for i, lmp_struc in enumerate(lmp_strucs):
+        key = id(lmp_struc)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(i)
+
+    efs_list = [None] * len(structures)
+    for ids in groups.values():
+        lmp_struc, lmp_dat = lmp_strucs[ids[0]], lmp_dats[ids[0]]
+        calc = None
+        for i in ids:
+            t0 = time.time()
+            lmp_struc.box = structures[i].cell.cellpar()
+            lmp_struc.coordinates = structures[i].get_positions()
+            if calcs is not None:
+                calc = get_lmp_calc_inplace(calcs, lmp_struc, lmp_in, lmp_dat, version, folder)
+            elif calc is None:
+                if not hasattr(lmp_struc, 'ewald_error_tolerance'):
+                    lmp_struc.complete()
+                calc = LAMMPSCalculator(lmp_struc,
+                                        base=os.path.join(folder, 'lmp'),
+                                        lmp_in=lmp_in,
+                                        lmp_dat=lmp_dat,
+                                        lmp_instance=lmp_instance)
+            else:
+                calc.update(lmp_struc, coefficients=False)
+            t1 = time.time()
+            efs_list[i] = calc.express_evaluation()
+            if times is not None:
+                times[i] = (t1 - t0, time.time() - t1)
+    return efs_list
+
+def set_runtime(ref_dic, **times):
+    """
+    Record the latest wall times (in seconds) of a reference, e.g.,
+    lmp_setup/lmp_run for lammps and ref for the reference calculator.
+
+    Args:
+        ref_dic (dict): reference dictionary
+        times: the wall time of each stage
+    """
+    if ref_dic.get('runtime') is None:
+        ref_dic['runtime'] = {}
+    for key, t in times.items():
+        ref_dic['runtime'][key] = float(t)
 
 def obj_from_efs(efs, ref_dic, e_offset, E_only, f_coef, s_coef, obj):
     """
     Compute the objective from a single ff_dic.
     If obj is MSE, return mse value
-    If obj is r2, return (eng, force, stress) array
+    If obj is r2, return (eng, force, stress) arrays of (2, N) with the
+    FF and reference values
     """
-    mse = 0
-    (eng, force, stress) = efs
-    eng_arr, force_arr, stress_arr = [], [[], []], [[], []]
-
-    if ref_dic['options'][0]:
-        e1 = eng / ref_dic['replicate'] + e_offset
-        e2 = ref_dic['energy'] / ref_dic['replicate']
-        mse += (e1-e2) ** 2
-        eng_arr = [e1, e2]
-
-    if not E_only:
-        if ref_dic['options'][1]:
-            f1 = force.flatten()
-            f2 = ref_dic['forces'].flatten()
-            f_diff = f1 - f2
-            mse += f_coef * np.sum(f_diff ** 2)
-            force_arr[0] = f1
-            force_arr[1] = f2
+    with profiler.timer('aggregate'):
+        mse = 0
+        (eng, force, stress) = efs
+        eng_arr, force_arr, stress_arr = np.empty([2, 0]), np.empty([2, 0]), np.empty([2, 0])
+
+        if ref_dic['options'][0]:
+            e1 = eng / ref_dic['replicate'] + e_offset
+            e2 = ref_dic['energy'] / ref_dic['replicate']
+            mse += (e1-e2) ** 2
+            eng_arr = np.array([[e1], [e2]])
+
+        if not E_only:
+            if ref_dic['options'][1]:
+                f1 = force.flatten()
+                f2 = ref_dic['forces'].flatten()
+                f_diff = f1 - f2
+                mse += f_coef * np.sum(f_diff ** 2)
+                force_arr = np.array([f1, f2])
 
-        if ref_dic['options'][2]:
-            s1 = stress.flatten()
-            s2 = ref_dic['stress'].flatten()
-            s_diff = s1 - s2
-            mse += s_coef * np.sum(s_diff ** 2)
-            stress_arr[0] = s1
-            stress_arr[1] = s2
+            if ref_dic['options'][2]:
+                s1 = stress.flatten()
+                s2 = ref_dic['stress'].flatten()
+                s_diff = s1 - s2
+                mse += s_coef * np.sum(s_diff ** 2)
+                stress_arr = np.array([s1, s2])
 
-    if obj == 'MSE':
-        return mse
-    else:
-        return (eng_arr, force_arr, stress_arr)
+        if obj == 'MSE':
+            return mse
+        else:
+            return (eng_arr, force_arr, stress_arr)
 
 def evaluate_ref_par(structures, numMols, calculator, natoms_per_unit,
                         options=[True, True, True]):
     """
-    evaluate the reference structure with the ref_evaluator
+    evaluate the reference structures with the ref_evaluator in batches,
+    see evaluate_ref_batch
+    """
+    strucs = [reset_lammps_cell(struc) for struc in structures]
+    return evaluate_ref_batch(strucs, numMols, calculator, natoms_per_unit, options)
+
+def evaluate_ref_batch(structures, numMols, calculator, natoms_per_unit,
+                       options=[True, True, True], parent=None, skin=1.0):
     """
+    Evaluate many reference structures with one model call per batch
+    (pyocse.batch.evaluate_batch) instead of one call per structure.
+    The wall time of the batch is shared by the number of atoms.
+
+    Args:
+        structures (list): ase atoms
+        numMols (list): numMols of each structure
+        calculator: ase calculator of the ref_evaluator
+        natoms_per_unit (int): number of atoms per unit
+        options (list): [energy, forces, stress]
+        parent: ase atoms from which the structures are derived by small
+            displacements/strains to share its neighbor list
+        skin (float): padding of the parent neighbor list
+
+    Returns:
+        the list of reference dictionaries
+    """
+    if len(structures) == 0:
+        return []
+    t0 = time.time()
+    engs, forces, stresses = evaluate_batch(structures, calculator, options,
+                                            parent=parent, skin=skin)
+    t = time.time() - t0
+    natoms = sum([len(structure) for structure in structures])
+
     ref_dics = []
-    for numMol, struc in zip(numMols, structures):
-        ref_dics.append(evaluate_ref_single(struc,
-                                            numMol,
-                                            calculator,
-                                            natoms_per_unit,
-                                            options))
+    for i, (structure, numMol) in enumerate(zip(structures, numMols)):
+        ref_dic = {'structure': structure,
+                   'energy': engs[i] if options[0] else None,
+                   'forces': forces[i] if options[1] else None,
+                   'stress': stresses[i] if options[2] else None,
+                   'replicate': len(structure)/natoms_per_unit,
+                   'options': options,
+                   'tag': 'CSP',
+                   'numMols': numMol,
+                  }
+        set_runtime(ref_dic, ref=t*len(structure)/natoms)
+        ref_dics.append(ref_dic)
     return ref_dics
 
 def evaluate_ref_single(structure, numMol, calculator, natoms_per_unit,
@@ -300,6 +853,7 @@ def evaluate_ref_single(structure, numMol, calculator, natoms_per_unit,
                'tag': 'CSP',
                'numMols': numMol,
               }
+    t0 = time.time()
     structure.set_calculator(calculator)
     if relax:
         structure.set_constraint(FixSymmetry(structure))
@@ -315,6 +869,7 @@ def evaluate_ref_single(structure, numMol, calculator, natoms_per_unit,
     if options[2]:
         ref_dic['stress'] = structure.get_stress()
     structure.set_calculator() # reset calculator to None
+    set_runtime(ref_dic, ref=time.time() - t0)
 
     return ref_dic
 
@@ -326,8 +881,8 @@ def augment_ref_par(strucs, numMols, calculator, steps, N_vibs,
     #coefs_stress = [0.85, 0.92, 1.08, 1.18, 1.25]
     #dxs = [0.01, 0.02, 0.03]
 
-    pwd = os.getcwd()
-    os.chdir(folder)
+    if logfile not in [None, '-']:
+        logfile = os.path.join(folder, logfile)
     ref_dics = []
 
     for numMol, ref_structure in zip(numMols, strucs):
@@ -341,15 +896,16 @@ def augment_ref_par(strucs, numMols, calculator, steps, N_vibs,
                                            logfile,
                                            fmax))
 
-    os.chdir(pwd)
     return ref_dics
 
 def augment_ref_single(ref_structure, numMol, calculator, steps,
                        N_vibs, n_atoms_per_unit, logfile='-',
-                       fmax=0.1, max_E=1000, min_dE=5.0):
+                       fmax=0.1, max_E=1000, min_dE=5.0, skin=1.0):
     """
     parallel version
     Add max_E and min_dE to prevent adding the high-E structures
+    The elastic/vibration samples are evaluated in batches that share the
+    neighbor list of the minimum padded by skin (in Angstrom)
     """
 
     #coefs_stress = [0.90, 0.95, 1.08, 1.15, 1.20]
@@ -389,6 +945,7 @@ def augment_ref_single(ref_structure, numMol, calculator, steps,
 
         print('# Get elastic configurations: 3 * {:d}'.format(len(coefs_stress)))
         cell0 = ref_structure.cell.array
+        strucs = []
         for ax in range(3):
             for coef in coefs_stress:
                 structure = ref_structure.copy()
@@ -399,34 +956,49 @@ def augment_ref_single(ref_structure, numMol, calculator, steps,
                 structure.set_calculator(calculator)
                 dyn = FIRE(structure, a=0.1, logfile=logfile)
                 dyn.run(fmax=fmax, steps=20)
-                ref_dic = evaluate_ref_single(structure,
-                                              numMol,
-                                              calculator,
-                                              n_atoms_per_unit,
-                                              [True, False, True])
+                structure.set_calculator()
+                strucs.append(reset_lammps_cell(structure))
 
-                value = ref_dic['energy']/ref_dic['replicate']
-                if ref_eng - min_dE < value < ref_eng + min_dE:
-                    ref_dic['tag'] = 'elastic'
-                    ref_dics.append(ref_dic)
+        # evaluate all strained structures in one batch, the neighbor list
+        # of the minimum is shared unless the strain is too large
+        dics = evaluate_ref_batch(strucs,
+                                  [numMol] * len(strucs),
+                                  calculator,
+                                  n_atoms_per_unit,
+                                  [True, False, True],
+                                  ref_structure,
+                                  skin)
+        for ref_dic in dics:
+            value = ref_dic['energy']/ref_dic['replicate']
+            if ref_eng - min_dE < value < ref_eng + min_dE:
+                ref_dic['tag'] = 'elastic'
+                ref_dics.append(ref_dic)
 
         print('# Get purturbation: {:d} * {:d}'.format(N_vibs, len(dxs)))
         pos0 = ref_structure.get_positions()
+        strucs = []
         for dx in dxs:
             for i in range(N_vibs):
                 structure = ref_structure.copy()
                 pos = pos0.copy()
                 pos += np.random.uniform(-dx, dx, size=pos0.shape)
                 structure.set_positions(pos)
-                ref_dic = evaluate_ref_single(structure,
-                                              numMol,
-                                              calculator,
-                                              n_atoms_per_unit,
-                                              [True, True, False])
-                value = ref_dic['energy']/ref_dic['replicate']
-                if ref_eng - min_dE < value < ref_eng + min_dE:
-                    ref_dic['tag'] = 'vibration'
-                    ref_dics.append(ref_dic)
+                strucs.append(reset_lammps_cell(structure))
+
+        # evaluate all perturbations of the minimum in one batch with the
+        # neighbor list of the minimum
+        dics = evaluate_ref_batch(strucs,
+                                  [numMol] * len(strucs),
+                                  calculator,
+                                  n_atoms_per_unit,
+                                  [True, True, False],
+                                  ref_structure,
+                                  skin)
+        for ref_dic in dics:
+            value = ref_dic['energy']/ref_dic['replicate']
+            if ref_eng - min_dE < value < ref_eng + min_dE:
+                ref_dic['tag'] = 'vibration'
+                ref_dics.append(ref_dic)
     print('# Finalized data augmentation')
 
     return ref_dics
@@ -465,7 +1037,9 @@ class ForceFieldParameters:
                  s_coef = 1.0,
                  ncpu = 1,
                  verbose = True,
-                 device = 'cpu'):
+                 device = 'cpu',
+                 lmp_mode = 'file',
+                 workdir = '.'):
         """
         Initialize the parameters
 
@@ -477,6 +1051,12 @@ class ForceFieldParameters:
             ref_evaluator (str): None or 'mace' or 'trochani'
             f_coef (float): coefficients for forces
             s_coef (float): coefficients for stress
+            lmp_mode (str): 'file' or 'memory'. In the 'memory' mode, the
+                topology stays loaded in lammps and only the coefficients,
+                charges, box and positions are updated for each evaluation
+            workdir (str): folder of the lammps files, the workers use its
+                cpuXXX subfolders. Concurrent fits in the same directory
+                should use different workdirs
         """
         self.smiles = smiles
         self.ff_style = style
@@ -510,11 +1090,32 @@ class ForceFieldParameters:
             # set up the lammps template
             self.ase_templates = {}
             self.lmp_dat = {}
+        if lmp_mode not in ['file', 'memory']:
+            raise ValueError("Unsupported lmp_mode", lmp_mode)
+        self.lmp_mode = lmp_mode
+        os.makedirs(workdir, exist_ok=True)
+        self.workdir = workdir
+        # live lammps instances for the memory mode
+        self.lmp_calcs = {}
+        self.ff_version = 0
         self.f_coef = f_coef
         self.s_coef = s_coef
         self.terms = ['bond', 'angle', 'proper', 'vdW', 'charge', 'offset']
         self.ncpu = ncpu
         self.verbose = verbose
+        # persistent workers for get_objective when ncpu > 1
+        self.pool = None
+        # analytic evaluators by numMols and descriptors by structure
+        self.analytic_engines = {}
+        self.analytic_descs = {}
+        # design matrices of the linear bonded terms by structure
+        self.linear_designs = {}
+        # wall time models by stage ('lmp' or 'ref'), see fit_cost_model
+        self.cost_models = {}
+        # lammps contributions of the frozen FF terms by structure
+        self.frozen_efs = {}
+        # objective values of the visited parameters, see set_objective_cache
+        self.objective_cache = ObjectiveCache()
 
     def get_default_ff_parameters(self, coefs=[0.5, 1.5], deltas=[-0.2, 0.2]):
         """
@@ -738,9 +1339,8 @@ class ForceFieldParameters:
         #if check: parameters = self.check_validity(parameters)
         #parameters = parameters.copy()
         self.ff.update_parameters(parameters)
-        # reset the ase_lammps to empty
-        self.ase_templates = {}
-        self.lmp_dat = {}
+        self.parameters_current = np.array(parameters)
+        self.ff_version += 1
 
     def __str__(self):
         s = "\n------Force Field Parameters------\n"
@@ -819,20 +1419,37 @@ class ForceFieldParameters:
         return lmp_strucs, lmp_dats
 
     def get_lmp_input_from_structure(self, structure, numMols=[1], set_template=True):
+        """
+        Get the lammps template and data strings [head, parameters, connects]
+        for the given structure. The templates are keyed by the topology
+        (smiles, numMols, number of atoms) and survive the parameter updates,
+        i.e., only the coefficients are copied into the template and the
+        parameter section is rewritten when the FF version has changed.
 
-        replicate = len(structure)/self.natoms_per_unit
-        if replicate in self.ase_templates.keys():
-            lmp_struc = self.ase_templates[replicate]
-            lmp_dat = self.lmp_dat[replicate]
-        else:
-            lmp_struc = self.ff.get_ase_lammps(structure, numMols)
-            dat_head = lmp_struc._write_dat_head()
-            dat_prm = lmp_struc._write_dat_parameters()
-            dat_connect, _, _, _ = lmp_struc._write_dat_connects()
-            lmp_dat = [dat_head, dat_prm, dat_connect]
-            if set_template:
-                self.lmp_dat[replicate] = lmp_dat
-                self.ase_templates[replicate] = lmp_struc
+        Args:
+            structure: ase atoms
+            numMols (list): number of molecules for each smiles
+            set_template (bool): whether or not cache the new template
+        """
+        with profiler.timer('template'):
+            key = (tuple(self.smiles), tuple(numMols), len(structure))
+            if key in self.ase_templates.keys():
+                lmp_struc, version = self.ase_templates[key]
+                lmp_dat = self.lmp_dat[key]
+                if version != self.ff_version:
+                    self.ff.update_ase_lammps(lmp_struc, numMols)
+                    lmp_dat = [lmp_dat[0], lmp_struc._write_dat_parameters(), lmp_dat[2]]
+                    self.lmp_dat[key] = lmp_dat
+                    self.ase_templates[key] = (lmp_struc, self.ff_version)
+            else:
+                lmp_struc = self.ff.get_ase_lammps(structure, numMols)
+                dat_head = lmp_struc._write_dat_head()
+                dat_prm = lmp_struc._write_dat_parameters()
+                dat_connect, _, _, _ = lmp_struc._write_dat_connects()
+                lmp_dat = [dat_head, dat_prm, dat_connect]
+                if set_template:
+                    self.lmp_dat[key] = lmp_dat
+                    self.ase_templates[key] = (lmp_struc, self.ff_version)
         return lmp_struc, lmp_dat
 
     #@timeit
@@ -859,9 +1476,10 @@ class ForceFieldParameters:
             self.update_ff_parameters(parameters)
 
         if type(lmp_struc) == Atoms:
-            self.ase_templates = {}
-            self.lmp_dat = {}
-            lmp_struc, lmp_dat = self.get_lmp_input_from_structure(lmp_struc, numMols)
+            structure = reset_lammps_cell(lmp_struc)
+            lmp_struc, lmp_dat = self.get_lmp_input_from_structure(structure, numMols)
+            lmp_struc.box = structure.cell.cellpar()
+            lmp_struc.coordinates = structure.get_positions()
         if box is not None: lmp_struc.box = box
         if positions is not None: lmp_struc.coordinates = positions
 
@@ -876,7 +1494,16 @@ class ForceFieldParameters:
                   'numMols': numMols,
                   }
 
-        eng, force, stress = get_lmp_efs(lmp_struc, lmp_in, lmp_dat)
+        if self.lmp_mode == 'memory':
+            eng, force, stress = get_lmp_efs_inplace(self.lmp_calcs,
+                                                     lmp_struc,
+                                                     lmp_in,
+                                                     lmp_dat,
+                                                     self.ff_version,
+                                                     self.workdir)
+        else:
+            eng, force, stress = get_lmp_efs(lmp_struc, lmp_in, lmp_dat,
+                                             folder=self.workdir)
         if options[0]: # Energy
             ff_dic['energy'] = eng
         if options[1]: # forces
@@ -903,11 +1530,225 @@ class ForceFieldParameters:
         return True
 
 
+    def get_worker_copy(self, workdir=None, deep=False):
+        """
+        Get a lightweight copy of the object to be sent to a worker process.
+        The reference calculator, the worker pool and the templates are
+        not copied.
+
+        Args:
+            workdir (str): folder of the lammps files of the copy
+            deep (bool): also copy the force field, to evaluate the copies
+                concurrently in threads of the same process
+        """
+        params = copy(self)
+        if workdir is not None:
+            os.makedirs(workdir, exist_ok=True)
+            params.workdir = workdir
+        if deep:
+            params.ff = deepcopy(self.ff)
+        params.ncpu = 1
+        params.pool = None
+        params.ase_templates = {}
+        params.lmp_dat = {}
+        params.lmp_calcs = {}
+        params.analytic_descs = {}
+        params.linear_designs = {}
+        params.frozen_efs = {}
+        params.objective_cache = None
+        if hasattr(params, 'calculator'):
+            params.calculator = None
+        return params
+
+    def get_lmp_calcs(self):
+        """
+        Get the dictionary of live lammps instances for the memory mode,
+        or None for the file mode
+        """
+        if self.lmp_mode == 'memory':
+            return self.lmp_calcs
+        else:
+            return None
+
+    def get_pool(self, ref_dics, population=False):
+        """
+        Get the persistent worker pool for the given ref_dics. A new pool
+        is started only when the list of references changes or when more
+        workers are needed.
+
+        Args:
+            ref_dics: list of reference dictionaries
+            population (bool): use ncpu workers even if there are fewer
+                references, to evaluate many candidates at once
+        """
+        if population:
+            nworkers = self.ncpu
+        else:
+            nworkers = min([self.ncpu, len(ref_dics)])
+        if self.pool is None or not self.pool.is_valid(ref_dics) \
+            or len(self.pool.workers) < nworkers:
+            self.close_pool()
+            self.pool = FFWorkerPool(self, ref_dics, nworkers)
+        return self.pool
+
+    def set_objective_cache(self, maxsize=10000, decimals=10, filename=None):
+        """
+        Reset the objective cache used by the optimizers
+
+        Args:
+            maxsize (int): maximum number of values in memory, 0 to disable
+            decimals (int): decimals to round the parameters
+            filename (str): shelve file to reuse the values in a restarted job
+        """
+        if self.objective_cache is not None:
+            self.objective_cache.close()
+        if maxsize > 0:
+            self.objective_cache = ObjectiveCache(maxsize, decimals, filename)
+        else:
+            self.objective_cache = None
+
+    def close_pool(self):
+        """
+        Shut down the persistent worker pool, the timers of the workers
+        are merged first if the profiler is enabled
+        """
+        if self.pool is not None:
+            if profiler.is_enabled():
+                self.pool.collect_profile()
+            self.pool.close()
+            self.pool = None
+
+    def report_profile(self, filename=None, label=None):
+        """
+        Print the time of each stage of the objective calls, including
+        the ones in the worker processes, see pyocse.profiler
+
+        Args:
+            filename (str): json file for the trace
+            label (str): name of the run in the trace
+
+        Returns:
+            the dictionary of the trace
+        """
+        if self.pool is not None:
+            self.pool.collect_profile()
+        return profiler.report(filename, label)
+
+    def get_cost_features(self, structure):
+        """
+        Get the features of the cost model: 1, number of atoms, replicate
+        and cell volume
+
+        Args:
+            structure: ase atoms
+        """
+        natoms = len(structure)
+        return np.array([1.0, natoms, natoms/self.natoms_per_unit, structure.get_volume()])
+
+    def get_runtime(self, ref_dic, stage='lmp'):
+        """
+        Get the recorded wall time of a reference for the given stage,
+        None if it has not been recorded.
+
+        Args:
+            ref_dic (dict): reference dictionary
+            stage (str): 'lmp' (setup + run 0) or 'ref' (reference calculator)
+        """
+        runtime = ref_dic.get('runtime')
+        if runtime is None:
+            return None
+        if stage == 'lmp':
+            if 'lmp_setup' in runtime and 'lmp_run' in runtime:
+                return runtime['lmp_setup'] + runtime['lmp_run']
+        elif stage in runtime:
+            return runtime[stage]
+        return None
+
+    def fit_cost_model(self, ref_dics, stage='lmp'):
+        """
+        Fit the linear model of the wall time against get_cost_features
+        from the recorded runtimes of the references.
+
+        Args:
+            ref_dics (list): reference dictionaries
+            stage (str): 'lmp' or 'ref'
+
+        Returns:
+            the coefficients, or None if there are less than two records
+        """
+        X, y = [], []
+        for ref_dic in ref_dics:
+            t = self.get_runtime(ref_dic, stage)
+            if t is not None and 'structure' in ref_dic:
+                X.append(self.get_cost_features(ref_dic['structure']))
+                y.append(t)
+        if len(y) < 2:
+            return None
+        coefs = np.linalg.lstsq(np.array(X), np.array(y), rcond=None)[0]
+        self.cost_models[stage] = coefs
+        return coefs
+
+    def get_costs(self, items, stage='lmp'):
+        """
+        Estimate the cost of each reference or structure to order the
+        parallel tasks. The recorded runtime is used first, then the cost
+        model of the stage, then the number of atoms.
+
+        Args:
+            items (list): reference dictionaries or ase atoms
+            stage (str): 'lmp' or 'ref'
+
+        Returns:
+            list of costs
+        """
+        coefs = self.cost_models.get(stage)
+        strucs, costs = [], []
+        for item in items:
+            if isinstance(item, Atoms):
+                strucs.append(item)
+                costs.append(None)
+            else:
+                strucs.append(item['structure'])
+                costs.append(self.get_runtime(item, stage))
+
+        if None in costs:
+            if coefs is None:
+                # do not mix the seconds with the number of atoms
+                return [len(struc) for struc in strucs]
+            for i, struc in enumerate(strucs):
+                if costs[i] is None:
+                    costs[i] = max([float(self.get_cost_features(struc).dot(coefs)), 0.0])
+        return costs
+
+    def estimate_time(self, ref_dics, ncalls=1, stage='lmp'):
+        """
+        Estimate the wall time (in seconds) of a stage that evaluates the
+        references ncalls times with ncpu processes, e.g., the number of
+        objective calls of optimize_local. Needs the recorded runtimes or
+        the cost model of the stage.
+
+        Args:
+            ref_dics (list): reference dictionaries
+            ncalls (int): number of evaluations of all references
+            stage (str): 'lmp' or 'ref'
+        """
+        if stage not in self.cost_models:
+            self.fit_cost_model(ref_dics, stage)
+        if stage not in self.cost_models:
+            raise ValueError("No runtime recorded for the stage", stage)
+        costs = self.get_costs(ref_dics, stage)
+        return ncalls * max([sum(costs)/self.ncpu, max(costs)])
+
     #@timeit
-    def get_objective(self, ref_dics, e_offset, E_only=False, lmp_in=None, obj='MSE'):
+    def get_objective(self, ref_dics, e_offset, E_only=False, lmp_in=None, obj='MSE',
+                      terms=None):
         """
-        Compute the objective mismatch for the give ref_dics
-        Todo, Enable the parallel option
+        Compute the objective mismatch for the give ref_dics.
+        If ncpu > 1, the references are evaluated by the persistent
+        workers from get_pool, which only receive the current parameters
+        and lmp_in.
+        If terms is given, only these terms are evaluated, see
+        get_incremental_results.
 
         Args:
             ref_dics:
@@ -915,88 +1756,456 @@ class ForceFieldParameters:
             E_only:
             lmp_in:
             obj:
-        """
+            terms (list): the FF terms that have changed, None for all
+        """
+
+        profiler.count('objective')
+        with profiler.timer('objective'):
+            if terms is not None:
+                results = [self.get_incremental_results(ref_dics, e_offset, terms,
+                                                        E_only, lmp_in, obj)]
+            elif self.ncpu == 1:
+                # sweep the references with one lammps instance per topology
+                lmp_strucs, lmp_dats = self.get_lmp_inputs_from_ref_dics(ref_dics)
+                result = evaluate_ff_par(ref_dics,
+                                         lmp_strucs,
+                                         lmp_dats,
+                                         lmp_in,
+                                         e_offset,
+                                         E_only,
+                                         self.natoms_per_unit,
+                                         self.f_coef,
+                                         self.s_coef,
+                                         self.workdir,
+                                         obj,
+                                         calcs=self.get_lmp_calcs(),
+                                         version=self.ff_version)
+                results = [result]
+            else:
+                #parallel process with the persistent workers
+                if len(self.parameters_current) > 0:
+                    parameters = self.parameters_current
+                else:
+                    parameters = np.array(self.params_init)
+                pool = self.get_pool(ref_dics)
+                costs = self.get_costs(ref_dics, 'lmp')
+                results = pool.evaluate(parameters, e_offset, E_only, obj, costs, lmp_in)
 
-        total_obj = 0
-        eng_arr, force_arr, stress_arr = [[], []], [[], []], [[], []]
+            return self.get_total_objective(results, obj)
+
+    def get_population_objective(self, ref_dics, parameters_list, e_offset,
+                                 E_only=False, obj='MSE'):
+        """
+        Compute the objective for many parameter sets. If ncpu > 1, the
+        candidates are evaluated concurrently, each on all references by
+        one of the persistent workers from get_pool.
 
-        lmp_strucs, lmp_dats = self.get_lmp_inputs_from_ref_dics(ref_dics)
+        Args:
+            ref_dics (list): reference dictionaries
+            parameters_list (list): full parameters of each candidate
+            e_offset (float): energy offset
+            E_only (bool): only fit the energy
+            obj (str): 'MSE' or 'R2'
 
+        Returns:
+            list of the objective values
+        """
         if self.ncpu == 1:
-            for i, ref_dic in enumerate(ref_dics):
-                options = ref_dic['options']
-                numMol = ref_dic['numMols']
-                ff_dic = self.evaluate_ff_single(lmp_strucs[i], numMol, options,
-                                                 lmp_dats[i], lmp_in,
-                                                 )
-                #total_obj += self.obj_from_ffdic(ff_dic, ref_dic, e_offset, E_only)
-                efs = (ff_dic['energy'], ff_dic['forces'], ff_dic['stress'])
-                res = obj_from_efs(efs,
-                                   ref_dic,
-                                   e_offset,
-                                   E_only,
-                                   self.f_coef,
-                                   self.s_coef,
-                                   obj,
-                                  )
-                if obj == 'MSE':
-                    total_obj += res
-                else:
-                    ([e1, e2], [f1, f2], [s1, s2]) = res
-                    eng_arr[0].append(e1)
-                    eng_arr[1].append(e2)
-                    force_arr[0].extend(f1)
-                    force_arr[1].extend(f2)
-                    stress_arr[0].extend(s1)
-                    stress_arr[1].extend(s1)
-        else:
-            #parallel process
-            N_cycle = int(np.ceil(len(ref_dics)/self.ncpu))
-            args_list = []
-            for i in range(self.ncpu):
-                folder = self.get_label(i)
-                id1 = i*N_cycle
-                id2 = min([id1+N_cycle, len(ref_dics)])
-                #print(i, id1, id2, len(ref_dics))
-                os.makedirs(folder, exist_ok=True)
-                args_list.append((ref_dics[id1:id2],
-                                  lmp_strucs[id1:id2],
-                                  lmp_dats[id1:id2],
-                                  lmp_in,
-                                  e_offset,
-                                  E_only,
-                                  self.natoms_per_unit,
-                                  self.f_coef,
-                                  self.s_coef,
-                                  folder,
-                                  obj,
-                                  ))
-
-            with ProcessPoolExecutor(max_workers=self.ncpu) as executor:
-                results = [executor.submit(evaluate_ff_par, *p) for p in args_list]
-                for result in results:
-                    if obj == 'MSE':
-                        total_obj += result.result()
-                        #print(result.result())
-                    else:
-                        #([e1, e2], [f1, f2], [s1, s2]) = result.result()
-                        (engs, forces, stresses) = result.result()
-                        eng_arr[0].extend(engs[0])
-                        eng_arr[1].extend(engs[1])
-                        force_arr[0].extend(forces[0])
-                        force_arr[1].extend(forces[1])
-                        stress_arr[0].extend(stresses[0])
-                        stress_arr[1].extend(stresses[1])
-            if obj == 'R2':
-                #print(eng_arr[0])
+            objs = []
+            for parameters in parameters_list:
+                self.update_ff_parameters(parameters)
+                lmp_in = self.ff.get_lammps_in()
+                objs.append(self.get_objective(ref_dics, e_offset, E_only, lmp_in, obj))
+            return objs
+
+        pool = self.get_pool(ref_dics, population=True)
+        profiler.count('objective', len(parameters_list))
+        with profiler.timer('objective'):
+            results = pool.evaluate_population(parameters_list, e_offset, E_only, obj)
+            return [self.get_total_objective([result], obj) for result in results]
+
+    def submit_objective(self, ref_dics, parameters, e_offset, E_only=False, obj='MSE'):
+        """
+        Submit the objective of a parameter set to the persistent workers
+        without waiting for it, so that many candidates can be in flight
+        while the caller does something else, e.g.,
+
+            futures = [params.submit_objective(ref_dics, p, e_offset) for p in candidates]
+            objs = [future.result() for future in futures]
+
+        Args:
+            ref_dics (list): reference dictionaries
+            parameters (array): full FF parameters
+            e_offset (float): energy offset
+            E_only (bool): only fit the energy
+            obj (str): 'MSE' or 'R2'
+
+        Returns:
+            a concurrent.futures.Future of the objective value
+        """
+        pool = self.get_pool(ref_dics, population=True)
+        future = Future()
+
+        def done(_future):
+            if future.cancelled():
+                return
+            if _future.cancelled():
+                future.cancel()
+            elif _future.exception() is not None:
+                future.set_exception(_future.exception())
+            else:
+                future.set_result(self.get_total_objective([_future.result()], obj))
+
+        profiler.count('objective')
+        _future = pool.submit(np.array(parameters), e_offset, E_only, obj)
+        # cancel the candidate if it is not running yet
+        future.add_done_callback(lambda f: _future.cancel() if f.cancelled() else None)
+        _future.add_done_callback(done)
+        return future
+
+    def get_total_objective(self, results, obj='MSE'):
+        """
+        Sum up the collect_ff_results of the references
+
+        Args:
+            results (list): collect_ff_results of several groups of references
+            obj (str): 'MSE' or 'R2'
+        """
+        if obj == 'MSE':
+            return sum(results, 0)
+
+        total_obj = 0
+        eng_arr, force_arr, stress_arr = collect_ff_results(results, obj)
+        if obj == 'R2':
+            #print(eng_arr[0])
+            with profiler.timer('aggregate'):
                 total_obj -= compute_r2(eng_arr[0], eng_arr[1])
                 total_obj -= self.f_coef * compute_r2(force_arr[0], force_arr[1])
                 total_obj -= self.s_coef * compute_r2(stress_arr[0], stress_arr[1])
-                #print('BBBBBBBBBBBb', self.f_coef, compute_r2(force_arr[0], force_arr[1]))
+            #print('BBBBBBBBBBBb', self.f_coef, compute_r2(force_arr[0], force_arr[1]))
 
         return total_obj
 
 
+    def get_frozen_efs(self, ref_dics, terms, lmp_in=None):
+        """
+        Get the energy/forces/stress of each reference without the
+        contributions of the given terms, i.e., the lammps values minus the
+        analytic values of the terms at the current parameters. They are
+        only computed again when the parameters of the other terms change.
+        If ncpu > 1, lammps runs on the persistent workers from get_pool.
+
+        Args:
+            ref_dics (list): reference dictionaries
+            terms (list): the FF terms to exclude
+            lmp_in: lammps input template
+
+        Returns:
+            a list of [energy, forces, stress]
+        """
+        parameters = self.get_current_parameters()
+        sub_paras, _, _ = self.get_sub_parameters(parameters, terms)
+        p_frozen = self.set_sub_parameters([np.zeros(len(v)) for v in sub_paras],
+                                           terms, parameters)
+        p_frozen[-1] = 0.0
+        key = (tuple(sorted(terms)), p_frozen.tobytes())
+
+        ids = []
+        for i, ref_dic in enumerate(ref_dics):
+            frozen = self.frozen_efs.get(id(ref_dic['structure']))
+            if frozen is None or frozen[0] != key:
+                ids.append(i)
+        refs = [ref_dics[i] for i in ids]
+
+        if len(refs) > 0:
+            if lmp_in is None:
+                lmp_in = self.ff.get_lammps_in()
+            if self.ncpu > 1:
+                pool = self.get_pool(ref_dics)
+                costs = self.get_costs(ref_dics, 'lmp')
+                efs_list = pool.evaluate_efs(parameters, ids, lmp_in, costs)
+            else:
+                lmp_strucs, lmp_dats = self.get_lmp_inputs_from_ref_dics(refs)
+                efs_list = evaluate_structures([ref_dic['structure'] for ref_dic in refs],
+                                               lmp_strucs,
+                                               lmp_dats,
+                                               lmp_in,
+                                               calcs=self.get_lmp_calcs(),
+                                               version=self.ff_version,
+                                               folder=self.workdir)
+            for ref_dic, efs in zip(refs, efs_list):
+                structure = ref_dic['structure']
+                engine, desc = self.get_analytic_descriptors(structure, ref_dic['numMols'])
+                efs0 = engine.evaluate(desc, parameters, False, terms)
+                frozen = [efs[i] - efs0[i] for i in range(3)]
+                self.frozen_efs[id(structure)] = (key, structure, frozen)
+
+        return [self.frozen_efs[id(ref_dic['structure'])][2] for ref_dic in ref_dics]
+
+    def get_incremental_results(self, ref_dics, e_offset, terms, E_only=False,
+                                lmp_in=None, obj='MSE'):
+        """
+        Evaluate the references when only the given FF terms have changed.
+        The contributions of the other terms come from get_frozen_efs, so
+        that lammps only runs when they change. The changed terms are added
+        by the analytic evaluator, e.g., only the pair and kspace parts for
+        vdW/charge or only the bonded parts for bond/angle/proper.
+
+        Args:
+            ref_dics (list): reference dictionaries
+            e_offset (float): energy offset
+            terms (list): the FF terms that have changed
+            E_only (bool): only fit the energy
+            lmp_in: lammps input template
+            obj (str): 'MSE' or 'R2'
+
+        Returns:
+            the same as evaluate_ff_par
+        """
+        terms = [term for term in terms if term != 'offset']
+        parameters = self.get_current_parameters()
+        frozen_list = self.get_frozen_efs(ref_dics, terms, lmp_in)
+        results = []
+        for ref_dic, frozen in zip(ref_dics, frozen_list):
+            engine, desc = self.get_analytic_descriptors(ref_dic['structure'], ref_dic['numMols'])
+            efs = engine.evaluate(desc, parameters, False, terms)
+            efs = [frozen[i] + efs[i] for i in range(3)]
+            results.append(obj_from_efs(efs, ref_dic, e_offset, E_only,
+                                        self.f_coef, self.s_coef, obj))
+        return collect_ff_results(results, obj)
+
+    def get_ff_signature(self):
+        """
+        Get a string of the FF setup which does not depend on the FF
+        parameters: smiles, style, charge method and the lammps input
+        without the coefficients (styles, cutoffs, Ewald settings)
+        """
+        lines = [line for line in self.ff.get_lammps_in().split('\n')
+                 if '_coeff' not in line.split('#')[0]]
+        return repr((self.smiles, self.ff_style, self.ff.chargemethod,
+                     self.natoms_per_unit, lines))
+
+    def get_current_parameters(self):
+        """
+        Get the current full FF parameters
+        """
+        if len(self.parameters_current) > 0:
+            return np.array(self.parameters_current, dtype=float)
+        else:
+            return np.array(self.params_init, dtype=float)
+
+    def get_analytic_engine(self, numMols, natoms=None):
+        """
+        Get the analytic evaluator for the given numMols and number of
+        atoms, the topology is tiled for the supercells as in lammps
+
+        Args:
+            numMols (list): number of molecules for each smiles
+            natoms (int): number of atoms of the structure
+        """
+        key = (tuple(numMols), natoms)
+        if key not in self.analytic_engines:
+            self.analytic_engines[key] = AnalyticFF(self, numMols, natoms)
+        return self.analytic_engines[key]
+
+    def evaluate_ff_analytic(self, structure, numMols, parameters=None, jacobian=False):
+        """
+        Evaluate the structure with the analytic evaluator.
+        The descriptors of each structure are computed only once.
+
+        Args:
+            structure: ase atoms
+            numMols (list): number of molecules for each smiles
+            parameters (array): full FF parameters
+            jacobian (bool): whether or not compute the derivatives
+
+        Returns:
+            energy, forces, stress (and the derivatives if jacobian)
+        """
+        if parameters is None:
+            if len(self.parameters_current) > 0:
+                parameters = self.parameters_current
+            else:
+                parameters = self.params_init
+        engine, desc = self.get_analytic_descriptors(structure, numMols)
+        return engine.evaluate(desc, parameters, jacobian)
+
+    def get_analytic_descriptors(self, structure, numMols):
+        """
+        Get the analytic evaluator and the cached descriptors of a structure
+
+        Args:
+            structure: ase atoms
+            numMols (list): number of molecules for each smiles
+        """
+        engine = self.get_analytic_engine(numMols, len(structure))
+        key = id(structure)
+        if key not in self.analytic_descs:
+            self.analytic_descs[key] = (structure, engine.get_descriptors(structure))
+        return engine, self.analytic_descs[key][1]
+
+    def get_objective_gradient(self, ref_dics, e_offset, parameters=None, E_only=False):
+        """
+        Compute the MSE objective and its gradient with respect to the full
+        parameters with the analytic evaluator. The last entry of the
+        gradient is the derivative over e_offset.
+
+        Args:
+            ref_dics: list of reference dictionaries
+            e_offset (float): energy offset
+            parameters (array): full FF parameters
+            E_only (bool): only fit the energy
+
+        Returns:
+            objective and gradient
+        """
+        if parameters is None:
+            if len(self.parameters_current) > 0:
+                parameters = self.parameters_current
+            else:
+                parameters = self.params_init
+        total_obj = 0.0
+        grad = np.zeros(len(parameters))
+
+        for ref_dic in ref_dics:
+            res = self.evaluate_ff_analytic(ref_dic['structure'],
+                                            ref_dic['numMols'],
+                                            parameters,
+                                            jacobian=True)
+            (eng, force, stress, dE, dF, dS) = res
+            total_obj += obj_from_efs((eng, force, stress),
+                                      ref_dic,
+                                      e_offset,
+                                      E_only,
+                                      self.f_coef,
+                                      self.s_coef,
+                                      'MSE')
+            options = ref_dic['options']
+            replicate = ref_dic['replicate']
+            if options[0]:
+                e_diff = (eng - ref_dic['energy']) / replicate + e_offset
+                grad += 2 * e_diff * dE / replicate
+                grad[-1] += 2 * e_diff
+            if not E_only:
+                if options[1]:
+                    f_diff = (force - ref_dic['forces']).flatten()
+                    grad += 2 * self.f_coef * f_diff @ dF.reshape([-1, len(grad)])
+                if options[2]:
+                    s_diff = stress.flatten() - ref_dic['stress'].flatten()
+                    grad += 2 * self.s_coef * s_diff @ dS
+        return total_obj, grad
+
+    def get_linear_design(self, ref_dics, terms=['bond', 'angle', 'proper'], parameters=None):
+        """
+        Get the design matrices of the bonded force constants that enter
+        the energy/forces/stress linearly for each reference. They are
+        cached by structure and only rebuilt when the other parameters
+        (e.g., the equilibrium values) change.
+
+        Args:
+            ref_dics: list of reference dictionaries
+            terms (list): bonded terms among 'bond', 'angle' and 'proper'
+            parameters (array): full FF parameters
+
+        Returns:
+            list of dictionaries from AnalyticFF.get_linear_design
+        """
+        if parameters is None:
+            if len(self.parameters_current) > 0:
+                parameters = self.parameters_current
+            else:
+                parameters = self.params_init
+
+        designs = []
+        for ref_dic in ref_dics:
+            structure = ref_dic['structure']
+            engine, desc = self.get_analytic_descriptors(structure, ref_dic['numMols'])
+            p = np.array(parameters[:-1], dtype=float)
+            p[engine.get_linear_ids(terms)] = 0.0
+            key = (tuple(terms), p.tobytes())
+            item = self.linear_designs.get(id(structure))
+            if item is None or item[1] != key:
+                design = engine.get_linear_design(desc, parameters, terms)
+                item = (structure, key, design)
+                self.linear_designs[id(structure)] = item
+            designs.append(item[2])
+        return designs
+
+    def optimize_linear(self, ref_dics, terms=['bond', 'angle', 'proper'],
+                        parameters0=None, E_only=False):
+        """
+        Fit the bonded force constants with all other parameters fixed.
+        Since they are linear in the energy/forces/stress, minimizing the
+        MSE objective is a bounded linear least squares problem.
+
+        Args:
+            ref_dics (dict): reference data dictionary
+            terms (list): 'bond', 'angle', 'proper' and optionally 'offset'
+            parameters0 (array): initial full parameters
+            E_only (bool): only fit the energy
+
+        Returns:
+            The optimized full parameters and the MSE objective
+        """
+        if parameters0 is None:
+            if len(self.parameters_current) > 0:
+                parameters0 = self.parameters_current
+            else:
+                parameters0 = self.params_init
+        parameters = np.array(parameters0, dtype=float)
+        fit_offset = 'offset' in terms
+        terms = [term for term in terms if term != 'offset']
+        designs = self.get_linear_design(ref_dics, terms, parameters)
+        ids = designs[0]['ids']
+        L = len(ids)
+
+        # Stack the weighted rows of all references
+        A, y = [], []
+        for ref_dic, design in zip(ref_dics, designs):
+            options = ref_dic['options']
+            replicate = ref_dic['replicate']
+            # (rows, targets, weight, offset column)
+            blocks = []
+            if options[0]:
+                a = design['dE'][None, :] / replicate
+                b = np.array([ref_dic['energy'] - design['E0']]) / replicate
+                if not fit_offset:
+                    b -= parameters[-1]
+                blocks.append((a, b, 1.0, 1.0))
+            if not E_only:
+                if options[1]:
+                    a = design['dF'].reshape([-1, L])
+                    b = (ref_dic['forces'] - design['F0']).flatten()
+                    blocks.append((a, b, np.sqrt(self.f_coef), 0.0))
+                if options[2]:
+                    a = design['dS']
+                    b = ref_dic['stress'].flatten() - design['S0']
+                    blocks.append((a, b, np.sqrt(self.s_coef), 0.0))
+            for (a, b, w, c) in blocks:
+                if fit_offset:
+                    a = np.hstack([a, np.full([len(a), 1], c)])
+                A.append(w * a)
+                y.append(w * b)
+        A = np.vstack(A)
+        y = np.concatenate(y)
+
+        # Skip the force constants that do not appear in any reference
+        active = np.where(np.any(A != 0, axis=0))[0]
+        lb = np.array([self.bounds[i][0] for i in ids] + [-np.inf] * fit_offset)
+        ub = np.array([self.bounds[i][1] for i in ids] + [np.inf] * fit_offset)
+        res = lsq_linear(A[:, active], y, bounds=(lb[active], ub[active]))
+
+        x = np.append(parameters[ids], parameters[-1])
+        x[active] = res.x
+        parameters[ids] = x[:L]
+        if fit_offset:
+            parameters[-1] = x[-1]
+        objective = 2 * res.cost
+        self.update_ff_parameters(parameters)
+        if self.verbose:
+            print("Linear fit of {:s}: {:.4f}".format(str(terms), objective))
+        return parameters, objective
+
     def get_opt_dict(self, terms=['vdW'], values=None, parameters=None):
         """
         Get the opt_dict as an input for optimization
@@ -1016,7 +2225,16 @@ class ForceFieldParameters:
         return opt_dict
 
     #@timeit
-    def optimize_init(self, ref_dics, opt_dict, parameters0=None, obj='MSE'):
+    def optimize_init(self, ref_dics, opt_dict, parameters0=None, obj='MSE',
+                      incremental=False, init=None):
+        """
+        Set up the objective function of the terms in opt_dict. If
+        incremental, the contributions of the other FF terms are frozen
+        and only the optimized terms are evaluated at each step (see
+        get_incremental_results). If init = (x, objective) is given from
+        a checkpoint and x is the same, the initial objective is not
+        evaluated again.
+        """
 
         if parameters0 is None:
             #parameters0 = self.params_init.copy()
@@ -1059,6 +2277,10 @@ class ForceFieldParameters:
         #x = [item for sublist in values for item in sublist]
         _, sub_bounds, _ = self.get_sub_parameters(parameters0, terms)
         bounds = [item for sublist in sub_bounds for item in sublist]
+        # the references are hashed once for the whole stage
+        cache = self.objective_cache
+        if cache is not None:
+            fingerprint = cache.get_fingerprint(ref_dics, self.get_ff_signature())
 
         def obj_fun(x, ref_dics, parameters0, e_offset, ids, obj, charges=None):
             """
@@ -1078,10 +2300,22 @@ class ForceFieldParameters:
                 values.append(x[-1] * charges)
             #print(terms, values)
             parameters = self.set_sub_parameters(values, terms, parameters0)
+            if cache is not None:
+                key = cache.get_key(parameters, e_offset,
+                                    (obj, self.f_coef, self.s_coef), fingerprint)
+                objective = cache.get(key)
+                if objective is not None:
+                    return objective
+
             self.update_ff_parameters(parameters)
-            # Reset the lmp.in file
-            lmp_in = self.ff.get_lammps_in()
-            objective = self.get_objective(ref_dics, e_offset, lmp_in=lmp_in, obj=obj)
+            if incremental:
+                objective = self.get_objective(ref_dics, e_offset, obj=obj, terms=terms)
+            else:
+                # Reset the lmp.in file
+                lmp_in = self.ff.get_lammps_in()
+                objective = self.get_objective(ref_dics, e_offset, lmp_in=lmp_in, obj=obj)
+            if cache is not None:
+                cache.put(key, objective)
             #print("Debugging", values[0][:5], objective)
             return objective
 
@@ -1093,10 +2327,50 @@ class ForceFieldParameters:
 
         arg_lists = (ref_dics, parameters0, e_offset, ids, obj, charges)
         # Actual optimization
-        print("Init obj", objective_function_wrapper(x, *arg_lists))#; import sys; sys.exit()
+        if init is not None and len(init[0]) == len(x) and np.allclose(init[0], x):
+            global last_function_value
+            last_function_value = init[1]
+        else:
+            objective_function_wrapper(x, *arg_lists)
+        print("Init obj", last_function_value)#; import sys; sys.exit()
 
         return x, bounds, objective_function_wrapper, arg_lists
 
+    def get_analytic_obj_fun(self, opt_dict):
+        """
+        Get the objective function that returns both the MSE objective and
+        its analytic gradient for the x vector from optimize_init.
+
+        Args:
+            opt_dict (dict): optimization terms and values
+        """
+        terms = list(opt_dict.keys())
+        if 'charge' in terms:
+            terms.pop(terms.index('charge'))
+            terms.append('charge')
+
+        def obj_fun(x, ref_dics, parameters0, e_offset, ids, obj, charges=None):
+            global last_function_value
+            values = self.optimize_post(x, ids, charges)
+            parameters = self.set_sub_parameters(values, terms, parameters0)
+            self.update_ff_parameters(parameters)
+            objective, grad = self.get_objective_gradient(ref_dics, e_offset, parameters)
+            sub_grads, _, _ = self.get_sub_parameters(grad, terms)
+            grad_x = []
+            for term, sub_grad in zip(terms, sub_grads):
+                if term == 'charge':
+                    # The last x value is the ratio of charge
+                    grad_x.append(np.dot(sub_grad, charges))
+                elif term == 'offset':
+                    # e_offset is fixed during the optimization
+                    grad_x.extend(np.zeros(len(sub_grad)))
+                else:
+                    grad_x.extend(sub_grad)
+            last_function_value = objective
+            return objective, np.array(grad_x)
+
+        return obj_fun
+
     def optimize_post(self, x, ids, charges):
         # Rearrange the optimized parameters to the list of values
         #ids = fun_args[-2]
@@ -1116,7 +2390,8 @@ class ForceFieldParameters:
 
 
     def optimize_global(self, ref_dics, opt_dict, parameters0=None,
-                        steps=100, obj='MSE', t0=100, alpha=0.99):
+                        steps=100, obj='MSE', t0=100, alpha=0.99, incremental=False,
+                        checkpoint=None, interval=10):
         """
         FF parameters' optimization using the simulated annealing algorithm
         Todo, test new interface, add temp scheduling
@@ -1129,16 +2404,39 @@ class ForceFieldParameters:
             obj (str): 'MSE' or 'R2'
             t0 (float): initial temp
             alpha (float): cooling rate
+            incremental (bool): only evaluate the optimized terms
+            checkpoint (str): file to save the state every interval steps
+                and to resume from if it exists
+            interval (int): steps between two checkpoints
         Returns:
             The optimized values
         """
-        x, bounds, obj_fun, fun_args = self.optimize_init(ref_dics, opt_dict, parameters0, obj)
-        t = t0
-        current_x = x
-        current_fun = obj_fun(current_x, *fun_args)
-        best_x, best_fun = current_x, current_fun
-
-        for i in range(steps):
+        state = load_checkpoint(checkpoint, 'optimize_global')
+        init = None
+        if state is not None:
+            if parameters0 is None:
+                parameters0 = state['parameters0']
+            init = (state['x0'], state['init_obj'])
+        x, bounds, obj_fun, fun_args = self.optimize_init(ref_dics, opt_dict, parameters0, obj,
+                                                          incremental, init)
+        init_obj = last_function_value
+        if state is not None and not is_same_start(state, x):
+            state = None
+        if state is None:
+            t = t0
+            current_x = x
+            current_fun = obj_fun(current_x, *fun_args)
+            best_x, best_fun = current_x, current_fun
+            step0 = 0
+        else:
+            t = state['t']
+            current_x, current_fun = state['current_x'], state['current_fun']
+            best_x, best_fun = state['best_x'], state['best_fun']
+            step0 = state['step']
+            np.random.set_state(state['rng'])
+            print("Resume optimize_global from step {:d} {:.4f}".format(step0, best_fun))
+
+        for i in range(step0, steps):
             # Generate a candidate solution
             candidate_x = current_x.copy()
             for j in range(len(bounds)):
@@ -1161,7 +2459,21 @@ class ForceFieldParameters:
             t *= alpha
             if self.verbose and i % 10 == 0:
                 print("Step {:4d} {:5.2f} {:.4f} {:.4f}".format(i, t, candidate_fun, current_fun))#, current_x)
+            if checkpoint is not None and ((i + 1) % interval == 0 or i + 1 == steps):
+                save_checkpoint(checkpoint, {'stage': 'optimize_global',
+                                             'x0': x,
+                                             'parameters0': fun_args[1],
+                                             'init_obj': init_obj,
+                                             'step': i + 1,
+                                             't': t,
+                                             'current_x': current_x,
+                                             'current_fun': current_fun,
+                                             'best_x': best_x,
+                                             'best_fun': best_fun,
+                                             'rng': np.random.get_state()})
         print("Best results after {:d} steps: {:.4f}".format(steps, best_fun))
+        if self.objective_cache is not None:
+            self.objective_cache.report('optimize_global')
         #print("Best fun", obj_fun(best_x, *fun_args))#; import sys; sys.exit()
 
         values = self.optimize_post(best_x, fun_args[-3], fun_args[-1])
@@ -1170,7 +2482,98 @@ class ForceFieldParameters:
         return best_x, best_fun, values, steps
 
 
-    def optimize_local(self, ref_dics, opt_dict, parameters0=None, steps=100, obj='MSE'):
+    def optimize_population(self, ref_dics, opt_dict, parameters0=None, steps=100,
+                            obj='MSE', popsize=15, seed=None, incremental=False):
+        """
+        FF parameters' global optimization using the differential evolution
+        algorithm of scipy. The candidates of each generation are evaluated
+        concurrently by get_population_objective, so that all ncpu workers
+        are busy even with a few references.
+
+        Args:
+            ref_dics (dict): reference data dictionary
+            opt_dict (dict): optimization terms and values
+            parameters0 (array): initial full parameters
+            steps (int): maximum number of generations
+            obj (str): 'MSE' or 'R2'
+            popsize (int): population size as a multiple of len(x)
+            seed (int): random seed
+            incremental (bool): only evaluate the optimized terms, used
+                if ncpu == 1
+        Returns:
+            The optimized values
+        """
+        x, bounds, obj_fun, fun_args = self.optimize_init(ref_dics, opt_dict, parameters0, obj,
+                                                          incremental)
+        (_, parameters0, e_offset, ids, _, charges) = fun_args
+        terms = list(opt_dict.keys())
+        if 'charge' in terms:
+            terms.pop(terms.index('charge'))
+            terms.append('charge')
+        settings = (obj, self.f_coef, self.s_coef)
+        cache = self.objective_cache
+        if cache is not None and self.ncpu > 1:
+            fingerprint = cache.get_fingerprint(ref_dics, self.get_ff_signature())
+        best = [np.inf]
+
+        def evaluate(func, population):
+            population = [np.array(_x) for _x in population]
+            if self.ncpu == 1:
+                objs = [obj_fun(_x, *fun_args) for _x in population]
+            else:
+                parameters_list = []
+                for _x in population:
+                    values = self.optimize_post(_x, ids, charges)
+                    parameters_list.append(self.set_sub_parameters(values, terms, parameters0))
+                objs = [None] * len(population)
+                if cache is not None:
+                    keys = [cache.get_key(parameters, e_offset, settings, fingerprint)
+                            for parameters in parameters_list]
+                    objs = [cache.get(key) for key in keys]
+                todo = [i for i in range(len(objs)) if objs[i] is None]
+                if len(todo) > 0:
+                    new_objs = self.get_population_objective(ref_dics,
+                                                             [parameters_list[i] for i in todo],
+                                                             e_offset, obj=obj)
+                    for i, objective in zip(todo, new_objs):
+                        objs[i] = objective
+                        if cache is not None:
+                            cache.put(keys[i], objective)
+            best[0] = min([best[0]] + objs)
+            return objs
+
+        class CallbackFunction:
+            def __init__(self, verbose):
+                self.iteration = 0
+                self.verbose = verbose
+
+            def callback(self, xk, convergence=None):
+                self.iteration += 1
+                if self.verbose and self.iteration % 10 == 0:
+                    print("Generation {:4d} {:.4f}".format(self.iteration, best[0]))
+
+        callback = CallbackFunction(self.verbose)
+        res = differential_evolution(obj_fun,
+                                     bounds,
+                                     args = fun_args,
+                                     maxiter = steps,
+                                     popsize = popsize,
+                                     seed = seed,
+                                     x0 = x,
+                                     polish = False,
+                                     updating = 'deferred',
+                                     workers = evaluate,
+                                     callback = callback.callback)
+
+        values = self.optimize_post(res.x, ids, charges)
+        print("Best results after {:d} generations: {:.4f}".format(res.nit, res.fun))
+        if self.objective_cache is not None:
+            self.objective_cache.report('optimize_population')
+        return res.x, res.fun, values, res.nfev
+
+    def optimize_local(self, ref_dics, opt_dict, parameters0=None, steps=100, obj='MSE',
+                       method='Nelder-Mead', incremental=False, checkpoint=None,
+                       interval=10, stop=None):
         """
         FF parameters' local optimization using the Nelder-Mead algorithm
 
@@ -1179,39 +2582,221 @@ class ForceFieldParameters:
             opt_dict (dict): optimization terms and values
             parameters0 (array): initial full parameters
             steps (int): optimization steps
+            obj (str): 'MSE' or 'R2'
+            method (str): 'Nelder-Mead' or a gradient based method in scipy
+                (e.g., 'L-BFGS-B') with the analytic gradients (MSE only)
+            incremental (bool): only evaluate the optimized terms
+            checkpoint (str): log of the evaluations, appended every
+                interval steps, to resume from if it exists
+            interval (int): steps between two checkpoints
+            stop (callable): stop(iteration, best objective) called after
+                each iteration, the optimization ends if it returns True
         Returns:
             The optimized values
         """
-        x, bounds, obj_fun, fun_args = self.optimize_init(ref_dics, opt_dict, parameters0, obj)
+        state = load_checkpoint(checkpoint, 'optimize_local')
+        init = None
+        if state is not None:
+            if state['method'] != method:
+                state = None
+            else:
+                if parameters0 is None:
+                    parameters0 = state['parameters0']
+                init = (state['x0'], state['init_obj'])
+        x, bounds, obj_fun, fun_args = self.optimize_init(ref_dics, opt_dict, parameters0, obj,
+                                                          incremental, init)
+        if state is not None and not is_same_start(state, x):
+            state = None
+        jac = None
+        if method != 'Nelder-Mead':
+            if obj != 'MSE':
+                raise ValueError("Analytic gradients only support MSE", obj)
+            obj_fun = self.get_analytic_obj_fun(opt_dict)
+            jac = True
+
+        # scipy does not expose the simplex (or the L-BFGS-B memory), the
+        # checkpoint keeps the sequence of evaluations instead. On restart,
+        # the recorded values are replayed, which brings the deterministic
+        # optimizer back to the same state without any new evaluation.
+        # The evaluations are appended to the log, only the new ones are
+        # written at each checkpoint.
+        header = {'stage': 'optimize_local',
+                  'x0': x,
+                  'method': method,
+                  'parameters0': fun_args[1],
+                  'init_obj': last_function_value}
+        history = []
+        replay = []
+        saved = [0]
+        best = [np.inf]
+        if state is not None:
+            replay = state['history']
+            saved[0] = len(replay)
+            print("Resume optimize_local from {:d} evaluations".format(len(replay)))
+        if checkpoint is not None:
+            # rewrite the log to drop a record cut by a killed job
+            write_log(checkpoint, header, replay)
+
+        def replay_fun(x, *args):
+            global last_function_value
+            n = len(history)
+            if n < len(replay) and np.array_equal(replay[n][0], x):
+                value = replay[n][1]
+                last_function_value = value[0] if jac else value
+            else:
+                if len(replay) > 0:
+                    # drop the records after the point of divergence
+                    replay.clear()
+                    saved[0] = n
+                    if checkpoint is not None:
+                        write_log(checkpoint, header, history)
+                value = obj_fun(x, *args)
+            history.append((np.array(x), value))
+            best[0] = min(best[0], value[0] if jac else value)
+            return value
+
+        def save_history():
+            if checkpoint is not None and len(history) > saved[0]:
+                append_log(checkpoint, history[saved[0]:])
+                saved[0] = len(history)
 
         #def my_callback(xk):
         #    print(f"Solution: {xk[:2]}, Objective: {last_function_value}")
         class CallbackFunction:
-            def __init__(self):
+            def __init__(self, verbose):
                 self.iteration = 0  # Initialize iteration count
+                self.verbose = verbose
 
             def callback(self, xk):
                 self.iteration += 1  # Increment iteration count
-                if self.iteration % 10 == 0:  # Check if it's a multiple of 10
+                if self.verbose and self.iteration % 10 == 0:  # Check if it's a multiple of 10
                     print("Step {:4d} {:.4f}".format(self.iteration, last_function_value))
+                if self.iteration % interval == 0:
+                    save_history()
+                if stop is not None and stop(self.iteration, best[0]):
+                    raise StopIteration
 
-        callback = CallbackFunction() if self.verbose else None
+        callback = CallbackFunction(self.verbose)
 
         res = minimize(#obj_fun,
-                       obj_fun, #objective_function_wrapper,
+                       replay_fun, #objective_function_wrapper,
                        x,
-                       method = 'Nelder-Mead',
+                       method = method,
+                       jac = jac,
                        args = fun_args, #(ref_dics, parameters0, e_offset, ids, charges),
                        options = {'maxiter': steps, 'disp': True},
                        bounds = bounds,
                        callback = callback.callback,
                        )
+        save_history()
 
         # Rearrange the optimized parameters to the list of values
         values = self.optimize_post(res.x, fun_args[-3], fun_args[-1])
         print("Final Obj", res.fun)
+        if self.objective_cache is not None:
+            self.objective_cache.report('optimize_local')
         return res.x, res.fun, values, res.nfev
 
+    def optimize_multistart(self, ref_dics, opt_dict, parameters0=None, nstarts=4,
+                            scale=0.1, margin=0.2, min_steps=20, seed=None, **kwargs):
+        """
+        Run several optimize_local from the given values and from random
+        perturbations within the bounds, and keep the best. The starts run
+        concurrently, each in its own process and folder, with the ncpu
+        split between the starts and the references. A start is cancelled
+        if its objective falls behind the best of all starts.
+
+        Args:
+            ref_dics (dict): reference data dictionary
+            opt_dict (dict): optimization terms and values
+            parameters0 (array): initial full parameters
+            nstarts (int): number of starts, the first one is unperturbed
+            scale (float): perturbation as a fraction of the bound widths
+            margin (float): relative margin to cancel a start
+            min_steps (int): number of steps before a start can be cancelled
+            seed (int): random seed of the perturbations
+            kwargs: other arguments of optimize_local (steps, obj, method)
+        Returns:
+            The optimized values of the best start and the total number of
+            evaluations
+        """
+        if parameters0 is None:
+            _, parameters0 = self.optimize_offset(ref_dics)
+        terms = list(opt_dict.keys())
+        _, sub_bounds, _ = self.get_sub_parameters(parameters0, terms)
+        rng = np.random.default_rng(seed)
+
+        opt_dicts = [opt_dict]
+        for i in range(1, nstarts):
+            _opt_dict = {}
+            for term, bounds in zip(terms, sub_bounds):
+                lb, ub = np.array(bounds).T
+                if term == 'charge':
+                    # the charges are optimized as a ratio in the bounds
+                    ratio = 1 + scale * (ub[0] - lb[0]) * rng.uniform(-1, 1)
+                    _opt_dict[term] = np.array(opt_dict[term]) * np.clip(ratio, lb[0], ub[0])
+                else:
+                    values = np.array(opt_dict[term], dtype=float)
+                    values += scale * (ub - lb) * rng.uniform(-1, 1, len(values))
+                    _opt_dict[term] = np.clip(values, lb, ub)
+            opt_dicts.append(_opt_dict)
+
+        nparallel = min([nstarts, self.ncpu])
+        best = mp.Value('d', np.inf)
+        results = [None] * nstarts
+        todo = iter(range(nstarts))
+        busy = {}
+        while True:
+            while len(busy) < nparallel:
+                i = next(todo, None)
+                if i is None:
+                    break
+                params = self.get_worker_copy()
+                params.ncpu = max([1, self.ncpu // nparallel])
+                params.objective_cache = ObjectiveCache()
+                conn, child_conn = mp.Pipe()
+                p = mp.Process(target=multistart_worker,
+                               args=(child_conn,
+                                     params,
+                                     ref_dics,
+                                     opt_dicts[i],
+                                     parameters0,
+                                     os.path.abspath(os.path.join(self.workdir, f"start{i:03d}")),
+                                     best,
+                                     margin,
+                                     min_steps,
+                                     kwargs))
+                p.start()
+                child_conn.close()
+                busy[conn] = (i, p)
+            if len(busy) == 0:
+                break
+            for conn in wait(list(busy.keys())):
+                i, p = busy.pop(conn)
+                try:
+                    results[i] = conn.recv()
+                except EOFError:
+                    results[i] = RuntimeError(f"start {i} exited without result")
+                conn.close()
+                p.join()
+
+        best_id, nfev = None, 0
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                print(f"Start {i:3d} failed", result)
+                continue
+            nfev += result[3]
+            profiler.merge(result[5])
+            status = 'cancelled' if result[4] else ''
+            print("Start {:3d} {:.4f} {:5d} {:s}".format(i, result[1], result[3], status))
+            if best_id is None or result[1] < results[best_id][1]:
+                best_id = i
+        if best_id is None:
+            raise RuntimeError("All starts of optimize_multistart failed")
+        x, fun, values = results[best_id][:3]
+        print("Best results from start {:d}: {:.4f}".format(best_id, fun))
+        return x, fun, values, nfev
+
     def optimize_offset(self, ref_dics, parameters0=None, steps=50):
         """
         Approximate the offset energy between FF and Reference evaluators
@@ -1334,8 +2919,6 @@ class ForceFieldParameters:
         _ref_dics = []
         self.update_ff_parameters(parameters)
         for i, ref_dic in enumerate(ref_dics):
-            self.ase_templates = {}
-            self.lmp_dat = {}
             ff_dic = self.evaluate_ff_single(ref_dic['structure'], ref_dic['numMols'])
             e1 = ff_dic['energy']/ff_dic['replicate'] + parameters[-1]
             e2 = ref_dic['energy']/ff_dic['replicate']
@@ -1362,7 +2945,35 @@ class ForceFieldParameters:
     def cut_references(self, ref_dics, cutoff):
         """
         Cut the list of references by energy
-        """
+
+        Args:
+            ref_dics: list of references, the path of a xml file (streamed)
+                or of an ase database
+            cutoff (float): energy window above the lowest energy per unit
+        """
+        if isinstance(ref_dics, str) and ref_dics.endswith('.xml'):
+            # two passes: the energies first, then only the kept structures
+            keys = ['energy', 'replicate']
+            engs = np.array([d['energy']/d['replicate'] for d in iter_xml(ref_dics, keys)])
+            eng_max = np.min(engs) + cutoff
+            _ref_dics = []
+            for i, dic in enumerate(iter_xml(ref_dics)):
+                if engs[i] < eng_max:
+                    _ref_dics.append(xml_dict_to_ref_dic(dic))
+            print("Reduce references {:d} => {:d}".format(len(engs), len(_ref_dics)))
+            return _ref_dics
+
+        elif isinstance(ref_dics, str):
+            # query the ase database by the indexed energy_per_unit
+            db = connect(ref_dics)
+            N0 = db.count()
+            row = next(db.select('energy_per_unit', sort='energy_per_unit', limit=1), None)
+            if row is None:
+                raise ValueError("No reference energy in the database", ref_dics)
+            _ref_dics = db_to_dict_list(ref_dics, emax=row.energy_per_unit + cutoff)
+            print("Reduce references {:d} => {:d}".format(N0, len(_ref_dics)))
+            return _ref_dics
+
         N0 = len(ref_dics)
         engs = []
         for ref_dic in ref_dics:
@@ -1378,9 +2989,31 @@ class ForceFieldParameters:
 
     def select_references(self, ref_dics, fields=['CSP', 'minimum']):
         """
-        Cut the list of references by energy
+        Select the list of references by tags
+
+        Args:
+            ref_dics: list of references, the path of a xml file (streamed)
+                or of an ase database
+            fields (list): tags to keep
         """
         assert(type(fields) == list)
+        if isinstance(ref_dics, str) and ref_dics.endswith('.xml'):
+            N0 = 0
+            _ref_dics = []
+            for dic in iter_xml(ref_dics):
+                N0 += 1
+                if dic['tag'] in fields:
+                    _ref_dics.append(xml_dict_to_ref_dic(dic))
+            print("Reduce references {:d} => {:d}".format(N0, len(_ref_dics)))
+            return _ref_dics
+
+        elif isinstance(ref_dics, str):
+            # query the ase database by the indexed tag
+            N0 = connect(ref_dics).count()
+            _ref_dics = db_to_dict_list(ref_dics, tags=fields)
+            print("Reduce references {:d} => {:d}".format(N0, len(_ref_dics)))
+            return _ref_dics
+
         N0 = len(ref_dics)
         _ref_dics = []
         for ref_dic in ref_dics:
@@ -1390,56 +3023,86 @@ class ForceFieldParameters:
         return _ref_dics
 
 
-    def load_references(self, filename, reset_cell=False):
+    def load_references(self, filename, reset_cell=False, fields=None, mmap=True,
+                        selection=None):
         """
         Load the reference information
 
         Args:
-            - filename (str): path of reference file
+            - filename (str): path of reference file (xml, npz or db)
             - reset_cell (bool): whether or not reset the cell
+            - fields (list): keys of the reference dictionary to load (npz only)
+            - mmap (bool): whether or not memory-map the arrays (npz only)
+            - selection: ase db selection, e.g., 'tag=CSP' (db only)
 
         Returns:
-            the list of reference dictionaries
+            the list of reference dictionaries, the cost models are fitted
+            if the runtimes were recorded
         """
         ref_dics = []
-        if filename.endswith(('.xml', '.db')):
+        if filename.endswith(('.xml', '.db', '.npz')):
             # Load reference data from file
             if filename.endswith('.xml'):
-                dics = xml_to_dict_list(filename)
-                for dic in dics:
-                    structure = Atoms(numbers = dic['numbers'],
-                                      positions = dic['position'],
-                                      cell = dic['lattice'],
-                                      pbc = [1, 1, 1])
-                    if reset_cell:
-                        structure = reset_lammps_cell(structure)
-                    dic0 = {
-                            'structure': structure,
-                            'energy': dic['energy'],
-                            'forces': dic['forces'],
-                            'stress': dic['stress'],
-                            'replicate': dic['replicate'],
-                            'options': dic['options'],
-                            'tag': dic['tag'],
-                            'numMols': [int(m) for m in dic['numMols']],
-                           }
-                    ref_dics.append(dic0)
+                for dic in iter_xml(filename):
+                    ref_dics.append(xml_dict_to_ref_dic(dic, reset_cell))
             else:
-                pass
+                if filename.endswith('.npz'):
+                    ref_dics = npz_to_dict_list(filename, fields, mmap)
+                else:
+                    ref_dics = db_to_dict_list(filename, selection=selection)
+                if reset_cell:
+                    for ref_dic in ref_dics:
+                        if 'structure' in ref_dic:
+                            ref_dic['structure'] = reset_lammps_cell(ref_dic['structure'])
         else:
             raise ValueError("Unsupported file format")
 
+        # refit the cost models from the runtimes stored with the references
+        for stage in ['lmp', 'ref']:
+            self.fit_cost_model(ref_dics, stage)
         return ref_dics
 
+    def iter_references(self, filename, reset_cell=False, chunksize=None):
+        """
+        Iterate over the references of a file. The xml file is streamed so
+        that only the current references are kept in memory; the other
+        formats are loaded by load_references.
+
+        Args:
+            - filename (str): path of reference file (xml, npz or db)
+            - reset_cell (bool): whether or not reset the cell
+            - chunksize (int): if given, yield lists of up to chunksize
+              references, e.g., to evaluate the objective chunk by chunk
+
+        Yields:
+            the reference dictionary or the list of reference dictionaries
+        """
+        if filename.endswith('.xml'):
+            refs = (xml_dict_to_ref_dic(dic, reset_cell) for dic in iter_xml(filename))
+        else:
+            refs = iter(self.load_references(filename, reset_cell))
+
+        if chunksize is None:
+            yield from refs
+        else:
+            chunk = []
+            for ref_dic in refs:
+                chunk.append(ref_dic)
+                if len(chunk) == chunksize:
+                    yield chunk
+                    chunk = []
+            if len(chunk) > 0:
+                yield chunk
+
     def export_references(self, ref_dics, filename='reference.xml'):
         """
-        export the reference configurations to xml or ase.db
+        export the reference configurations to xml, npz or ase.db
 
         Args:
             - ref_dics: list of reference configuration in dict format
             - filename: filename
         """
-        if filename.endswith(('.xml', '.db')):
+        if filename.endswith(('.xml', '.db', '.npz')):
             # Export reference data to file
             if filename.endswith('.xml'):
                 root = ET.Element('library')
@@ -1472,20 +3135,33 @@ class ForceFieldParameters:
                 with open(filename, 'w') as f:
                     f.write(pretty_xml)
 
+            elif filename.endswith('.npz'):
+                # Binary columnar format
+                dict_list_to_npz(ref_dics, filename)
+
             elif filename.endswith('.db'):
-                # Ase database
-                pass
+                # Ase database, appended to the existing rows
+                dict_list_to_db(ref_dics, filename, '.'.join(self.smiles))
         else:
             raise ValueError("Unsupported file format")
 
+    def convert_references(self, filename_in, filename_out):
+        """
+        Convert the reference file between the supported formats,
+        e.g., reference.xml to reference.npz and vice versa
+
+        Args:
+            - filename_in: input reference file
+            - filename_out: output reference file
+        """
+        ref_dics = self.load_references(filename_in, mmap=False)
+        self.export_references(ref_dics, filename_out)
+
     def get_label(self, i):
-        if i < 10:
-            folder = f"cpu00{i}"
-        elif i < 100:
-            folder = f"cpu0{i}"
-        else:
-            folder = f"cpu0{i}"
-        return folder
+        """
+        Get the folder of the i-th worker in the workdir
+        """
+        return os.path.join(self.workdir, f"cpu{i:03d}")
 
     def evaluate_single_reference(self, ref_dic, parameters):
 
@@ -1523,13 +3199,9 @@ class ForceFieldParameters:
         self.update_ff_parameters(parameters)
         offset_opt = parameters[-1]
 
-        ff_eng, ff_force, ff_stress = [], [], []
-        ref_eng, ref_force, ref_stress = [], [], []
-
-        lmp_strucs, lmp_dats = self.get_lmp_inputs_from_ref_dics(ref_dics)
-        lmp_in = self.ff.get_lammps_in()
-
         if self.ncpu == 1:
+            lmp_strucs, lmp_dats = self.get_lmp_inputs_from_ref_dics(ref_dics)
+            refs, efs_refs = [], []
             for i, ref_dic in enumerate(ref_dics):
                 structure, options, numMols = ref_dic['structure'], ref_dic['options'], ref_dic['numMols']
                 #print(lmp_strucs[i].box)
@@ -1549,55 +3221,19 @@ class ForceFieldParameters:
                 e2 = ref_dic['energy']/ff_dic['replicate']
                 de = abs(e1 + offset_opt - e2)
                 if e1 < max_E and de < max_dE:
-                    ff_eng.append(e1 + offset_opt)
-                    ref_eng.append(e2)
-                    if ref_dic['options'][1]:
-                        ff_force.extend(ff_dic['forces'].tolist())
-                        ref_force.extend(ref_dic['forces'].tolist())
-                    if ref_dic['options'][2]:
-                        ff_stress.extend(ff_dic['stress'].tolist())
-                        ref_stress.extend(ref_dic['stress'].tolist())
+                    refs.append(ref_dic)
+                    efs_refs.append((ff_dic['energy'], ff_dic['forces'], ff_dic['stress']))
+            (ff_eng, ff_force, ff_stress,
+             ref_eng, ref_force, ref_stress) = stack_efs(efs_refs, refs, offset_opt)
         else:
-            #parallel process
-            N_cycle = int(np.ceil(len(ref_dics)/self.ncpu))
-            #for cycle in range(N_cycle):
-            args_list = []
-            for i in range(self.ncpu):
-                folder = self.get_label(i)
-                id1 = i * N_cycle
-                id2 = min([id1+N_cycle, len(ref_dics)])
-                #print(i, id1, id2, len(ref_dics))
-                os.makedirs(folder, exist_ok=True)
-                args_list.append((ref_dics[id1:id2],
-                                  lmp_strucs[id1:id2],
-                                  lmp_dats[id1:id2],
-                                  lmp_in,
-                                  offset_opt,
-                                  self.natoms_per_unit,
-                                  self.f_coef,
-                                  self.s_coef,
-                                  folder,
-                                  max_E,
-                                  max_dE))
-
-            with ProcessPoolExecutor(max_workers=self.ncpu) as executor:
-                results = [executor.submit(evaluate_ff_error_par, *p) for p in args_list]
-                for result in results:
-                    res = result.result()
-                    ff_eng.extend(res[0])
-                    if len(res[1]) > 0: ff_force.extend(res[1])
-                    if len(res[2]) > 0: ff_stress.extend(res[2])
-                    ref_eng.extend(res[3])
-                    if len(res[4]) > 0: ref_force.extend(res[4])
-                    if len(res[5]) > 0: ref_stress.extend(res[5])
-
-        ff_eng = np.array(ff_eng).flatten()
-        ff_force = np.array(ff_force).flatten()
-        ff_stress = np.array(ff_stress)
-
-        ref_eng = np.array(ref_eng).flatten()
-        ref_force = np.array(ref_force).flatten()
-        ref_stress = np.array(ref_stress)
+            #parallel process with the persistent workers, one task per reference
+            pool = self.get_pool(ref_dics)
+            costs = self.get_costs(ref_dics, 'lmp')
+            results = pool.evaluate_errors(parameters, offset_opt, max_E, max_dE, costs)
+            # each result holds the 1D arrays of one reference
+            (ff_eng, ff_force, ff_stress,
+             ref_eng, ref_force, ref_stress) = [np.concatenate([res[i] for res in results])
+                                                for i in range(6)]
 
         mse_eng = np.sqrt(np.mean((ff_eng-ref_eng)**2))
         mse_for = np.sqrt(np.mean((ff_force-ref_force)**2))
@@ -1633,35 +3269,24 @@ class ForceFieldParameters:
 
         if not augment:
             if self.ncpu == 1:
-                for numMol, struc in zip(numMols, strucs):
-                    ref_structure = reset_lammps_cell(struc)
-                    ref_dic = evaluate_ref_single(ref_structure,
-                                                  numMol,
-                                                  self.calculator,
-                                                  self.natoms_per_unit,
-                                                  [True, True, True])
-                    ref_dic['tag'] = 'CSP'
-                    ref_dics.append(ref_dic)
+                ref_dics = evaluate_ref_par(strucs,
+                                            numMols,
+                                            self.calculator,
+                                            self.natoms_per_unit,
+                                            [True, True, True])
             else:
-                N_cycle = int(np.ceil(len(strucs)/self.ncpu))
-                args_list = []
-                for i in range(self.ncpu):
-                    folder = self.get_label(i)
-                    id1 = i*N_cycle
-                    id2 = min([id1+N_cycle, len(strucs)])
-                    os.makedirs(folder, exist_ok=True)
-                    print("# parallel process", N_cycle, id1, id2)
-                    args_list.append((strucs[id1:id2],
-                                      numMols[id1:id2],
-                                      self.calculator,
-                                      self.natoms_per_unit,
-                                      [True, True, True]))
-
-                with ProcessPoolExecutor(max_workers=self.ncpu) as executor:
-                    results = [executor.submit(evaluate_ref_par, *p) for p in args_list]
-                    for result in results:
-                        res = result.result()
-                        ref_dics.extend(res)
+                folders = [self.get_label(i) for i in range(self.ncpu)]
+                args_list = [([struc], [numMol]) for struc, numMol in zip(strucs, numMols)]
+                print("# parallel process", len(args_list), self.ncpu)
+                results = schedule_tasks(evaluate_ref_par,
+                                         args_list,
+                                         folders,
+                                         self.get_costs(strucs, 'ref'),
+                                         calculator=self.calculator,
+                                         natoms_per_unit=self.natoms_per_unit,
+                                         options=[True, True, True])
+                for res in results:
+                    ref_dics.extend(res)
 
         # augment structures is more expensive
         else:
@@ -1675,28 +3300,21 @@ class ForceFieldParameters:
                     ref_dics.extend(dics)
 
             else:
-                N_cycle = int(np.ceil(len(strucs)/self.ncpu))
-                args_list = []
-                for i in range(self.ncpu):
-                    folder = self.get_label(i)
-                    id1 = i*N_cycle
-                    id2 = min([id1+N_cycle, len(strucs)])
-                    os.makedirs(folder, exist_ok=True)
-                    print("# parallel process", N_cycle, id1, id2)
-                    args_list.append((strucs[id1:id2],
-                                      numMols[id1:id2],
-                                      self.calculator,
-                                      steps,
-                                      N_vibs,
-                                      self.natoms_per_unit,
-                                      folder,
-                                      logfile))
-
-                with ProcessPoolExecutor(max_workers=self.ncpu) as executor:
-                    results = [executor.submit(augment_ref_par, *p) for p in args_list]
-                    for result in results:
-                        res = result.result()
-                        ref_dics.extend(res)
+                folders = [self.get_label(i) for i in range(self.ncpu)]
+                args_list = [([struc], [numMol]) for struc, numMol in zip(strucs, numMols)]
+                print("# parallel process", len(args_list), self.ncpu)
+                results = schedule_tasks(augment_ref_par,
+                                         args_list,
+                                         folders,
+                                         self.get_costs(strucs, 'ref'),
+                                         calculator=self.calculator,
+                                         steps=steps,
+                                         N_vibs=N_vibs,
+                                         n_atoms_per_unit=self.natoms_per_unit,
+                                         folder_arg='folder',
+                                         logfile=logfile)
+                for res in results:
+                    ref_dics.extend(res)
 
         return ref_dics
 
@@ -1732,21 +3350,16 @@ class ForceFieldParameters:
                 strucs.append(c0.to_ase(resort=False))
                 numMols.append(c0.numMols)
         else:
-            N_cycle = int(np.ceil(len(strs)/self.ncpu))
-            args_list = []
-            for i in range(self.ncpu):
-                id1 = i*N_cycle
-                id2 = min([id1+N_cycle, len(strs)])
-                print("# parallel process", N_cycle, id1, id2)
-                args_list.append((strs[id1:id2], smiles))
-
-            with ProcessPoolExecutor(max_workers=self.ncpu) as executor:
-                results = [executor.submit(add_strucs_par, *p) for p in args_list]
-                for result in results:
-                    res = result.result()
-                    if len(res) > 0:
-                        strucs.extend(res[0])
-                        numMols.extend(res[1])
+            folders = [self.get_label(i) for i in range(self.ncpu)]
+            args_list = [([_str],) for _str in strs]
+            results = schedule_tasks(add_strucs_par,
+                                     args_list,
+                                     folders,
+                                     [len(_str) for _str in strs],
+                                     smiles=smiles)
+            for res in results:
+                strucs.extend(res[0])
+                numMols.extend(res[1])
 
         return self.add_multi_references(strucs, numMols, augment, steps, N_vibs)
 
@@ -1915,10 +3528,6 @@ class ForceFieldParameters:
         """
         self.update_ff_parameters(parameters)
         for i, ref_dic in enumerate(ref_dics):
-            # Remove the templates
-            self.ase_templates = {}
-            self.lmp_dat = {}
-
             ff_dic = self.evaluate_ff_single(ref_dic['structure'], ref_dic['numMols'])
             e1 = ff_dic['energy']/ff_dic['replicate'] + parameters[-1]
             e2 = ref_dic['energy']/ff_dic['replicate']
@@ -0,0 +1,712 @@
+#!/usr/bin/env python
+"""
+Process pools to run the FF fitting tasks in parallel.
+
+    - schedule_tasks: one-off tasks (e.g., the reference calculations)
+      handed out to a process pool, the most expensive first
+    - FFWorkerPool: persistent lammps workers for the FF objective, which
+      keep the references (see SharedReferences) between the calls
+    - multistart_worker: one start of optimize_multistart
+
+The evaluation helpers of the workers come from pyocse.parameters, which
+imports this module, so that they are imported when the workers run.
+"""
+import os, time
+import traceback
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+
+import numpy as np
+from ase import Atoms
+
+from pyocse import profiler
+from pyocse.lmp import LAMMPSCalculator
+from pyocse.lmp.calculator import get_lammps_instance
+
+
+def get_task_order(costs):
+    """
+    Get the order to submit the tasks, the most expensive first, so that
+    the long tasks do not end up last on a single worker.
+
+    Args:
+        costs (list): estimated cost of each task (e.g., number of atoms)
+
+    Returns:
+        the task ids sorted by decreasing cost
+    """
+    return np.argsort(-np.asarray(costs, dtype=float), kind='stable').tolist()
+
+class TaskWorker:
+    """
+    State of a worker process of schedule_tasks. It is set up once per
+    process by the pool initializer with the function, the shared
+    arguments and the folder, so that only the arguments of each task are
+    sent afterwards. The state only exists in the worker processes.
+
+    Args:
+        func: function to call
+        kwargs (dict): arguments shared by all tasks
+        folder (str): folder of the worker
+        folder_arg (str): keyword of func to receive the folder
+    """
+    context = None
+
+    def __init__(self, func, kwargs, folder, folder_arg=None):
+        self.func = func
+        self.kwargs = dict(kwargs)
+        if folder_arg is not None:
+            self.kwargs[folder_arg] = folder
+
+    @classmethod
+    def initialize(cls, folders, func, kwargs, folder_arg=None):
+        """
+        Take a working folder and keep the state of the new worker process
+        """
+        folder = folders.get()
+        os.makedirs(folder, exist_ok=True)
+        cls.context = cls(func, kwargs, folder, folder_arg)
+
+    @classmethod
+    def run(cls, args):
+        """
+        Run one task with the positional arguments args
+        """
+        context = cls.context
+        return context.func(*args, **context.kwargs)
+
+def schedule_tasks(func, args_list, folders, costs=None, folder_arg=None, **kwargs):
+    """
+    Run func(*args, **kwargs) for each args in args_list with one process
+    per folder. Each task is submitted on its own, the most expensive
+    first, and an idle process picks up the next remaining task. The
+    function and the shared kwargs (e.g., the reference calculator) are
+    only sent once to each process. Each process has its own folder,
+    which is given to the functions that write files through the
+    folder_arg keyword, the working directory is never changed.
+
+    Args:
+        func: function to call, must be picklable
+        args_list (list): positional arguments of each task
+        folders (list): folders of the processes
+        costs (list): estimated cost of each task, None to keep the order
+        folder_arg (str): keyword of func to receive the folder
+        kwargs: arguments shared by all tasks
+
+    Returns:
+        the list of results in the order of args_list
+    """
+    if costs is None:
+        order = range(len(args_list))
+    else:
+        order = get_task_order(costs)
+
+    queue = mp.Queue()
+    for folder in folders:
+        queue.put(os.path.abspath(folder))
+
+    results = [None] * len(args_list)
+    with ProcessPoolExecutor(max_workers=len(folders),
+                             initializer=TaskWorker.initialize,
+                             initargs=(queue, func, kwargs, folder_arg)) as executor:
+        futures = [(i, executor.submit(TaskWorker.run, args_list[i])) for i in order]
+        for i, future in futures:
+            results[i] = future.result()
+    return results
+
+class SharedReferences:
+    """
+    The reference arrays (positions, cells, forces and stresses) packed
+    once into one shared memory block per array type, with the offset and
+    shape of each reference. Only the block names, the offsets and the
+    small per-reference values (numbers, energy, options, ...) are
+    pickled when it is sent to a worker process, which then rebuilds the
+    ref_dics with get_ref_dics. The forces and stresses of the rebuilt
+    ref_dics are read-only views of the shared memory.
+
+    Args:
+        ref_dics: list of reference dictionaries
+    """
+    keys = ['positions', 'cell', 'forces', 'stress']
+
+    def __init__(self, ref_dics):
+        arrays = {key: [] for key in self.keys}
+        for ref_dic in ref_dics:
+            structure = ref_dic['structure']
+            arrays['positions'].append(structure.positions)
+            arrays['cell'].append(structure.cell.array)
+            arrays['forces'].append(ref_dic.get('forces'))
+            arrays['stress'].append(ref_dic.get('stress'))
+
+        self.owner = True
+        self.blocks = {}
+        self.layouts = {}
+        for key in self.keys:
+            layout, size = [], 0
+            for array in arrays[key]:
+                if array is None:
+                    layout.append(None)
+                else:
+                    shape = np.shape(array)
+                    layout.append((size, shape))
+                    size += int(np.prod(shape))
+            block = shared_memory.SharedMemory(create=True, size=max([8, 8 * size]))
+            buf = np.ndarray(size, dtype=np.float64, buffer=block.buf)
+            for array, item in zip(arrays[key], layout):
+                if item is not None:
+                    buf[item[0]:item[0]+int(np.prod(item[1]))] = np.ravel(array)
+            del buf
+            self.blocks[key] = block
+            self.layouts[key] = layout
+
+        self.meta = []
+        for ref_dic in ref_dics:
+            structure = ref_dic['structure']
+            dic = {k: v for (k, v) in ref_dic.items() if k not in ['structure', 'forces', 'stress']}
+            self.meta.append((dic, structure.numbers.copy(), structure.pbc.copy()))
+
+    def __len__(self):
+        return len(self.meta)
+
+    def __getstate__(self):
+        return {'names': {key: block.name for (key, block) in self.blocks.items()},
+                'layouts': self.layouts,
+                'meta': self.meta}
+
+    def __setstate__(self, state):
+        self.owner = False
+        self.layouts = state['layouts']
+        self.meta = state['meta']
+        self.blocks = {key: shared_memory.SharedMemory(name=name)
+                       for (key, name) in state['names'].items()}
+
+    def get_array(self, key, i):
+        """
+        Get the read-only view of the array of the i-th reference, None
+        if it does not have one
+        """
+        item = self.layouts[key][i]
+        if item is None:
+            return None
+        offset, shape = item
+        array = np.ndarray(shape, dtype=np.float64, buffer=self.blocks[key].buf,
+                           offset=8 * offset)
+        array.flags.writeable = False
+        return array
+
+    def get_ref_dics(self):
+        """
+        Rebuild the list of reference dictionaries
+        """
+        ref_dics = []
+        for i, (dic, numbers, pbc) in enumerate(self.meta):
+            ref_dic = dict(dic)
+            ref_dic['structure'] = Atoms(numbers=numbers,
+                                         positions=self.get_array('positions', i),
+                                         cell=self.get_array('cell', i),
+                                         pbc=pbc)
+            ref_dic['forces'] = self.get_array('forces', i)
+            ref_dic['stress'] = self.get_array('stress', i)
+            ref_dics.append(ref_dic)
+        return ref_dics
+
+    def close(self):
+        """
+        Release the shared memory, which is removed by the owner
+        """
+        for block in self.blocks.values():
+            if self.owner:
+                block.unlink()
+            try:
+                block.close()
+            except BufferError:
+                # views are still in use by the process
+                pass
+        self.blocks = {}
+
+def ff_worker(conn, params, refs, folder, profile=False):
+    """
+    Persistent worker to evaluate the FF objective on the references.
+    It keeps a private copy of ForceFieldParameters, the ref_dics
+    and one warm lammps instance (or the live instances per topology if
+    lmp_mode is 'memory') until it receives None. The tasks are either
+    ('update', parameters, e_offset, E_only, obj, lmp_in) to set the
+    parameters (and the lammps input if lmp_in is not None),
+    which needs no reply, ('run', i) to evaluate the i-th reference,
+    which replies the obj_from_efs result and the (setup, run) wall times,
+    ('error', i, max_E, max_dE) to reply the stack_efs arrays of the i-th
+    reference (empty if its energy is unphysical) and the wall times,
+    ('efs', i) to reply the lammps (energy, forces, stress) of the i-th
+    reference and the wall times,
+    ('objective', parameters, e_offset, E_only, obj) to evaluate all
+    references with a candidate, which replies the collect_ff_results and
+    the list of wall times, or ('profile', enabled) to reply and reset the
+    timers of the worker (see pyocse.profiler).
+
+    Args:
+        conn: the worker end of a multiprocessing Pipe
+        params: ForceFieldParameters object for the worker
+        refs: SharedReferences of the reference dictionaries
+        folder: working directory for the lammps files
+        profile (bool): whether or not to switch on the timers
+    """
+    from pyocse.parameters import (collect_ff_results, get_lmp_calc_inplace,
+                                   obj_from_efs, stack_efs)
+
+    profiler.enable(profile)
+    ref_dics = refs.get_ref_dics()
+    os.makedirs(folder, exist_ok=True)
+    params.workdir = folder
+    if params.lmp_mode == 'memory':
+        lmp = None
+    else:
+        lmp = get_lammps_instance(os.path.join(folder, 'lmp'))
+
+    last = None
+
+    def run(ref_dic, lmp_in):
+        nonlocal last
+        try:
+            t0 = time.time()
+            structure = ref_dic['structure']
+            lmp_struc, lmp_dat = params.get_lmp_input_from_structure(structure, ref_dic['numMols'])
+            lmp_struc.box = structure.cell.cellpar()
+            lmp_struc.coordinates = structure.get_positions()
+            calcs = params.get_lmp_calcs()
+            if calcs is not None:
+                calc = get_lmp_calc_inplace(calcs, lmp_struc, lmp_in, lmp_dat,
+                                            params.ff_version, folder)
+            else:
+                # keep the loaded lammps data if the topology is the same
+                # as in the previous task
+                key = (id(lmp_struc), params.ff_version)
+                if last is not None and last[0] == key:
+                    calc = last[1]
+                    calc.update(lmp_struc, coefficients=False)
+                else:
+                    if not hasattr(lmp_struc, 'ewald_error_tolerance'):
+                        lmp_struc.complete()
+                    calc = LAMMPSCalculator(lmp_struc,
+                                            base=os.path.join(folder, 'lmp'),
+                                            lmp_in=lmp_in,
+                                            lmp_dat=lmp_dat,
+                                            lmp_instance=lmp)
+                    last = (key, calc)
+            t1 = time.time()
+            efs = calc.express_evaluation()
+            t2 = time.time()
+        except Exception:
+            last = None
+            raise
+        return efs, (t1 - t0, t2 - t1)
+
+    error = None
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        if task[0] == 'profile':
+            conn.send(profiler.get_stats(clear=True))
+            profiler.enable(task[1])
+            continue
+
+        if task[0] == 'update':
+            (_, parameters, e_offset, E_only, obj, lmp_in) = task
+            try:
+                params.update_ff_parameters(parameters)
+                if lmp_in is None:
+                    lmp_in = params.ff.get_lammps_in()
+                error = None
+            except Exception:
+                error = RuntimeError(traceback.format_exc())
+            continue
+
+        if task[0] == 'objective':
+            (_, parameters, e_offset, E_only, obj) = task
+            try:
+                params.update_ff_parameters(parameters)
+                lmp_in = params.ff.get_lammps_in()
+                error = None
+                results, times = [], []
+                for ref_dic in ref_dics:
+                    efs, t = run(ref_dic, lmp_in)
+                    results.append(obj_from_efs(efs, ref_dic, e_offset, E_only,
+                                                params.f_coef, params.s_coef, obj))
+                    times.append(t)
+                result = (collect_ff_results(results, obj), times)
+            except Exception:
+                error = RuntimeError(traceback.format_exc())
+                result = error
+            with profiler.timer('ipc_send'):
+                conn.send(result)
+            continue
+
+        if error is not None:
+            conn.send(error)
+            continue
+        try:
+            ref_dic = ref_dics[task[1]]
+            efs, t = run(ref_dic, lmp_in)
+            if task[0] == 'error':
+                (_, _, max_E, max_dE) = task
+                # Ignore the structures with unphysical energy values
+                replicate = ref_dic['replicate']
+                e_diff = efs[0]/replicate + e_offset - ref_dic['energy']/replicate
+                if efs[0] < max_E and abs(e_diff) < max_dE:
+                    result = (stack_efs([efs], [ref_dic], e_offset), t)
+                else:
+                    print('Neglect reference due to energy', efs[0], abs(e_diff), ref_dic['tag'])
+                    result = (stack_efs([], [], e_offset), t)
+            elif task[0] == 'efs':
+                result = (efs, t)
+            else:
+                result = (obj_from_efs(efs, ref_dic, e_offset, E_only,
+                                       params.f_coef, params.s_coef, obj), t)
+        except Exception:
+            result = RuntimeError(traceback.format_exc())
+        with profiler.timer('ipc_send'):
+            conn.send(result)
+    if lmp is not None:
+        lmp.close()
+    conn.close()
+
+class FFWorkerPool:
+    """
+    A pool of long-lived processes to compute the FF objective. Each
+    worker process is started only once with the references, which are
+    passed through shared memory (see SharedReferences). For each
+    objective call, only the parameter vector is sent to the workers and
+    the references are then handed out one by one, the largest first, to
+    whichever worker is idle. The results are gathered in the input order
+    and the wall times are recorded in the runtime of each ref_dic.
+    Candidates can also be submitted without waiting (see submit), each
+    is then evaluated on all references by one worker, while a background
+    thread dispatches them and collects the results.
+
+    Args:
+        params: ForceFieldParameters object
+        ref_dics: list of reference dictionaries
+        nworkers: number of worker processes
+    """
+
+    def __init__(self, params, ref_dics, nworkers):
+        self.ref_dics = ref_dics
+        self.nrefs = len(ref_dics)
+        self.order = get_task_order([len(ref_dic['structure']) for ref_dic in ref_dics])
+        self.workers = []
+        # the pipes are used by either evaluate or the dispatcher thread
+        self.lock = threading.RLock()
+        self.queue_lock = threading.Lock()
+        self.pending = deque()
+        self.thread = None
+        self.shared = SharedReferences(ref_dics)
+        self.profile = profiler.is_enabled()
+
+        for i in range(nworkers):
+            folder = os.path.abspath(params.get_label(i))
+            conn, child_conn = mp.Pipe()
+            p = mp.Process(target=ff_worker,
+                           args=(child_conn,
+                                 params.get_worker_copy(),
+                                 self.shared,
+                                 folder,
+                                 profiler.is_enabled()),
+                           daemon=True)
+            p.start()
+            child_conn.close()
+            self.workers.append((p, conn))
+
+    def is_valid(self, ref_dics):
+        """
+        Check if the pool was started for the given ref_dics
+        """
+        return ref_dics is self.ref_dics and len(ref_dics) == self.nrefs
+
+    def evaluate(self, parameters, e_offset, E_only=False, obj='MSE', costs=None,
+                 lmp_in=None):
+        """
+        Evaluate all references with the given parameters, after the
+        submitted candidates in flight are done
+
+        Args:
+            costs (list): estimated cost of each reference to order the
+                tasks, None to use the number of atoms
+            lmp_in (str): lammps input template, None to get it from the
+                FF of the workers
+
+        Returns:
+            list with the collect_ff_results of all references
+        """
+        from pyocse.parameters import collect_ff_results
+
+        results = self._run_references(('update', parameters, e_offset, E_only, obj, lmp_in),
+                                       ('run',), costs)
+        return [collect_ff_results(results, obj)]
+
+    def evaluate_errors(self, parameters, e_offset, max_E=1000.0, max_dE=1.25, costs=None):
+        """
+        Get the FF and reference values of each reference for the given
+        parameters, as in evaluate_ff_error_par
+
+        Returns:
+            list with the stack_efs arrays of each reference
+        """
+        return self._run_references(('update', parameters, e_offset, False, 'MSE', None),
+                                    ('error', max_E, max_dE), costs)
+
+    def evaluate_efs(self, parameters, ids, lmp_in=None, costs=None):
+        """
+        Get the lammps energy, forces and stress of some references for
+        the given parameters, as in evaluate_structures
+
+        Args:
+            ids (list): indices of the references
+            lmp_in (str): lammps input template
+
+        Returns:
+            list of (energy, forces, stress) in the order of ids
+        """
+        results = self._run_references(('update', parameters, 0.0, False, 'MSE', lmp_in),
+                                       ('efs',), costs, ids)
+        return [results[i] for i in ids]
+
+    def _run_references(self, update, task, costs=None, ids=None):
+        """
+        Send the update to all workers and then the index of each reference
+        to the idle workers, only the indices are sent to the workers.
+        If a reference fails, no new task is sent, the replies in flight
+        are collected and the first error is raised, the workers are kept.
+
+        Args:
+            update (tuple): the update task
+            task (tuple): the task name and arguments after the index
+            costs (list): estimated cost of each reference
+            ids (list): indices of the references to run, None for all
+
+        Returns:
+            list with the result of each reference
+        """
+        from pyocse.parameters import set_runtime
+
+        with self.lock:
+            if self.profile != profiler.is_enabled():
+                self.collect_profile()
+            with profiler.timer('ipc_send'):
+                for _, conn in self.workers:
+                    conn.send(update)
+
+            results = [None] * self.nrefs
+            order = self.order if costs is None else get_task_order(costs)
+            if ids is not None:
+                ids = set(ids)
+                order = [i for i in order if i in ids]
+            todo = iter(order)
+            busy = {}
+            for _, conn in self.workers:
+                i = next(todo, None)
+                if i is None:
+                    break
+                conn.send((task[0], i) + task[1:])
+                busy[conn] = i
+
+            error = None
+            while len(busy) > 0:
+                for conn in wait(list(busy.keys())):
+                    try:
+                        with profiler.timer('ipc_recv'):
+                            result = conn.recv()
+                    except (EOFError, OSError):
+                        # drop the dead worker
+                        self.workers = [w for w in self.workers if w[1] is not conn]
+                        result = RuntimeError("A worker exited unexpectedly")
+                    i = busy.pop(conn)
+                    if isinstance(result, Exception):
+                        if error is None:
+                            error = result
+                        continue
+                    results[i], t = result
+                    set_runtime(self.ref_dics[i], lmp_setup=t[0], lmp_run=t[1])
+                    i = None if error is not None else next(todo, None)
+                    if i is not None:
+                        conn.send((task[0], i) + task[1:])
+                        busy[conn] = i
+            if error is not None:
+                raise error
+
+        return results
+
+    def submit(self, parameters, e_offset, E_only=False, obj='MSE'):
+        """
+        Submit a candidate to be evaluated on all references by the next
+        idle worker
+
+        Returns:
+            a Future of the collect_ff_results
+        """
+        future = Future()
+        with self.queue_lock:
+            if len(self.workers) == 0:
+                raise RuntimeError("The worker pool is closed")
+            self.pending.append((future, ('objective', parameters, e_offset, E_only, obj)))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._dispatch, daemon=True)
+                self.thread.start()
+        return future
+
+    def _dispatch(self):
+        """
+        Send the submitted candidates to the idle workers and set the
+        results of their futures until nothing is left
+        """
+        from pyocse.parameters import set_runtime
+
+        with self.lock:
+            if self.profile != profiler.is_enabled():
+                self.collect_profile()
+            busy = {}
+            while True:
+                with self.queue_lock:
+                    idle = [conn for _, conn in self.workers if conn not in busy]
+                    while len(idle) > 0 and len(self.pending) > 0:
+                        future, task = self.pending.popleft()
+                        if not future.set_running_or_notify_cancel():
+                            continue
+                        conn = idle.pop()
+                        try:
+                            with profiler.timer('ipc_send'):
+                                conn.send(task)
+                        except (BrokenPipeError, OSError):
+                            self.workers = [w for w in self.workers if w[1] is not conn]
+                            future.set_exception(RuntimeError("A worker exited unexpectedly"))
+                            continue
+                        busy[conn] = future
+                    if len(busy) == 0:
+                        self.thread = None
+                        return
+
+                # wake up regularly to pick up the new submissions
+                for conn in wait(list(busy.keys()), timeout=0.05):
+                    future = busy.pop(conn)
+                    try:
+                        with profiler.timer('ipc_recv'):
+                            result = conn.recv()
+                    except (EOFError, OSError):
+                        # drop the dead worker
+                        self.workers = [w for w in self.workers if w[1] is not conn]
+                        future.set_exception(RuntimeError("A worker exited unexpectedly"))
+                        if len(self.workers) == 0:
+                            with self.queue_lock:
+                                while len(self.pending) > 0:
+                                    self.pending.popleft()[0].set_exception(
+                                        RuntimeError("No worker left in the pool"))
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        result, times = result
+                        for ref_dic, t in zip(self.ref_dics, times):
+                            set_runtime(ref_dic, lmp_setup=t[0], lmp_run=t[1])
+                        future.set_result(result)
+
+    def collect_profile(self):
+        """
+        Merge the timers of the workers into the ones of this process and
+        pass on whether the timers are enabled, see pyocse.profiler
+        """
+        with self.lock:
+            self.profile = profiler.is_enabled()
+            try:
+                for _, conn in self.workers:
+                    conn.send(('profile', profiler.is_enabled()))
+                for _, conn in self.workers:
+                    profiler.merge(conn.recv())
+            except (BrokenPipeError, EOFError, OSError):
+                print("Cannot collect the timers of a dead worker")
+
+    def evaluate_population(self, parameters_list, e_offset, E_only=False, obj='MSE'):
+        """
+        Evaluate all references for each parameter set, the candidates are
+        handed out one by one to whichever worker is idle
+
+        Args:
+            parameters_list (list): full parameters of each candidate
+
+        Returns:
+            list with the collect_ff_results of each candidate
+        """
+        futures = [self.submit(parameters, e_offset, E_only, obj)
+                   for parameters in parameters_list]
+        return [future.result() for future in futures]
+
+    def close(self):
+        """
+        Shut down all worker processes, the candidates in flight are
+        finished first and the pending ones are cancelled
+        """
+        with self.queue_lock:
+            while len(self.pending) > 0:
+                self.pending.popleft()[0].cancel()
+        with self.lock:
+            for p, conn in self.workers:
+                if p.is_alive():
+                    try:
+                        conn.send(None)
+                    except (BrokenPipeError, OSError):
+                        pass
+            for p, conn in self.workers:
+                p.join(timeout=10)
+                if p.is_alive():
+                    p.terminate()
+                conn.close()
+            self.workers = []
+            self.shared.close()
+
+def multistart_worker(conn, params, ref_dics, opt_dict, parameters0, folder,
+                      best, margin, min_steps, kwargs):
+    """
+    Run one start of optimize_multistart in its own folder and send back
+    (x, fun, values, nfev, cancelled, profile), with the timers of the
+    start from pyocse.profiler. The best objective of all starts
+    is shared in best, the start is cancelled once its own best objective
+    is worse than the shared one by the relative margin.
+
+    Args:
+        conn: the worker end of a multiprocessing Pipe
+        params: ForceFieldParameters object for the start
+        ref_dics: list of reference dictionaries
+        opt_dict: optimization terms and start values
+        parameters0: initial full parameters
+        folder: working directory of the start
+        best: shared multiprocessing Value of the best objective
+        margin (float): relative margin to cancel the start
+        min_steps (int): number of steps before a start can be cancelled
+        kwargs (dict): other arguments of optimize_local
+    """
+    cancelled = [False]
+
+    def stop(iteration, fun):
+        with best.get_lock():
+            if fun < best.value:
+                best.value = fun
+            shared = best.value
+        if iteration >= min_steps and fun > shared + margin * abs(shared):
+            cancelled[0] = True
+        return cancelled[0]
+
+    os.makedirs(folder, exist_ok=True)
+    params.workdir = folder
+    try:
+        x, fun, values, nfev = params.optimize_local(ref_dics, opt_dict, parameters0,
+                                                     stop=stop, **kwargs)
+        params.close_pool()
+        result = (x, fun, values, nfev, cancelled[0], profiler.get_stats(clear=True))
+    except Exception:
+        result = RuntimeError(traceback.format_exc())
+    finally:
+        params.close_pool()
+    conn.send(result)
+    conn.close()
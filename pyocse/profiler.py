@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Timing and counter registry for the hot path of the FF fitting.
+
+Each objective call goes through the following stages:
+
+    - template: lammps template/data strings of the structure
+    - write_input/write_data: lmp.in and lmp.dat files
+    - lmp_init: lammps instance and read of lmp.in
+    - lmp_update: in-place reset of the box/positions/coefficients
+    - run0: run 0 of lammps
+    - extract: energy, stress and forces from the lammps variables
+    - aggregate: objective from the energies, forces and stresses
+    - ipc_send/ipc_recv: pickling and transfer to/from the workers
+
+The timers are off by default, in which case timer() returns a shared
+dummy context and the cost is a function call:
+
+    from pyocse import profiler
+    profiler.enable()
+    params.optimize_local(...)
+    params.report_profile('trace.json')
+
+The worker processes keep their own registries and send them back on
+request (see FFWorkerPool.collect_profile), their times are summed up,
+so that the stages can add up to more than the wall time of the
+objective calls with ncpu > 1. The json traces of two runs
+can be compared with compare('old.json', 'new.json').
+"""
+import json
+import time
+from time import perf_counter
+
+
+STAGES = ['template', 'write_input', 'write_data', 'lmp_init', 'lmp_update',
+          'run0', 'extract', 'aggregate', 'ipc_send', 'ipc_recv', 'objective']
+
+_enabled = False
+_timers = {}     # name -> [calls, total, min, max]
+_counters = {}   # name -> count
+
+
+class _Timer:
+    __slots__ = ('name', 't0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        add_time(self.name, perf_counter() - self.t0)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def enable(flag=True):
+    """
+    Switch the timers on (or off with flag=False)
+    """
+    global _enabled
+    _enabled = bool(flag)
+
+def disable():
+    enable(False)
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    """
+    Clear all timers and counters
+    """
+    _timers.clear()
+    _counters.clear()
+
+def timer(name):
+    """
+    Context manager to accumulate the elapsed time of the block
+
+    Args:
+        name (str): stage name
+    """
+    if not _enabled:
+        return _null_timer
+    return _Timer(name)
+
+def add_time(name, t, calls=1):
+    """
+    Add the elapsed time t (in seconds) to the stage name
+    """
+    record = _timers.get(name)
+    if record is None:
+        _timers[name] = [calls, t, t, t]
+    else:
+        record[0] += calls
+        record[1] += t
+        if t < record[2]: record[2] = t
+        if t > record[3]: record[3] = t
+
+def count(name, n=1):
+    """
+    Increase the counter name by n
+    """
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+def get_stats(clear=False):
+    """
+    Get a picklable copy of the timers and counters
+
+    Args:
+        clear (bool): whether or not to reset the registry
+    """
+    stats = {'timers': {k: list(v) for k, v in _timers.items()},
+             'counters': dict(_counters)}
+    if clear:
+        reset()
+    return stats
+
+def merge(stats):
+    """
+    Add the timers and counters from get_stats of another process
+    """
+    for name, (calls, total, t_min, t_max) in stats['timers'].items():
+        record = _timers.get(name)
+        if record is None:
+            _timers[name] = [calls, total, t_min, t_max]
+        else:
+            record[0] += calls
+            record[1] += total
+            record[2] = min(record[2], t_min)
+            record[3] = max(record[3], t_max)
+    for name, n in stats['counters'].items():
+        _counters[name] = _counters.get(name, 0) + n
+
+def get_trace(label=None):
+    """
+    Get the dictionary of the json trace
+
+    Args:
+        label (str): name of the run
+    """
+    ncalls = max(_counters.get('objective', 0), 1)
+    stages = {}
+    for name, (calls, total, t_min, t_max) in _timers.items():
+        stages[name] = {'calls': calls,
+                        'total': total,
+                        'mean': total / calls,
+                        'min': t_min,
+                        'max': t_max,
+                        'per_objective': total / ncalls}
+    return {'label': label,
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'stages': stages,
+            'counters': dict(_counters)}
+
+def _sorted_names(names):
+    names = list(names)
+    order = [s for s in STAGES if s in names]
+    return order + sorted(s for s in names if s not in STAGES)
+
+def report(filename=None, label=None):
+    """
+    Print the per-stage table and dump the json trace if filename is given
+
+    Args:
+        filename (str): json file
+        label (str): name of the run
+    """
+    trace = get_trace(label)
+    stages = trace['stages']
+    counters = trace['counters']
+    ncalls = counters.get('objective', 0)
+    wall = stages['objective']['total'] if 'objective' in stages else None
+
+    print(f"Profile of {ncalls} objective calls")
+    print("{:<14s} {:>9s} {:>11s} {:>11s} {:>11s} {:>7s}".format(
+          'stage', 'calls', 'total(s)', 'mean(ms)', 'per_obj(ms)', '%obj'))
+    for name in _sorted_names(stages.keys()):
+        s = stages[name]
+        pct = 100 * s['total'] / wall if wall else 0.0
+        print("{:<14s} {:9d} {:11.4f} {:11.4f} {:11.4f} {:7.1f}".format(
+              name, s['calls'], s['total'], 1000 * s['mean'],
+              1000 * s['per_objective'], pct))
+    for name in sorted(counters.keys()):
+        if name not in stages:
+            print("{:<14s} {:9d}".format(name, counters[name]))
+
+    if filename is not None:
+        dump(filename, trace)
+    return trace
+
+def dump(filename, trace=None, label=None):
+    """
+    Write the json trace
+    """
+    if trace is None:
+        trace = get_trace(label)
+    with open(filename, 'w') as f:
+        json.dump(trace, f, indent=2)
+
+def compare(filename0, filename1):
+    """
+    Print the time per objective call of each stage in two json traces
+    """
+    with open(filename0) as f:
+        stages0 = json.load(f)['stages']
+    with open(filename1) as f:
+        stages1 = json.load(f)['stages']
+
+    print("{:<14s} {:>11s} {:>11s} {:>8s}".format('stage', 'old(ms)', 'new(ms)', 'ratio'))
+    for name in _sorted_names(set(stages0) | set(stages1)):
+        t0 = 1000 * stages0[name]['per_objective'] if name in stages0 else 0.0
+        t1 = 1000 * stages1[name]['per_objective'] if name in stages1 else 0.0
+        ratio = "{:8.2f}".format(t1 / t0) if t0 > 0 else "{:>8s}".format('-')
+        print("{:<14s} {:11.4f} {:11.4f} {}".format(name, t0, t1, ratio))